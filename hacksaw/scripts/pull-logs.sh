@@ -71,10 +71,11 @@ send_error_message()
     local lines=$(ssh $USERNAME@$REMOTEHOST wc -l $log_file | \
 	$AWK '{ print $1 }')
     local kbytes=$(get_file_size $log_file)
-    local msg_file=$(tempfile -d $LOCALDIR)
+    local msg_file=$(tempfile -d $LOCALDIR -p .msg)
     local msg="ERROR: log file too large "
     msg="$msg ($(basename $log_file): $lines lines, $kbytes kB)"
     echo "$(date "+%b %e %T") $(hostname) $(basename $0)[$$]: $msg" > $msg_file
+    mv $msg_file $LOCALDIR/$(basename $msg_file | sed 's/^\.//')
 }
 
 
@@ -110,10 +111,20 @@ file_not_empty()
 }
 
 
+# Files are copied to a hidden name in the spool directory, which
+# processlogs ignores, and only renamed into place once they're
+# complete. processlogs -d picks files up as soon as they're renamed.
+function copying_name
+{
+    local log_file=$1
+    echo "$LOCALDIR/.$(basename $log_file).$COPY_EXT"
+}
+
+
 function scp_file
 {
     local filename=$1
-    scp -Bq $USERNAME@$REMOTEHOST:$filename $LOCALDIR
+    scp -Bq $USERNAME@$REMOTEHOST:$filename $(copying_name $filename)
 }
 
 
@@ -129,6 +140,8 @@ pull_log()
 	return
     elif file_not_empty $log_file; then
 	scp_file $log_file
+	fix_localhost $log_file
+	mv $(copying_name $log_file) $LOCALDIR/$(basename $log_file)
     fi
 }
 
@@ -137,7 +150,8 @@ fix_localhost()
 {
     local log_file=$1
     hostname=$(basename ${log_file%%-*})
-    perl -p -i -e "s/^(([^ ]+ ){3})localhost/\${1}$hostname/" $log_file
+    perl -p -i -e "s/^(([^ ]+ ){3})localhost/\${1}$hostname/" \
+	$(copying_name $log_file)
 }
 
 
@@ -167,5 +181,4 @@ REMOTEHOST=$1
 files=$(list_remote_files)
 for log_file in $files; do
     pull_log $log_file
-    fix_localhost $log_file
 done
@@ -15,6 +15,7 @@ setup(name="hacksaw",
       package_dir={"": "src"},
       packages=["hacksaw", "hacksaw.proc"],
       scripts=["src/processlogs.py", "src/run-processor.py",
-               "scripts/pull-logs.sh", "scripts/push-logs.sh"],
+               "scripts/pull-logs.sh", "scripts/push-logs.sh",
+               "scripts/hacksaw-grep"],
       data_files=[("etc", ["etc/hacksaw.conf"])],
       )
@@ -0,0 +1,193 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import getopt
+import os
+import random
+import sys
+import time
+
+
+# Programs that log with a pid in their tag, and those that don't.
+PROGRAMS = [
+    ("sshd", True),
+    ("CRON", True),
+    ("postfix/smtpd", True),
+    ("named", True),
+    ("ntpd", True),
+    ("kernel", False),
+    ("sudo", False),
+    ("dhclient", False),
+]
+
+MESSAGES = {
+    "sshd": [
+        "Accepted publickey for %(user)s from %(ip)s port %(port)d ssh2",
+        "Failed password for invalid user %(user)s from %(ip)s port "
+        "%(port)d ssh2",
+        "Received disconnect from %(ip)s: 11: disconnected by user",
+    ],
+    "CRON": [
+        "(%(user)s) CMD (/usr/local/bin/check-%(number)d.sh)",
+        "pam_unix(cron:session): session opened for user %(user)s",
+    ],
+    "postfix/smtpd": [
+        "connect from unknown[%(ip)s]",
+        "%(hex)s: client=unknown[%(ip)s]",
+        "disconnect from unknown[%(ip)s]",
+    ],
+    "named": [
+        "client %(ip)s#%(port)d: query: host%(number)d.example.com IN A +",
+        "lame server resolving 'example%(number)d.net' (in 'net'?): %(ip)s#53",
+    ],
+    "ntpd": [
+        "synchronized to %(ip)s, stratum %(small)d",
+        "time reset +0.%(number)d s",
+    ],
+    "kernel": [
+        "eth0: link up, 100Mbps, full-duplex, lpa 0x%(hex)s",
+        "Out of memory: Killed process %(number)d (java).",
+        "EXT3-fs error (device sda%(small)d): ext3_find_entry: reading "
+        "directory #%(number)d offset 0",
+    ],
+    "sudo": [
+        "%(user)s : TTY=pts/%(small)d ; PWD=/home/%(user)s ; USER=root ; "
+        "COMMAND=/bin/ls",
+    ],
+    "dhclient": [
+        "DHCPREQUEST on eth0 to %(ip)s port 67",
+        "bound to %(ip)s -- renewal in %(number)d seconds.",
+    ],
+}
+
+USERS = ["root", "bob", "alice", "wilber", "nobody", "backup"]
+
+# Multi-line groups are written by the "backup" program and are matched
+# by the ignore rules below, so that they exercise MultiLineFilter.
+GROUP_PROGRAM = "backup"
+GROUP_START = "BEGIN nightly report"
+GROUP_LINE = "copied /srv/data/file%(number)d (%(number)d bytes)"
+GROUP_END = "END nightly report"
+
+IGNORE_RULES = [
+    ("match1", GROUP_START),
+    ("end1", GROUP_END),
+    ("match2", r"session opened for user \w+"),
+]
+
+
+class CorpusGenerator(object):
+
+    def __init__(self, seed=0, hosts=40, start_time=None,
+                 group_probability=0.01, group_length=20):
+        self.random = random.Random(seed)
+        self.hostnames = ["host%02d" % i for i in range(hosts)]
+        if start_time is None:
+            start_time = time.mktime((2005, 6, 1, 0, 0, 0, 0, 0, -1))
+        self.time = start_time
+        self.group_probability = group_probability
+        self.group_length = group_length
+
+    def _get_timestamp(self):
+        self.time += self.random.random()
+        localtime = time.localtime(self.time)
+        day = "%2d" % localtime.tm_mday
+        return time.strftime("%b " + day + " %H:%M:%S", localtime)
+
+    def _get_values(self):
+        rand = self.random
+        return {
+            "user": rand.choice(USERS),
+            "ip": "10.%d.%d.%d" % (rand.randint(0, 255),
+                                   rand.randint(0, 255),
+                                   rand.randint(1, 254)),
+            "port": rand.randint(1024, 65535),
+            "number": rand.randint(0, 99999),
+            "small": rand.randint(0, 9),
+            "hex": "%08X" % rand.randint(0, 0xffffffff),
+        }
+
+    def _format(self, hostname, program, pid, text):
+        if pid is None:
+            tag = program
+        else:
+            tag = "%s[%d]" % (program, pid)
+        return "%s %s %s: %s\n" % (self._get_timestamp(), hostname, tag,
+                                   text)
+
+    def _make_group(self, hostname):
+        pid = self.random.randint(100, 32767)
+        lines = [self._format(hostname, GROUP_PROGRAM, pid, GROUP_START)]
+        for i in range(self.random.randint(1, self.group_length)):
+            text = GROUP_LINE % self._get_values()
+            lines.append(self._format(hostname, GROUP_PROGRAM, pid, text))
+        lines.append(self._format(hostname, GROUP_PROGRAM, pid, GROUP_END))
+        return lines
+
+    def _make_line(self, hostname):
+        program, has_pid = self.random.choice(PROGRAMS)
+        pid = None
+        if has_pid:
+            pid = self.random.randint(100, 32767)
+        text = self.random.choice(MESSAGES[program]) % self._get_values()
+        return self._format(hostname, program, pid, text)
+
+    def generate(self, count):
+        """Yield count syslog lines in RFC 3164 format"""
+        while count > 0:
+            hostname = self.random.choice(self.hostnames)
+            if self.random.random() < self.group_probability:
+                lines = self._make_group(hostname)[:count]
+            else:
+                lines = [self._make_line(hostname)]
+            for line in lines:
+                yield line
+            count -= len(lines)
+
+    def write(self, path, count):
+        file_obj = file(path, "w")
+        try:
+            file_obj.writelines(self.generate(count))
+        finally:
+            file_obj.close()
+
+
+class Usage(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def main(argv=None):
+    count = 100000
+    hosts = 40
+    seed = 0
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        try:
+            opts, args = getopt.getopt(argv, "n:h:s:")
+            for opt, arg in opts:
+                if opt == "-n":
+                    count = int(arg)
+                elif opt == "-h":
+                    hosts = int(arg)
+                elif opt == "-s":
+                    seed = int(arg)
+        except (getopt.error, ValueError), msg:
+            raise Usage(msg)
+        if len(args) != 1:
+            raise Usage("no output file specified")
+        CorpusGenerator(seed, hosts).write(args[0], count)
+    except Usage, e:
+        print >>sys.stderr, e.msg
+        progname = os.path.basename(sys.argv[0])
+        print >>sys.stderr, \
+              "%s [-n <lines>] [-h <hosts>] [-s <seed>] <file>" % progname
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import re
+import unittest
+
+import hacksaw.bench.corpus as corpus
+import hacksaw.lib
+
+
+class CorpusGeneratorTest(unittest.TestCase):
+
+    def test_line_count(self):
+        """Check we generate the number of lines asked for"""
+        lines = list(corpus.CorpusGenerator().generate(1000))
+        self.assertEqual(len(lines), 1000)
+
+    def test_repeatable(self):
+        """Check the same seed always generates the same corpus"""
+        first = list(corpus.CorpusGenerator(seed=1).generate(100))
+        second = list(corpus.CorpusGenerator(seed=1).generate(100))
+        self.assertEqual(first, second)
+
+    def test_format(self):
+        """Check lines can be parsed as syslog messages"""
+        generator = corpus.CorpusGenerator(hosts=5)
+        for line in generator.generate(1000):
+            self.assert_(line.endswith("\n"))
+            message = hacksaw.lib.LogMessage(line)
+            self.assert_(message.hostname in generator.hostnames)
+            self.assertEqual(len(message.date), len("Jun  1 00:00:00"))
+
+    def test_pids(self):
+        """Check some programs log their pid and some don't"""
+        processes = [hacksaw.lib.LogMessage(line).process for line in
+                     corpus.CorpusGenerator().generate(1000)]
+        with_pid = [process for process in processes if "[" in process]
+        self.assert_(0 < len(with_pid) < len(processes))
+
+    def test_groups(self):
+        """Check multi-line groups start and end with the ignore rules"""
+        generator = corpus.CorpusGenerator(group_probability=1)
+        lines = list(generator.generate(100))
+        rules = dict(corpus.IGNORE_RULES)
+        self.assert_(re.search(rules["match1"], lines[0]))
+        ends = [line for line in lines if re.search(rules["end1"], line)]
+        self.assert_(ends)
+
+
+if __name__ == '__main__':
+    unittest.main()
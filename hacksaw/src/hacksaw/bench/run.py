@@ -0,0 +1,279 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import getopt
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import netsyslog
+
+import hacksaw.bench.corpus
+import hacksaw.bench.udpsink
+import hacksaw.lib
+import processlogs
+
+
+CONFIG = """\
+[general]
+spool: %(workdir)s/spool
+processors: hacksaw.proc.logfile, hacksaw.proc.mail, hacksaw.proc.remotesyslog
+batchsize: %(batch_size)d
+
+[hacksaw.proc.logfile]
+logfile: %(workdir)s/output/logfile
+
+[hacksaw.proc.mail]
+messagestore: %(workdir)s/output/messagestore
+
+[hacksaw.proc.remotesyslog]
+hosts: %(address)s
+facility: local0
+priority: info
+
+[hacksaw.proc.remotesyslog.ignore]
+%(ignore_rules)s
+"""
+
+
+class Environment(object):
+
+    # Everything a benchmark needs: a config file, a corpus, an output
+    # directory that is emptied before each run and a UDP sink that the
+    # remotesyslog processor forwards to.
+
+    def __init__(self, lines, batch_size, seed):
+        self.lines = lines
+        self.workdir = tempfile.mkdtemp(prefix="hacksaw-bench-")
+        self.sink = hacksaw.bench.udpsink.UDPSink()
+        self.sink.start()
+        self.real_port = netsyslog.Logger.PORT
+        netsyslog.Logger.PORT = self.sink.port
+        rules = ["%s: %s" % rule for rule in
+                 hacksaw.bench.corpus.IGNORE_RULES]
+        self.config_file = os.path.join(self.workdir, "hacksaw.conf")
+        file(self.config_file, "w").write(CONFIG % {
+            "workdir": self.workdir,
+            "batch_size": batch_size,
+            "address": self.sink.address,
+            "ignore_rules": "\n".join(rules)})
+        self.config = hacksaw.lib.GeneralConfig(self.config_file).compile()
+        self.corpus = os.path.join(self.workdir, "corpus")
+        generator = hacksaw.bench.corpus.CorpusGenerator(seed)
+        generator.write(self.corpus, lines)
+
+    def reset(self):
+        for name in ("spool", "output"):
+            path = os.path.join(self.workdir, name)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+        self.sink.reset()
+
+    def cleanup(self):
+        netsyslog.Logger.PORT = self.real_port
+        self.sink.stop()
+        shutil.rmtree(self.workdir)
+
+
+class Benchmark(object):
+
+    name = None  # Must be set by the subclass.
+
+    def __init__(self, env):
+        self.env = env
+
+    def setup(self):
+        self.env.reset()
+
+    def run(self):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class ProcessLogFilesBenchmark(Benchmark):
+
+    name = "processlogs"
+
+    def setup(self):
+        super(ProcessLogFilesBenchmark, self).setup()
+        shutil.copy(self.env.corpus,
+                    os.path.join(self.env.config.spool_directory, "corpus"))
+
+    def run(self):
+        processlogs.process_log_files(self.env.config)
+
+
+class ProcessorBenchmark(Benchmark):
+
+    module_name = None  # Must be set by the subclass.
+
+    def __init__(self, env):
+        super(ProcessorBenchmark, self).__init__(env)
+        __import__(self.module_name)
+        self.module = sys.modules[self.module_name]
+        lines = file(env.corpus).readlines()
+        size = env.config.batch_size
+        self.batches = [lines[i:i + size]
+                        for i in range(0, len(lines), size)]
+
+    def setup(self):
+        super(ProcessorBenchmark, self).setup()
+        config = self.module.Config(self.env.config_file).compile()
+        self.processor = self.module.Processor(config)
+
+    def run(self):
+        for batch in self.batches:
+            self.processor.handle_messages(batch)
+        # Closing flushes whatever the processor has held back (the
+        # mail sender, unsent TCP packets), so it's timed too.
+        processor = self.processor
+        self.processor = None
+        processor.close()
+
+    def teardown(self):
+        if self.processor is not None:
+            self.processor.close()
+
+
+class LogfileBenchmark(ProcessorBenchmark):
+
+    name = "proc.logfile"
+    module_name = "hacksaw.proc.logfile"
+
+
+class MailBenchmark(ProcessorBenchmark):
+
+    name = "proc.mail"
+    module_name = "hacksaw.proc.mail"
+
+
+class RemoteSyslogBenchmark(ProcessorBenchmark):
+
+    name = "proc.remotesyslog"
+    module_name = "hacksaw.proc.remotesyslog"
+
+
+BENCHMARKS = [ProcessLogFilesBenchmark, LogfileBenchmark, MailBenchmark,
+              RemoteSyslogBenchmark]
+
+
+def run_benchmark(benchmark, repeats):
+    timings = []
+    for i in range(repeats):
+        benchmark.setup()
+        try:
+            start = time.time()
+            benchmark.run()
+            timings.append(time.time() - start)
+        finally:
+            benchmark.teardown()
+    best = min(timings)
+    return {"seconds": timings,
+            "best": best,
+            "lines_per_second": benchmark.env.lines / best}
+
+
+def run_benchmarks(names, lines, repeats, batch_size, seed):
+    env = Environment(lines, batch_size, seed)
+    results = {}
+    try:
+        for cls in BENCHMARKS:
+            if names and cls.name not in names:
+                continue
+            results[cls.name] = run_benchmark(cls(env), repeats)
+    finally:
+        env.cleanup()
+    return {"python": sys.version.split()[0],
+            "lines": lines,
+            "repeats": repeats,
+            "batch_size": batch_size,
+            "seed": seed,
+            "benchmarks": results}
+
+
+def find_regressions(results, baseline, tolerance):
+    """Return the benchmarks that are slower than the baseline allows"""
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        try:
+            expected = baseline["benchmarks"][name]["lines_per_second"]
+        except KeyError:
+            continue
+        if result["lines_per_second"] < expected * (1 - tolerance):
+            regressions.append((name, expected, result["lines_per_second"]))
+    regressions.sort()
+    return regressions
+
+
+class Usage(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def main(argv=None):
+    names = []
+    lines = 100000
+    repeats = 3
+    batch_size = hacksaw.lib.GeneralConfig.DEFAULT_BATCH_SIZE
+    seed = 0
+    output = None
+    baseline = None
+    tolerance = 0.1
+    if argv is None:
+        argv = sys.argv[1:]
+    try:
+        try:
+            opts, args = getopt.getopt(argv, "b:n:r:s:o:c:t:B:")
+            for opt, arg in opts:
+                if opt == "-b":
+                    names.append(arg)
+                elif opt == "-n":
+                    lines = int(arg)
+                elif opt == "-r":
+                    repeats = int(arg)
+                elif opt == "-B":
+                    batch_size = int(arg)
+                elif opt == "-s":
+                    seed = int(arg)
+                elif opt == "-o":
+                    output = arg
+                elif opt == "-c":
+                    baseline = json.load(file(arg))
+                elif opt == "-t":
+                    tolerance = float(arg)
+        except (getopt.error, ValueError), msg:
+            raise Usage(msg)
+        results = run_benchmarks(names, lines, repeats, batch_size, seed)
+        if output is None:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write("\n")
+        else:
+            json.dump(results, file(output, "w"), indent=2, sort_keys=True)
+        if baseline is not None:
+            regressions = find_regressions(results, baseline, tolerance)
+            for name, expected, actual in regressions:
+                print >>sys.stderr, "%s: %.0f lines/s (baseline %.0f)" % \
+                      (name, actual, expected)
+            if regressions:
+                return 1
+    except Usage, e:
+        print >>sys.stderr, e.msg
+        progname = os.path.basename(sys.argv[0])
+        print >>sys.stderr, ("%s [-b <benchmark>] [-n <lines>] [-r <repeats>] "
+                             "[-B <batch size>] [-s <seed>] [-o <file>] "
+                             "[-c <baseline file> [-t <tolerance>]]" %
+                             progname)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
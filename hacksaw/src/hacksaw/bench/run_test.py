@@ -0,0 +1,90 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import unittest
+
+import hacksaw.bench.run
+
+
+class FakeProcessor(object):
+
+    def __init__(self):
+        self.messages = []
+        self.closes = 0
+
+    def handle_messages(self, messages):
+        self.messages.extend(messages)
+
+    def close(self):
+        self.closes += 1
+
+
+class FakeBenchmark(hacksaw.bench.run.ProcessorBenchmark):
+
+    def __init__(self):
+        self.batches = [["one\n", "two\n"], ["three\n"]]
+
+    def setup(self):
+        self.processor = FakeProcessor()
+
+
+class ProcessorBenchmarkTest(unittest.TestCase):
+
+    def test_close_is_timed(self):
+        """Check the processor is closed inside the timed run"""
+        benchmark = FakeBenchmark()
+        benchmark.setup()
+        processor = benchmark.processor
+        benchmark.run()
+        self.assertEqual(processor.messages, ["one\n", "two\n", "three\n"])
+        self.assertEqual(processor.closes, 1)
+        benchmark.teardown()
+        self.assertEqual(processor.closes, 1)
+
+    def test_close_after_failure(self):
+        """Check teardown closes the processor if the run fails"""
+        benchmark = FakeBenchmark()
+        benchmark.setup()
+        processor = benchmark.processor
+        def fail(messages):
+            raise ValueError
+        processor.handle_messages = fail
+        self.assertRaises(ValueError, benchmark.run)
+        benchmark.teardown()
+        self.assertEqual(processor.closes, 1)
+
+
+class FindRegressionsTest(unittest.TestCase):
+
+    def make_results(self, **rates):
+        benchmarks = {}
+        for name, rate in rates.items():
+            benchmarks[name] = {"lines_per_second": rate}
+        return {"benchmarks": benchmarks}
+
+    def test_no_regression(self):
+        """Check small slowdowns are within tolerance"""
+        baseline = self.make_results(logfile=1000)
+        results = self.make_results(logfile=950)
+        self.assertEqual(
+            hacksaw.bench.run.find_regressions(results, baseline, 0.1), [])
+
+    def test_regression(self):
+        """Check large slowdowns are reported"""
+        baseline = self.make_results(logfile=1000, mail=1000)
+        results = self.make_results(logfile=800, mail=1200)
+        self.assertEqual(
+            hacksaw.bench.run.find_regressions(results, baseline, 0.1),
+            [("logfile", 1000, 800)])
+
+    def test_new_benchmark(self):
+        """Check benchmarks missing from the baseline are ignored"""
+        baseline = self.make_results()
+        results = self.make_results(logfile=800)
+        self.assertEqual(
+            hacksaw.bench.run.find_regressions(results, baseline, 0.1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
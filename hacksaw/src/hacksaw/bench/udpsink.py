@@ -0,0 +1,62 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import socket
+import threading
+
+
+class UDPSink(object):
+
+    # Stands in for a remote syslog server, counting the packets that
+    # are sent to it. It listens on an unprivileged port chosen by the
+    # kernel; see the port attribute.
+
+    BUFFER_SIZE = 65536
+    RECEIVE_BUFFER = 8 * 1024 * 1024
+
+    def __init__(self, address="127.0.0.1"):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                  self.RECEIVE_BUFFER)
+        except socket.error:
+            pass
+        self._sock.bind((address, 0))
+        self._sock.settimeout(0.1)
+        self.address, self.port = self._sock.getsockname()
+        self.packets = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.setDaemon(True)
+
+    def _receive(self):
+        while not self._stopping.isSet():
+            try:
+                data = self._sock.recv(self.BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            self._lock.acquire()
+            try:
+                self.packets += 1
+                self.bytes += len(data)
+            finally:
+                self._lock.release()
+
+    def start(self):
+        self._thread.start()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.packets = 0
+            self.bytes = 0
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+        self._sock.close()
@@ -0,0 +1,39 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import socket
+import time
+import unittest
+
+import hacksaw.bench.udpsink
+
+
+class UDPSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = hacksaw.bench.udpsink.UDPSink()
+        self.sink.start()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def wait_for_packets(self, count):
+        deadline = time.time() + 5
+        while self.sink.packets < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_count_packets(self):
+        """Check the sink counts the packets sent to it"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(3):
+            sock.sendto("hello", (self.sink.address, self.sink.port))
+        self.wait_for_packets(3)
+        self.assertEqual(self.sink.packets, 3)
+        self.assertEqual(self.sink.bytes, 15)
+        self.sink.reset()
+        self.assertEqual(self.sink.packets, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,412 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import cStringIO
+import fnmatch
+import getopt
+import glob
+import gzip
+import itertools
+import mmap
+import multiprocessing
+import os
+import re
+import signal
+import sys
+import time
+
+import hacksaw.index
+import hacksaw.lib
+
+
+# Searches the log files written by hacksaw.proc.logfile. Plain files
+# are split into ranges of whole lines that are searched in parallel
+# by a pool of worker processes, each reading its range through a
+# memory map. Compressed segments can't be split, so each is searched
+# by a single worker. Results are written out in the order in which
+# the ranges appear in the files, so the output is in the same order
+# as grep's would be.
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+TIME_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+
+class Query(object):
+
+    # The tests that a line must pass. Host and program names may be
+    # shell-style wildcards; times are seconds since the epoch, and
+    # end_time is exclusive.
+
+    def __init__(self, pattern=None, hostname=None, program=None,
+                 start_time=None, end_time=None, ignore_case=False,
+                 invert=False):
+        self.pattern = pattern
+        self.hostname = hostname
+        self.program = program
+        self.start_time = start_time
+        self.end_time = end_time
+        self.ignore_case = ignore_case
+        self.invert = invert
+        self._compile()
+
+    def _compile(self):
+        self._regex = None
+        self._window_regex = None
+        if self.pattern is not None:
+            flags = 0
+            if self.ignore_case:
+                flags = re.IGNORECASE
+            self._regex = re.compile(self.pattern, flags)
+            # Every line is checked against the real pattern, so we
+            # can drop a leading ^, which stops the regular expression
+            # engine from skipping ahead to the pattern's first letters.
+            pattern = self.pattern
+            if pattern.startswith("^"):
+                pattern = pattern[1:]
+            self._window_regex = re.compile(pattern, flags | re.MULTILINE)
+        elif not self.invert:
+            # Look for the longest piece of the host or program name that
+            # isn't a wildcard, leaving _match_fields() to check the lines
+            # that it turns up properly. invert only applies to a
+            # pattern, so this can't be used with it.
+            pieces = []
+            for wildcard, end in ((self.hostname, " "), (self.program, "")):
+                if wildcard is not None:
+                    pieces.extend(self._get_literals(" " + wildcard + end))
+            pieces.sort(key=len)
+            if pieces and pieces[-1].strip():
+                self._window_regex = re.compile(re.escape(pieces[-1]))
+        self._hostname = self._compile_wildcard(self.hostname)
+        self._program = self._compile_wildcard(self.program)
+        self._dates = hacksaw.index.DateParser()
+
+    def _get_literals(self, wildcard):
+        return re.split(r"[*?]|\[[^]]*\]", wildcard)
+
+    def _compile_wildcard(self, wildcard):
+        if wildcard is None:
+            return None
+        return re.compile(fnmatch.translate(wildcard))
+
+    def __getstate__(self):
+        # Only the options are sent to the worker processes, which
+        # compile them for themselves.
+        state = self.__dict__.copy()
+        for name in ("_regex", "_window_regex", "_hostname", "_program",
+                     "_dates"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+    def _get_has_times(self):
+        return self.start_time is not None or self.end_time is not None
+
+    has_times = property(_get_has_times)
+
+    def _match_fields(self, line):
+        if self._hostname is not None or self._program is not None:
+            match = hacksaw.lib.LogMessage.pattern.match(line)
+            if match is None:
+                return False
+            hostname, process = match.group(2, 3)
+            if self._hostname is not None and \
+                   not self._hostname.match(hostname):
+                return False
+            if self._program is not None and \
+                   not self._program.match(process.split("[", 1)[0]):
+                return False
+        if self.has_times:
+            seconds = self._dates.parse(line[:15])
+            if seconds is None:
+                return False
+            if self.start_time is not None and seconds < self.start_time:
+                return False
+            if self.end_time is not None and seconds >= self.end_time:
+                return False
+        return True
+
+    def matches(self, line):
+        if not self._match_fields(line):
+            return False
+        if self._regex is None:
+            return True
+        return bool(self._regex.search(line)) != self.invert
+
+    def _find_candidates(self, data):
+        # Searching a whole window at once is far quicker than
+        # searching it a line at a time. Returns the (start, end) of
+        # each line that a match starts in. Each line is checked on its
+        # own, so that a match that runs on into the next line doesn't
+        # count.
+        spans = []
+        search = self._window_regex.search
+        position = 0
+        while True:
+            match = search(data, position)
+            if match is None:
+                break
+            start = data.rfind("\n", 0, match.start()) + 1
+            end = data.find("\n", match.start()) + 1 or len(data)
+            if self._regex is None or self._regex.search(data[start:end]):
+                spans.append((start, end))
+            position = max(end, match.start() + 1)
+        return spans
+
+    def _get_others(self, data, spans):
+        # Return the lines of data that aren't in spans.
+        parts = []
+        position = 0
+        for start, end in spans:
+            parts.append(data[position:start])
+            position = end
+        parts.append(data[position:])
+        return cStringIO.StringIO("".join(parts)).readlines()
+
+    def search(self, data):
+        """Return the lines in data (which holds whole lines) that match"""
+        if self._window_regex is not None:
+            spans = self._find_candidates(data)
+            if self.invert and self._regex is not None:
+                lines = self._get_others(data, spans)
+            else:
+                lines = [data[start:end] for start, end in spans]
+        else:
+            lines = cStringIO.StringIO(data).readlines()
+        if self._hostname is None and self._program is None and \
+               not self.has_times:
+            return lines
+        return [line for line in lines if self._match_fields(line)]
+
+
+def is_compressed(path):
+    return path.endswith(".gz")
+
+
+# Segments are named logfile.YYYYMMDD-HHMMSS, with .N added if there's
+# already one from the same second (see LogFile._get_segment_name()),
+# and .gz if they've been compressed.
+SEGMENT_PATTERN = re.compile(r"\.(\d{8}-\d{6})(?:\.(\d+))?(?:\.gz)?$")
+
+
+def get_segments(log_path):
+    """Return a log file's rotated segments and the log file, oldest first"""
+    segments = []
+    for path in glob.glob(log_path + ".2*"):
+        match = SEGMENT_PATTERN.match(path[len(log_path):])
+        if match is not None:
+            stamp, count = match.groups()
+            segments.append((stamp, int(count or 0), path))
+    segments.sort()
+    segments = [path for stamp, count, path in segments]
+    if os.path.exists(log_path):
+        segments.append(log_path)
+    return segments
+
+
+def _align(map_obj, offset, size):
+    # Move offset on to the start of the next line.
+    if offset <= 0 or offset >= size:
+        return min(max(offset, 0), size)
+    newline = map_obj.find("\n", offset - 1)
+    if newline == -1:
+        return size
+    return newline + 1
+
+
+def split_range(map_obj, start, end, chunk_size):
+    """Split start to end into line-aligned ranges of about chunk_size"""
+    ranges = []
+    size = len(map_obj)
+    while start < end:
+        stop = _align(map_obj, min(start + chunk_size, end), size)
+        stop = min(max(stop, start + 1), end)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def find_regions(path, size, query):
+    """Return the regions of a plain log file that may hold matches"""
+    if query.hostname is None and not query.has_times:
+        return [(0, size)]
+    hostname = query.hostname
+    if hostname is not None and re.search(r"[*?[]", hostname):
+        hostname = None  # the index only knows exact names
+    return hacksaw.index.find_regions(path, size, hostname=hostname,
+                                      start_time=query.start_time,
+                                      end_time=query.end_time)
+
+
+def make_tasks(paths, query, chunk_size=CHUNK_SIZE):
+    """Return the (path, range, query) tasks to search paths with"""
+    tasks = []
+    for path in paths:
+        if is_compressed(path):
+            tasks.append((path, None, query))
+            continue
+        size = os.path.getsize(path)
+        if size == 0:
+            continue
+        file_obj = file(path, "rb")
+        try:
+            map_obj = mmap.mmap(file_obj.fileno(), size,
+                                access=mmap.ACCESS_READ)
+            try:
+                for start, end in find_regions(path, size, query):
+                    for span in split_range(map_obj, start, end, chunk_size):
+                        tasks.append((path, span, query))
+            finally:
+                map_obj.close()
+        finally:
+            file_obj.close()
+    return tasks
+
+
+def _read_range(path, start, end):
+    file_obj = file(path, "rb")
+    try:
+        map_obj = mmap.mmap(file_obj.fileno(), end, access=mmap.ACCESS_READ)
+        try:
+            return map_obj[start:end]
+        finally:
+            map_obj.close()
+    finally:
+        file_obj.close()
+
+
+def _read_compressed(path, chunk_size):
+    # Yield the decompressed contents of path, a chunk of whole lines
+    # at a time.
+    file_obj = gzip.open(path, "rb")
+    try:
+        remainder = ""
+        while True:
+            data = file_obj.read(chunk_size)
+            if not data:
+                break
+            data = remainder + data
+            end = data.rfind("\n") + 1
+            remainder = data[end:]
+            if end:
+                yield data[:end]
+        if remainder:
+            yield remainder
+    finally:
+        file_obj.close()
+
+
+def search(task):
+    """Return the lines in a task's file and range that match its query"""
+    path, span, query = task
+    if span is None:
+        lines = []
+        for data in _read_compressed(path, CHUNK_SIZE):
+            lines.extend(query.search(data))
+        return path, lines
+    return path, query.search(_read_range(path, span[0], span[1]))
+
+
+def run(paths, query, jobs=None, output=None, chunk_size=CHUNK_SIZE):
+    """Search paths, writing the matching lines to output in order"""
+    if output is None:
+        output = sys.stdout
+    tasks = make_tasks(paths, query, chunk_size)
+    pool = None
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        results = pool.imap(search, tasks)
+    else:
+        results = itertools.imap(search, tasks)
+    show_paths = len(paths) > 1
+    count = 0
+    try:
+        for path, lines in results:
+            count += len(lines)
+            if show_paths:
+                lines = ["%s:%s" % (path, line) for line in lines]
+            output.writelines(lines)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return count
+
+
+def parse_time(value):
+    for format in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(value, format))
+        except ValueError:
+            pass
+    raise ValueError("unrecognised time: %s" % value)
+
+
+class Usage(Exception):
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def main(argv=None):
+    options = {}
+    jobs = None
+    all_segments = False
+    if argv is None:
+        argv = sys.argv[1:]
+    # Like grep, die quietly if whatever we're writing to goes away.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    try:
+        try:
+            opts, args = getopt.getopt(argv, "e:ivH:p:s:t:j:a")
+            for opt, arg in opts:
+                if opt == "-e":
+                    options["pattern"] = arg
+                elif opt == "-i":
+                    options["ignore_case"] = True
+                elif opt == "-v":
+                    options["invert"] = True
+                elif opt == "-H":
+                    options["hostname"] = arg
+                elif opt == "-p":
+                    options["program"] = arg
+                elif opt == "-s":
+                    options["start_time"] = parse_time(arg)
+                elif opt == "-t":
+                    options["end_time"] = parse_time(arg)
+                elif opt == "-j":
+                    jobs = int(arg)
+                elif opt == "-a":
+                    all_segments = True
+        except (getopt.error, ValueError), msg:
+            raise Usage(msg)
+        if not args:
+            raise Usage("no log files specified")
+        paths = []
+        for path in args:
+            if all_segments:
+                paths.extend(get_segments(path))
+            else:
+                paths.append(path)
+        count = run(paths, Query(**options), jobs)
+    except Usage, e:
+        print >>sys.stderr, e.msg
+        progname = os.path.basename(sys.argv[0])
+        print >>sys.stderr, ("%s [-e <regex>] [-i] [-v] [-H <host>] "
+                             "[-p <program>] [-s <start time>] "
+                             "[-t <end time>] [-j <jobs>] [-a] <file>..." %
+                             progname)
+        return 2
+    if count == 0:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import cStringIO
+import gzip
+import mmap
+import os
+import shutil
+import unittest
+
+import hacksaw.grep
+import hacksaw.index
+
+
+LINES = ["Jun  1 02:00:00 host1 sshd[123]: Accepted publickey for bob\n",
+         "Jun  1 02:05:00 host2 CRON[456]: (root) CMD (backup)\n",
+         "Jun  1 02:10:00 host10 sshd[789]: Failed password for alice\n",
+         "Not a syslog message\n",
+         "Jun  1 02:20:00 host1 kernel: eth0: link up\n"]
+
+
+class QueryTest(unittest.TestCase):
+
+    def search(self, **options):
+        query = hacksaw.grep.Query(**options)
+        return query.search("".join(LINES))
+
+    def test_pattern(self):
+        """Check we find the lines that match a pattern"""
+        self.assertEqual(self.search(pattern="sshd"), [LINES[0], LINES[2]])
+        self.assertEqual(self.search(pattern="^Not"), [LINES[3]])
+        self.assertEqual(self.search(pattern="up$"), [LINES[4]])
+
+    def test_ignore_case(self):
+        """Check we can ignore case"""
+        self.assertEqual(self.search(pattern="cron"), [])
+        self.assertEqual(self.search(pattern="cron", ignore_case=True),
+                         [LINES[1]])
+
+    def test_invert(self):
+        """Check we can find the lines that don't match"""
+        self.assertEqual(self.search(pattern="host1 ", invert=True),
+                         LINES[1:4])
+
+    def test_invert_without_pattern(self):
+        """Check -v doesn't change what a host search finds"""
+        lines = self.search(hostname="host1", invert=True)
+        self.assertEqual(lines, [LINES[0], LINES[4]])
+        query = hacksaw.grep.Query(hostname="host1", invert=True)
+        self.assertEqual(lines, [line for line in LINES
+                                 if query.matches(line)])
+
+    def test_match_spans_lines(self):
+        """Check a match that runs into the next line doesn't count"""
+        self.assertEqual(self.search(pattern=r"bob\sJun"), [])
+
+    def test_hostname(self):
+        """Check we can find the lines from a host"""
+        self.assertEqual(self.search(hostname="host1"), [LINES[0], LINES[4]])
+        self.assertEqual(self.search(hostname="host1*"),
+                         [LINES[0], LINES[2], LINES[4]])
+
+    def test_program(self):
+        """Check we can find the lines from a program"""
+        self.assertEqual(self.search(program="sshd"), [LINES[0], LINES[2]])
+        self.assertEqual(self.search(program="k*", hostname="host1"),
+                         [LINES[4]])
+
+    def test_times(self):
+        """Check we can find the lines in a time range"""
+        parser = hacksaw.index.DateParser()
+        start = parser.parse("Jun  1 02:05:00")
+        lines = self.search(start_time=start, end_time=start + 600)
+        self.assertEqual(lines, [LINES[1], LINES[2]])
+
+    def test_fields_and_pattern(self):
+        """Check we can combine a pattern with a field"""
+        self.assertEqual(self.search(pattern="password", program="sshd"),
+                         [LINES[2]])
+        self.assertEqual(self.search(pattern="password", hostname="host1"),
+                         [])
+
+
+class GrepTest(unittest.TestCase):
+
+    LOG_DIR = "./test-grep"
+
+    def setUp(self):
+        if os.path.exists(self.LOG_DIR):
+            shutil.rmtree(self.LOG_DIR)
+        os.mkdir(self.LOG_DIR)
+        self.log_path = os.path.join(self.LOG_DIR, "logfile")
+        self.lines = ["Jun  1 02:%02d:%02d host%d sshd[1]: Message %d\n" %
+                      (i / 60, i % 60, i % 3, i) for i in range(600)]
+        file(self.log_path, "w").write("".join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.LOG_DIR)
+
+    def grep(self, paths, jobs=1, chunk_size=1000, **options):
+        output = cStringIO.StringIO()
+        count = hacksaw.grep.run(paths, hacksaw.grep.Query(**options), jobs,
+                                 output, chunk_size)
+        lines = output.getvalue().splitlines(True)
+        self.assertEqual(count, len(lines))
+        return lines
+
+    def test_split_range(self):
+        """Check ranges are split on line boundaries"""
+        file_obj = file(self.log_path)
+        size = os.path.getsize(self.log_path)
+        map_obj = mmap.mmap(file_obj.fileno(), size, access=mmap.ACCESS_READ)
+        ranges = hacksaw.grep.split_range(map_obj, 0, size, 1000)
+        self.assert_(len(ranges) > 1)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], size)
+        for start, end in ranges:
+            self.assertEqual(map_obj[end - 1], "\n")
+        map_obj.close()
+
+    def test_keep_order(self):
+        """Check the output is in the same order as the log file"""
+        lines = self.grep([self.log_path], jobs=3, pattern="Message")
+        self.assertEqual(lines, self.lines)
+
+    def test_compressed(self):
+        """Check we can search compressed segments"""
+        segment = self.log_path + ".20050601-030000.gz"
+        gzip_file = gzip.open(segment, "wb")
+        gzip_file.write("".join(self.lines))
+        gzip_file.close()
+        lines = self.grep([segment, self.log_path], jobs=2,
+                          hostname="host1")
+        expected = [line for line in self.lines if " host1 " in line]
+        self.assertEqual(len(lines), len(expected) * 2)
+        self.assertEqual(lines[0], "%s:%s" % (segment, expected[0]))
+        self.assertEqual(lines[-1], "%s:%s" % (self.log_path, expected[-1]))
+
+    def test_get_segments(self):
+        """Check we find a log file's segments, oldest first"""
+        names = ["logfile.20050602-000000.gz", "logfile.20050601-000000",
+                 "logfile.20050601-000000.idx", "logfile.started"]
+        for name in names:
+            file(os.path.join(self.LOG_DIR, name), "w").close()
+        segments = [os.path.basename(path) for path in
+                    hacksaw.grep.get_segments(self.log_path)]
+        self.assertEqual(segments, ["logfile.20050601-000000",
+                                    "logfile.20050602-000000.gz", "logfile"])
+
+    def test_segments_from_same_second(self):
+        """Check segments rotated within a second are kept in order"""
+        names = ["logfile.20050601-000000.gz", "logfile.20050601-000000.1.gz",
+                 "logfile.20050601-000000.2", "logfile.20050601-000000.10.gz",
+                 "logfile.20050601-000001.gz"]
+        for name in names:
+            file(os.path.join(self.LOG_DIR, name), "w").close()
+        segments = [os.path.basename(path) for path in
+                    hacksaw.grep.get_segments(self.log_path)]
+        self.assertEqual(segments, names + ["logfile"])
+
+    def test_use_index(self):
+        """Check we only search the parts of the file the index points to"""
+        os.remove(self.log_path)
+        writer = hacksaw.index.IndexWriter(self.log_path, 60)
+        for i in range(0, len(self.lines), 10):
+            offset = 0
+            if os.path.exists(self.log_path):
+                offset = os.path.getsize(self.log_path)
+            file(self.log_path, "a").write("".join(self.lines[i:i + 10]))
+            writer.write(offset, self.lines[i:i + 10])
+        writer.close()
+        query = hacksaw.grep.Query(hostname="host2")
+        size = os.path.getsize(self.log_path)
+        regions = hacksaw.grep.find_regions(self.log_path, size, query)
+        self.assert_(sum([end - start for start, end in regions]) < size)
+        start = hacksaw.index.DateParser().parse("Jun  1 02:05:00")
+        lines = self.grep([self.log_path], hostname="host2",
+                          start_time=start, end_time=start + 60)
+        self.assertEqual(lines, [line for line in self.lines[300:360]
+                                 if " host2 " in line])
+
+    def test_main(self):
+        """Check the exit status says whether anything matched"""
+        devnull = file(os.devnull, "w")
+        real_stdout = hacksaw.grep.sys.stdout
+        hacksaw.grep.sys.stdout = devnull
+        try:
+            self.assertEqual(hacksaw.grep.main(["-e", "Message 1\\b",
+                                                self.log_path]), 0)
+            self.assertEqual(hacksaw.grep.main(["-e", "nothing",
+                                                self.log_path]), 1)
+        finally:
+            hacksaw.grep.sys.stdout = real_stdout
+
+
+if __name__ == "__main__":
+    unittest.main()
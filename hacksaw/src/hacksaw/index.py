@@ -0,0 +1,250 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import os
+import time
+
+
+# A sidecar index for a log file, kept in a file of the same name with
+# ".idx" on the end. It starts with a line giving the length of the
+# time buckets (in seconds):
+#
+#   #interval <seconds>
+#
+# Each time a batch is appended to the log file, a record is appended
+# to the index for each time bucket and host in the batch, giving the
+# span of the log file that holds that host's lines for that bucket:
+#
+#   <start offset> <end offset> <bucket start, seconds since epoch> <host>
+#
+# Lines whose date can't be parsed go in bucket 0. The lines of other
+# hosts can fall inside a span, so a query still has to check each
+# line that it reads.
+#
+# A query only has to read the spans that match, plus any part of the
+# log file that no record covers (written before the index was turned
+# on, or lost in a crash between writing the log and the index).
+
+
+UNKNOWN_HOST = "-"
+HEADER = "#interval"
+
+
+def get_index_path(log_path):
+    return log_path + ".idx"
+
+
+class DateParser(object):
+
+    # Turns syslog dates ("Jun  1 02:13:59") into seconds since the
+    # epoch. They don't include the year, so we assume the most recent
+    # one that doesn't put the date in the future. Results are cached
+    # by the minute, as each minute's lines all share one date prefix.
+
+    MAX_CACHE_SIZE = 10000
+    MAX_CLOCK_SKEW = 24 * 60 * 60
+
+    def __init__(self):
+        self._cache = {}
+
+    def _parse_minute(self, minute):
+        try:
+            parsed = time.strptime(" ".join(minute.split()), "%b %d %H:%M")
+        except ValueError:
+            return None
+        now = time.time()
+        year = time.localtime(now).tm_year
+        values = (year,) + parsed[1:8] + (-1,)
+        seconds = time.mktime(values)
+        if seconds > now + DateParser.MAX_CLOCK_SKEW:
+            seconds = time.mktime((year - 1,) + values[1:])
+        return int(seconds)
+
+    def parse_minute(self, minute):
+        """Return the start of a minute ("Jun  1 02:13") or None"""
+        try:
+            return self._cache[minute]
+        except KeyError:
+            if len(self._cache) >= DateParser.MAX_CACHE_SIZE:
+                self._cache.clear()
+            start = self._cache[minute] = self._parse_minute(minute)
+            return start
+
+    def parse(self, date):
+        """Return the date in seconds since the epoch, or None"""
+        start = self.parse_minute(date[:12])
+        seconds = date[13:15]
+        if start is None or date[12:13] != ":" or not seconds.isdigit():
+            return None
+        return start + int(seconds)
+
+
+class IndexWriter(object):
+
+    # Appends records to the index for a log file. The caller must hold
+    # the log file's lock, so that the offsets we're given are where
+    # the lines really went.
+
+    def __init__(self, log_path, interval):
+        self.path = get_index_path(log_path)
+        self.interval = int(interval)
+        self._dates = DateParser()
+        self._buckets = {}
+        self._file = None
+
+    def _get_bucket(self, minute):
+        # The interval is a whole number of minutes, so every line
+        # logged in a minute is in the same bucket.
+        try:
+            return self._buckets[minute]
+        except KeyError:
+            pass
+        if len(self._buckets) >= DateParser.MAX_CACHE_SIZE:
+            self._buckets.clear()
+        start = self._dates.parse_minute(minute)
+        if start is not None:
+            start -= start % self.interval
+        self._buckets[minute] = start
+        return start
+
+    def get_records(self, offset, lines):
+        """Return the records for lines appended at offset"""
+        # Syslog dates are always 15 characters long, followed by the
+        # hostname, so we can slice them out rather than run a regular
+        # expression over every line.
+        spans = {}
+        keys = []
+        for line in lines:
+            end = offset + len(line)
+            bucket = self._get_bucket(line[:12])
+            space = line.find(" ", 16)
+            if bucket is None or line[15:16] != " " or space == -1:
+                key = (0, UNKNOWN_HOST)
+            else:
+                key = (bucket, line[16:space])
+            span = spans.get(key)
+            if span is None:
+                spans[key] = [offset, end]
+                keys.append(key)
+            else:
+                span[1] = end
+            offset = end
+        return [(spans[key][0], spans[key][1], key[0], key[1])
+                for key in keys]
+
+    def write(self, offset, lines):
+        if self._file is None:
+            self._file = file(self.path, "a")
+        records = ["%d %d %d %s\n" % record
+                   for record in self.get_records(offset, lines)]
+        if os.fstat(self._file.fileno()).st_size == 0:
+            records.insert(0, "%s %d\n" % (HEADER, self.interval))
+        self._file.write("".join(records))
+        self._file.flush()
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def rotate(self, segment):
+        """Move the index aside along with its log file"""
+        self.close()
+        if os.path.exists(self.path):
+            os.rename(self.path, get_index_path(segment))
+
+
+def read_index(log_path):
+    """Return a log file's bucket interval and index records.
+
+    Records are (start, end, bucket, host) tuples. The interval is None
+    if there isn't an index.
+
+    """
+    interval = None
+    records = []
+    try:
+        file_obj = file(get_index_path(log_path))
+    except IOError:
+        return interval, records
+    try:
+        for line in file_obj:
+            words = line.split()
+            if len(words) == 2 and words[0] == HEADER:
+                interval = int(words[1])
+                continue
+            if len(words) != 4:
+                continue  # a record that was only partly written
+            try:
+                start, end, bucket = [int(word) for word in words[:3]]
+            except ValueError:
+                continue
+            records.append((start, end, bucket, words[3]))
+    finally:
+        file_obj.close()
+    return interval, records
+
+
+def _merge(spans):
+    spans.sort()
+    merged = []
+    for start, end in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def find_regions(log_path, size, hostname=None, start_time=None,
+                 end_time=None):
+    """Return the (start, end) offsets that may hold matching lines.
+
+    size is the length of the log file; anything in it that isn't
+    covered by the index is always included, as are lines whose host
+    or date couldn't be parsed.
+
+    """
+    interval, records = read_index(log_path)
+    indexed = _merge([(start, end) for start, end, bucket, host in records
+                      if end <= size])
+    wanted = []
+    for start, end, bucket, host in records:
+        if end > size:
+            continue
+        if hostname is not None and host not in (hostname, UNKNOWN_HOST):
+            continue
+        if bucket:
+            if end_time is not None and bucket > end_time:
+                continue
+            if start_time is not None and interval is not None and \
+                   bucket + interval <= start_time:
+                continue
+        wanted.append((start, end))
+    offset = 0
+    for start, end in indexed:
+        if start > offset:
+            wanted.append((offset, start))
+        offset = end
+    if offset < size:
+        wanted.append((offset, size))
+    return [tuple(span) for span in _merge(wanted)]
+
+
+def read_regions(file_obj, regions):
+    """Yield the lines in each of the (start, end) regions of a file"""
+    for start, end in regions:
+        file_obj.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            line = file_obj.readline()
+            if not line:
+                break
+            remaining -= len(line)
+            yield line
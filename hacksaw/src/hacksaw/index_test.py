@@ -0,0 +1,173 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import os
+import shutil
+import time
+import unittest
+
+import hacksaw.index
+
+
+def make_line(seconds, hostname, text):
+    date = time.strftime("%b %d %H:%M:%S", time.localtime(seconds))
+    return "%s %s sshd[123]: %s\n" % (date, hostname, text)
+
+
+class DateParserTest(unittest.TestCase):
+
+    def test_parse(self):
+        """Check we can turn a syslog date into seconds since the epoch"""
+        now = int(time.time())
+        date = time.strftime("%b %d %H:%M:%S", time.localtime(now))
+        parser = hacksaw.index.DateParser()
+        self.assertEqual(parser.parse(date), now)
+        self.assertEqual(parser.parse(date[:-2] + "00"), now - now % 60)
+
+    def test_single_figure_day(self):
+        """Check we can parse dates with a space padded day"""
+        parser = hacksaw.index.DateParser()
+        seconds = parser.parse("Jan  2 03:04:05")
+        self.assertEqual(time.localtime(seconds)[1:6], (1, 2, 3, 4, 5))
+
+    def test_never_in_the_future(self):
+        """Check dates in the future are taken to be from last year"""
+        tomorrow = time.time() + 2 * 24 * 60 * 60
+        date = time.strftime("%b %d %H:%M:%S", time.localtime(tomorrow))
+        seconds = hacksaw.index.DateParser().parse(date)
+        self.assert_(seconds < time.time())
+
+    def test_bad_date(self):
+        """Check we return None for dates we can't parse"""
+        parser = hacksaw.index.DateParser()
+        self.assertEqual(parser.parse("not a date"), None)
+
+
+class IndexTest(unittest.TestCase):
+
+    LOG_DIR = './test-index'
+
+    def setUp(self):
+        if os.path.exists(self.LOG_DIR):
+            shutil.rmtree(self.LOG_DIR)
+        os.mkdir(self.LOG_DIR)
+        self.log_path = os.path.join(self.LOG_DIR, 'logfile')
+        self.start = int(time.time()) - 3600
+        self.start -= self.start % 300
+
+    def tearDown(self):
+        shutil.rmtree(self.LOG_DIR)
+
+    def append(self, writer, lines):
+        offset = 0
+        if os.path.exists(self.log_path):
+            offset = os.path.getsize(self.log_path)
+        file(self.log_path, "a").write("".join(lines))
+        writer.write(offset, lines)
+
+    def test_records(self):
+        """Check we record the span of each host's lines in each bucket"""
+        lines = [make_line(self.start, "host1", "Message 1"),
+                 make_line(self.start + 1, "host2", "Message 2"),
+                 make_line(self.start + 2, "host1", "Message 3"),
+                 make_line(self.start + 300, "host1", "Message 4"),
+                 "Not a syslog message\n"]
+        writer = hacksaw.index.IndexWriter(self.log_path, 300)
+        offsets = [10]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line))
+        self.assertEqual(writer.get_records(10, lines),
+                         [(offsets[0], offsets[3], self.start, "host1"),
+                          (offsets[1], offsets[2], self.start, "host2"),
+                          (offsets[3], offsets[4], self.start + 300, "host1"),
+                          (offsets[4], offsets[5], 0,
+                           hacksaw.index.UNKNOWN_HOST)])
+
+    def test_read_index(self):
+        """Check we can read back what we've written"""
+        writer = hacksaw.index.IndexWriter(self.log_path, 300)
+        line1 = make_line(self.start, "host1", "Message 1")
+        line2 = make_line(self.start, "host2", "Message 2")
+        self.append(writer, [line1])
+        self.append(writer, [line2])
+        writer.close()
+        interval, records = hacksaw.index.read_index(self.log_path)
+        self.assertEqual(interval, 300)
+        size = len(line1) + len(line2)
+        self.assertEqual(records, [(0, len(line1), self.start, "host1"),
+                                   (len(line1), size, self.start, "host2")])
+
+    def test_partial_record(self):
+        """Check we ignore a record that was only partly written"""
+        writer = hacksaw.index.IndexWriter(self.log_path, 300)
+        self.append(writer, [make_line(self.start, "host1", "Message 1")])
+        writer.close()
+        file(writer.path, "a").write("123 45")
+        interval, records = hacksaw.index.read_index(self.log_path)
+        self.assertEqual(len(records), 1)
+
+    def test_no_index(self):
+        """Check we read the whole file if there is no index"""
+        file(self.log_path, "w").write("Message 1\n")
+        self.assertEqual(hacksaw.index.find_regions(self.log_path, 10),
+                         [(0, 10)])
+
+    def test_find_host(self):
+        """Check we only read the regions that hold a host's lines"""
+        writer = hacksaw.index.IndexWriter(self.log_path, 300)
+        for i in range(3):
+            self.append(writer, [make_line(self.start, "host1", "Message"),
+                                 make_line(self.start, "host2", "Message")])
+        writer.close()
+        size = os.path.getsize(self.log_path)
+        regions = hacksaw.index.find_regions(self.log_path, size,
+                                             hostname="host2")
+        lines = list(hacksaw.index.read_regions(file(self.log_path),
+                                                regions))
+        self.assertEqual(len(lines), 3)
+        for line in lines:
+            self.assert_(" host2 " in line)
+
+    def test_find_time(self):
+        """Check we only read the buckets in the time range"""
+        writer = hacksaw.index.IndexWriter(self.log_path, 300)
+        for i in range(4):
+            self.append(writer, [make_line(self.start + i * 300, "host1",
+                                           "Message %d" % i)])
+        writer.close()
+        size = os.path.getsize(self.log_path)
+        regions = hacksaw.index.find_regions(
+            self.log_path, size, start_time=self.start + 310,
+            end_time=self.start + 600)
+        lines = list(hacksaw.index.read_regions(file(self.log_path),
+                                                regions))
+        self.assertEqual([line.split()[-1] for line in lines], ["1", "2"])
+
+    def test_unindexed_regions(self):
+        """Check we always read the parts of the file that aren't indexed"""
+        file(self.log_path, "w").write("Old message\n")
+        writer = hacksaw.index.IndexWriter(self.log_path, 300)
+        self.append(writer, [make_line(self.start, "host1", "Message")])
+        file(self.log_path, "a").write("Unindexed message\n")
+        writer.close()
+        size = os.path.getsize(self.log_path)
+        regions = hacksaw.index.find_regions(self.log_path, size,
+                                             hostname="host2")
+        lines = list(hacksaw.index.read_regions(file(self.log_path),
+                                                regions))
+        self.assertEqual(lines, ["Old message\n", "Unindexed message\n"])
+
+    def test_rotate(self):
+        """Check the index is moved aside with its log file"""
+        writer = hacksaw.index.IndexWriter(self.log_path, 300)
+        self.append(writer, [make_line(self.start, "host1", "Message")])
+        segment = self.log_path + ".1"
+        os.rename(self.log_path, segment)
+        writer.rotate(segment)
+        self.failIf(os.path.exists(writer.path))
+        self.assertEqual(len(hacksaw.index.read_index(segment)[1]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import os
+
+
+class Journal(object):
+
+    # Records how far through each spool file we've got, so that an
+    # interrupted run can carry on where it left off. Each spool file
+    # has its own entry, containing the file's inode number (so that a
+    # new file that happens to reuse an old name isn't skipped) and
+    # the offset of the first byte that hasn't been processed.
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _get_entry_path(self, log_path):
+        return os.path.join(self.directory, os.path.basename(log_path))
+
+    def get_offset(self, log_path):
+        try:
+            contents = file(self._get_entry_path(log_path)).read()
+            inode, offset = [int(word) for word in contents.split()]
+        except (IOError, ValueError):
+            return 0
+        stat = os.stat(log_path)
+        if inode != stat.st_ino or offset > stat.st_size:
+            return 0
+        return offset
+
+    def commit(self, log_path, offset):
+        entry_path = self._get_entry_path(log_path)
+        tmp_path = entry_path + ".tmp"
+        file_obj = file(tmp_path, "w")
+        try:
+            file_obj.write("%d %d\n" % (os.stat(log_path).st_ino, offset))
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        finally:
+            file_obj.close()
+        os.rename(tmp_path, entry_path)
+
+    def remove(self, log_path):
+        try:
+            os.remove(self._get_entry_path(log_path))
+        except OSError:
+            pass
+
+    def prune(self, log_names):
+        """Remove entries for spool files that no longer exist"""
+        for name in os.listdir(self.directory):
+            if name not in log_names:
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,67 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import os
+import shutil
+import unittest
+
+import hacksaw.journal
+
+
+class JournalTest(unittest.TestCase):
+
+    SPOOL_DIR = './test-spool'
+    JOURNAL_DIR = './test-spool/.journal'
+
+    def setUp(self):
+        if os.path.exists(self.SPOOL_DIR):
+            shutil.rmtree(self.SPOOL_DIR)
+        os.mkdir(self.SPOOL_DIR)
+        self.log_path = os.path.join(self.SPOOL_DIR, 'test.log')
+        file(self.log_path, 'w').write('Message 1\nMessage 2\n')
+        self.journal = hacksaw.journal.Journal(self.JOURNAL_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.SPOOL_DIR)
+
+    def test_new_file(self):
+        """Check we start at the beginning of files we haven't seen"""
+        self.assertEqual(self.journal.get_offset(self.log_path), 0)
+
+    def test_commit(self):
+        """Check we can record how far through a file we've got"""
+        self.journal.commit(self.log_path, 10)
+        journal = hacksaw.journal.Journal(self.JOURNAL_DIR)
+        self.assertEqual(journal.get_offset(self.log_path), 10)
+
+    def test_replaced_file(self):
+        """Check we start again if the file has been replaced"""
+        self.journal.commit(self.log_path, 10)
+        file(self.log_path + '.new', 'w').write('Message 3\nMessage 4\n')
+        os.rename(self.log_path + '.new', self.log_path)
+        self.assertEqual(self.journal.get_offset(self.log_path), 0)
+
+    def test_offset_beyond_end(self):
+        """Check we start again if the file is shorter than the offset"""
+        self.journal.commit(self.log_path, 100)
+        self.assertEqual(self.journal.get_offset(self.log_path), 0)
+
+    def test_remove(self):
+        """Check we can forget about a file"""
+        self.journal.commit(self.log_path, 10)
+        self.journal.remove(self.log_path)
+        self.assertEqual(os.listdir(self.JOURNAL_DIR), [])
+
+    def test_prune(self):
+        """Check we remove entries for files that have gone"""
+        self.journal.commit(self.log_path, 10)
+        other_path = os.path.join(self.SPOOL_DIR, 'other.log')
+        file(other_path, 'w').write('Message 3\n')
+        self.journal.commit(other_path, 10)
+        self.journal.prune(['other.log'])
+        self.assertEqual(os.listdir(self.JOURNAL_DIR), ['other.log'])
+
+
+if __name__ == '__main__':
+    unittest.main()
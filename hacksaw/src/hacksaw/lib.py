@@ -4,6 +4,8 @@
 
 import ConfigParser
 import os
+import re
+import sys
 
 
 class ConfigError(RuntimeError):
@@ -11,8 +13,37 @@ class ConfigError(RuntimeError):
     pass
 
 
+class ConfigSnapshot(object):
+
+    # A read-only copy of the values in a Config object, held in slots
+    # so that processors can read them at attribute speed. Optional
+    # settings that weren't in the config file are left empty, and only
+    # raise ConfigError if somebody tries to use them.
+
+    __slots__ = ('filename', '_section')
+
+    def __init__(self, filename, section, values):
+        object.__setattr__(self, 'filename', filename)
+        object.__setattr__(self, '_section', section)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError, "config snapshot is read only"
+
+    def __getattr__(self, name):
+        # Only called for names that don't have a value.
+        if name in self.__slots__:
+            raise ConfigError, "no value for '%s' in [%s]" % (name,
+                                                              self._section)
+        raise AttributeError, name
+
+
 class Config(object):
 
+    FIELDS = ()  # The properties that compile() copies into a snapshot.
+    REQUIRED_FIELDS = ()  # Those that compile() won't do without.
+
     def __init__(self, filename):
         if not os.path.exists(filename):
             raise IOError, "file not found: '%s'" % filename
@@ -29,11 +60,56 @@ class Config(object):
         except ConfigParser.NoSectionError, e:
             raise ConfigError, e
 
+    def _get_optional_item(self, item, default):
+        try:
+            return self._get_item(item)
+        except ConfigParser.NoOptionError:
+            return default
+
+    @classmethod
+    def _get_snapshot_class(cls):
+        if '_snapshot_class' not in cls.__dict__:
+            cls._snapshot_class = type(cls.__name__ + 'Snapshot',
+                                       (ConfigSnapshot,),
+                                       {'__slots__': tuple(cls.FIELDS)})
+        return cls._snapshot_class
+
+    def compile(self):
+        """Check every value once, returning a read-only ConfigSnapshot"""
+        values = {}
+        for name in self.FIELDS:
+            try:
+                value = getattr(self, name)
+            except ConfigParser.NoOptionError:
+                if name in self.REQUIRED_FIELDS:
+                    raise ConfigError, "no value for '%s' in [%s]" % \
+                          (name, self._get_section())
+                continue
+            except (ConfigParser.Error, ValueError, AttributeError), e:
+                raise ConfigError, "bad value for '%s' in [%s]: %s" % \
+                      (name, self._get_section(), e)
+            if isinstance(value, list):
+                value = tuple(value)
+            values[name] = value
+        return self._get_snapshot_class()(self.filename, self._get_section(),
+                                          values)
+
 
 class GeneralConfig(Config):
 
     SPOOL = 'spool'
     PROCESSORS = 'processors'
+    BATCH_SIZE = 'batchsize'
+    POLL_INTERVAL = 'poll_interval'
+    JOURNAL = 'journal'
+    METRICS = 'metrics'
+
+    FIELDS = ('spool_directory', 'processors', 'batch_size', 'poll_interval',
+              'journal_directory', 'metrics')
+    REQUIRED_FIELDS = ('spool_directory', 'processors')
+
+    DEFAULT_BATCH_SIZE = 1000
+    DEFAULT_POLL_INTERVAL = 5
 
     def _get_section(self):
         return 'general'
@@ -49,11 +125,104 @@ class GeneralConfig(Config):
 
     processors = property(_get_processors)
 
+    def _get_batch_size(self):
+        value = self._get_optional_item(GeneralConfig.BATCH_SIZE,
+                                        GeneralConfig.DEFAULT_BATCH_SIZE)
+        return int(value)
+
+    batch_size = property(_get_batch_size)
+
+    def _get_poll_interval(self):
+        value = self._get_optional_item(GeneralConfig.POLL_INTERVAL,
+                                        GeneralConfig.DEFAULT_POLL_INTERVAL)
+        return float(value)
+
+    poll_interval = property(_get_poll_interval)
+
+    def _get_journal_directory(self):
+        default = os.path.join(self.spool_directory, '.journal')
+        return self._get_optional_item(GeneralConfig.JOURNAL, default)
+
+    journal_directory = property(_get_journal_directory)
+
+    def _get_metrics(self):
+        value = self._get_optional_item(GeneralConfig.METRICS, 'no')
+        return value.lower() in ('1', 'yes', 'true', 'on')
+
+    metrics = property(_get_metrics)
+
 
 class Processor(object):
 
     def __init__(self, config):
         self.config = config
+        self.lines_dropped = 0
 
     def handle_message(self, message):
         raise NotImplementedError
+
+    def handle_messages(self, messages):
+        """Handle a batch of messages, in the order they were logged.
+
+        Processors that can handle a batch in one go (e.g. with a
+        single write) should override this method. A message that can't
+        be handled mustn't stop the rest of the batch: handle all the
+        others, then raise the first error so that it's reported.
+
+        """
+        error = None
+        for message in messages:
+            try:
+                self.handle_message(message)
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        pass
+
+
+class LogMessage(object):
+
+    # This class was blatantly stolen from the Band Saw source.
+    # See http://bandsaw.sourceforge.net/.
+
+    regex = r"([^\s]+\s+[^\s]+\s+[^\s]+)\s+([^\s]+)\s+([^\s]+):\s(.*)"
+    pattern = re.compile(regex)
+    
+    def __init__(self, line):
+        self.match = LogMessage.pattern.match(line)
+
+    def _get_message_part(self, index):
+        try:
+            return self.match.groups()[index]
+        except AttributeError:
+            return ""
+
+    def _get_date(self):
+        return self._get_message_part(0)
+
+    date = property(_get_date)
+    
+    def _get_hostname(self):
+        return self._get_message_part(1)
+
+    hostname = property(_get_hostname)
+
+    def _get_process(self):
+        return self._get_message_part(2)
+
+    process = property(_get_process)
+
+    def _get_program(self):
+        # The process without its pid (e.g. "sshd" for "sshd[123]").
+        return self.process.split("[", 1)[0]
+
+    program = property(_get_program)
+
+    def _get_text(self):
+        return self._get_message_part(3)
+
+    text = property(_get_text)
@@ -51,6 +51,167 @@ class GeneralConfigTest(ConfigTest):
         self.read_config()
         self.assertEqual(self.config.processors, ['hacksaw.proc.email',
                                                   'hacksaw.proc.syslog'])
-    
+
+    def test_default_batch_size(self):
+        """Check the batch size has a sensible default"""
+        self.append_to_file('[general]')
+        self.read_config()
+        self.assertEqual(self.config.batch_size,
+                         hacksaw.lib.GeneralConfig.DEFAULT_BATCH_SIZE)
+
+    def test_get_batch_size(self):
+        """Check we can read the batch size from the config file"""
+        self.append_to_file('[general]')
+        self.append_to_file('batchsize: 50')
+        self.read_config()
+        self.assertEqual(self.config.batch_size, 50)
+
+    def test_metrics_off_by_default(self):
+        """Check processors aren't instrumented unless asked for"""
+        self.append_to_file('[general]')
+        self.read_config()
+        self.failIf(self.config.metrics)
+
+    def test_get_metrics(self):
+        """Check we can turn on processor instrumentation"""
+        self.append_to_file('[general]')
+        self.append_to_file('metrics: yes')
+        self.read_config()
+        self.assert_(self.config.metrics)
+
+
+
+class CompileConfigTest(ConfigTest):
+
+    config_cls = hacksaw.lib.GeneralConfig
+
+    def setUp(self):
+        ConfigTest.setUp(self)
+        self.append_to_file('[general]')
+        self.append_to_file('spool: /var/spool/hacksaw')
+
+    def test_compile(self):
+        """Check a compiled config holds the same values"""
+        self.append_to_file('processors: hacksaw.proc.mail')
+        self.read_config()
+        snapshot = self.config.compile()
+        self.assertEqual(snapshot.spool_directory, '/var/spool/hacksaw')
+        self.assertEqual(snapshot.processors, ('hacksaw.proc.mail',))
+        self.assertEqual(snapshot.batch_size, self.config.batch_size)
+        self.assertEqual(snapshot.filename, self.filename)
+
+    def test_read_only(self):
+        """Check a compiled config can't be changed"""
+        self.append_to_file('processors: hacksaw.proc.mail')
+        self.read_config()
+        snapshot = self.config.compile()
+        self.assertRaises(AttributeError, setattr, snapshot,
+                          'spool_directory', '/tmp')
+
+    def test_missing_option(self):
+        """Check optional settings that aren't set only fail when used"""
+
+        class OptionalConfig(hacksaw.lib.GeneralConfig):
+
+            FIELDS = ('spool_directory', 'processors')
+            REQUIRED_FIELDS = ('spool_directory',)
+
+        self.read_config()
+        snapshot = OptionalConfig(self.filename).compile()
+        self.assertRaises(hacksaw.lib.ConfigError, getattr, snapshot,
+                          'processors')
+
+    def test_missing_required_option(self):
+        """Check required options that aren't set fail on compiling"""
+        self.read_config()
+        self.assertRaises(hacksaw.lib.ConfigError, self.config.compile)
+
+    def test_bad_value(self):
+        """Check bad values are reported when the config is compiled"""
+        self.append_to_file('batchsize: lots')
+        self.read_config()
+        self.assertRaises(hacksaw.lib.ConfigError, self.config.compile)
+
+
+class LogMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.line = 'Jun 23 14:02:37 hoopoo ldap[29913]: Hello  world\n'
+
+    def test_date(self):
+        """Check we can extract the date from a log message"""
+        message = hacksaw.lib.LogMessage(self.line)
+        self.assertEqual(message.date, 'Jun 23 14:02:37')
+
+    def test_date_single_figure_day(self):
+        """Check we can extract the date when the day is a single digit"""
+        line = 'Jun  1 14:02:37 hoopoo ldap[29913]: Hello  world\n'
+        message = hacksaw.lib.LogMessage(line)
+        self.assertEqual(message.date, 'Jun  1 14:02:37')
+
+    def test_hostname(self):
+        """Check we can extract the hostname from a log message"""
+        message = hacksaw.lib.LogMessage(self.line)
+        self.assertEqual(message.hostname, 'hoopoo')
+
+    def test_process(self):
+        """Check we can extract the process details from a log message"""
+        message = hacksaw.lib.LogMessage(self.line)
+        self.assertEqual(message.process, 'ldap[29913]')
+
+    def test_program(self):
+        """Check we can extract the program name from a log message"""
+        message = hacksaw.lib.LogMessage(self.line)
+        self.assertEqual(message.program, 'ldap')
+        line = 'Jun 23 14:02:37 hoopoo kernel: Hello  world\n'
+        self.assertEqual(hacksaw.lib.LogMessage(line).program, 'kernel')
+
+    def test_message(self):
+        """Check we can extract the text from a log message"""
+        message = hacksaw.lib.LogMessage(self.line)
+        self.assertEqual(message.text, 'Hello  world')
+
+
+class ProcessorTest(unittest.TestCase):
+
+    def test_handle_messages(self):
+        """Check a batch of messages is handled one message at a time"""
+
+        class FakeProcessor(hacksaw.lib.Processor):
+
+            def __init__(self):
+                hacksaw.lib.Processor.__init__(self, None)
+                self.messages = []
+
+            def handle_message(self, message):
+                self.messages.append(message)
+
+        processor = FakeProcessor()
+        processor.handle_messages(['one\n', 'two\n'])
+        self.assertEqual(processor.messages, ['one\n', 'two\n'])
+
+    def test_bad_message_in_batch(self):
+        """Check a message that fails doesn't stop the rest of the batch"""
+
+        class FakeProcessor(hacksaw.lib.Processor):
+
+            def __init__(self):
+                hacksaw.lib.Processor.__init__(self, None)
+                self.messages = []
+
+            def handle_message(self, message):
+                if message.startswith('bad'):
+                    raise ValueError(message)
+                self.messages.append(message)
+
+        processor = FakeProcessor()
+        try:
+            processor.handle_messages(['one\n', 'bad1\n', 'two\n', 'bad2\n'])
+        except ValueError, e:
+            self.assertEqual(str(e), 'bad1\n')
+        else:
+            self.fail("no error raised")
+        self.assertEqual(processor.messages, ['one\n', 'two\n'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,131 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import math
+import os
+import sys
+import time
+import traceback
+
+import hacksaw.lib
+
+
+class Histogram(object):
+
+    # Bucket i counts calls that took less than 2 ** i microseconds,
+    # which is accurate enough to tell a slow processor from a fast
+    # one and costs next to nothing to record.
+
+    BUCKETS = 40
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, seconds):
+        mantissa, exponent = math.frexp(seconds * 1e6)
+        index = min(max(exponent, 0), self.BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction):
+        """Return an upper bound on the given fraction of call times"""
+        if self.count == 0:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(2 ** index / 1e6, self.maximum)
+        return self.maximum
+
+    def _get_mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    mean = property(_get_mean)
+
+
+class InstrumentedProcessor(hacksaw.lib.Processor):
+
+    # Wraps a processor, counting the lines it is given, timing each
+    # call and tallying the exceptions it raises. A traceback is only
+    # printed the first time each type of exception is seen.
+
+    def __init__(self, name, processor):
+        self.config = processor.config
+        self.name = name
+        self.processor = processor
+        self.lines_in = 0
+        self.errors = {}
+        self.histogram = Histogram()
+
+    def _get_lines_dropped(self):
+        return getattr(self.processor, "lines_dropped", 0)
+
+    lines_dropped = property(_get_lines_dropped)
+
+    def _record_error(self):
+        name = sys.exc_info()[0].__name__
+        if name not in self.errors:
+            traceback.print_exc()
+            self.errors[name] = 0
+        self.errors[name] += 1
+
+    def _call(self, method, arg):
+        start = time.time()
+        try:
+            method(arg)
+        except Exception:
+            self._record_error()
+        self.histogram.record(time.time() - start)
+
+    def handle_message(self, message):
+        self.lines_in += 1
+        self._call(self.processor.handle_message, message)
+
+    def handle_messages(self, messages):
+        self.lines_in += len(messages)
+        self._call(self.processor.handle_messages, messages)
+
+    def close(self):
+        self.processor.close()
+
+
+def write_summary(processors, stream=None):
+    instrumented = [processor for processor in processors
+                    if isinstance(processor, InstrumentedProcessor)]
+    if not instrumented:
+        return
+    if stream is None:
+        stream = sys.stderr
+    stream.write("hacksaw metrics for process %d at %s\n" %
+                 (os.getpid(), time.strftime("%Y-%m-%d %H:%M:%S")))
+    stream.write("%-28s %10s %8s %8s %7s %9s %8s %8s %8s %8s\n" %
+                 ("processor", "lines", "dropped", "calls", "errors",
+                  "total(s)", "mean(ms)", "p50(ms)", "p99(ms)", "max(ms)"))
+    for processor in instrumented:
+        histogram = processor.histogram
+        stream.write("%-28s %10d %8d %8d %7d %9.3f %8.3f %8.3f %8.3f %8.3f\n"
+                     % (processor.name, processor.lines_in,
+                        processor.lines_dropped, histogram.count,
+                        sum(processor.errors.values()), histogram.total,
+                        histogram.mean * 1000,
+                        histogram.percentile(0.5) * 1000,
+                        histogram.percentile(0.99) * 1000,
+                        histogram.maximum * 1000))
+    for processor in instrumented:
+        names = processor.errors.keys()
+        names.sort()
+        for name in names:
+            stream.write("%s: %d x %s\n" %
+                         (processor.name, processor.errors[name], name))
+    stream.flush()
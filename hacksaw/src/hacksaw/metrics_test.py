@@ -0,0 +1,84 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import StringIO
+import sys
+import unittest
+
+import hacksaw.lib
+import hacksaw.metrics
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_empty(self):
+        """Check an empty histogram reports zero"""
+        histogram = hacksaw.metrics.Histogram()
+        self.assertEqual(histogram.percentile(0.5), 0.0)
+        self.assertEqual(histogram.mean, 0.0)
+
+    def test_percentile(self):
+        """Check percentiles are within a factor of two"""
+        histogram = hacksaw.metrics.Histogram()
+        for i in range(99):
+            histogram.record(0.001)
+        histogram.record(1.0)
+        self.assert_(0.001 <= histogram.percentile(0.5) < 0.002)
+        self.assert_(0.001 <= histogram.percentile(0.99) < 0.002)
+        self.assertEqual(histogram.percentile(1.0), 1.0)
+        self.assertEqual(histogram.maximum, 1.0)
+        self.assertEqual(histogram.count, 100)
+
+
+class FakeProcessor(hacksaw.lib.Processor):
+
+    def handle_message(self, message):
+        if message == "bad":
+            raise ValueError(message)
+        if message == "ignored":
+            self.lines_dropped += 1
+
+
+class InstrumentedProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = hacksaw.metrics.InstrumentedProcessor(
+            "fake", FakeProcessor(None))
+        sys.stderr = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stderr = sys.__stderr__
+
+    def test_count_lines(self):
+        """Check we count the lines handed to a processor"""
+        self.processor.handle_messages(["one", "ignored", "three"])
+        self.processor.handle_message("four")
+        self.assertEqual(self.processor.lines_in, 4)
+        self.assertEqual(self.processor.lines_dropped, 1)
+        self.assertEqual(self.processor.histogram.count, 2)
+
+    def test_count_errors(self):
+        """Check we tally errors, printing the first of each type"""
+        self.processor.handle_message("bad")
+        self.processor.handle_messages(["bad"])
+        self.assertEqual(self.processor.errors, {"ValueError": 2})
+        self.assertEqual(sys.stderr.getvalue().count("Traceback"), 1)
+
+    def test_summary(self):
+        """Check the summary includes each processor's figures"""
+        self.processor.handle_messages(["one", "bad"])
+        stream = StringIO.StringIO()
+        hacksaw.metrics.write_summary([self.processor], stream)
+        self.assert_("fake" in stream.getvalue())
+        self.assert_("fake: 1 x ValueError" in stream.getvalue())
+
+    def test_no_summary_when_disabled(self):
+        """Check nothing is written for processors that aren't instrumented"""
+        stream = StringIO.StringIO()
+        hacksaw.metrics.write_summary([FakeProcessor(None)], stream)
+        self.assertEqual(stream.getvalue(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
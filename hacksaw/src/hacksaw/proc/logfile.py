@@ -2,52 +2,458 @@
 # (C) Cmed Ltd, 2004
 
 
+import Queue
 import errno
 import fcntl
+import gzip
 import os
+import shutil
+import string
 import sys
+import threading
 import time
+import traceback
 
+import hacksaw.index
 import hacksaw.lib
 
 
-class Processor(hacksaw.lib.Processor):
+class Compressor(object):
+
+    # Gzips rotated log files in a background thread, so that writing
+    # to the log file never waits for compression. Each file is written
+    # to a temporary name and renamed into place before the original is
+    # removed, so there is always a complete copy on disk.
+
+    COMPRESS_LEVEL = 6
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def compress_file(self, path):
+        tmp_path = path + ".gz.tmp"
+        src = file(path, "rb")
+        try:
+            dest = gzip.GzipFile(tmp_path, "wb", self.COMPRESS_LEVEL)
+            try:
+                shutil.copyfileobj(src, dest, self.CHUNK_SIZE)
+            finally:
+                dest.close()
+        finally:
+            src.close()
+        os.rename(tmp_path, path + ".gz")
+        os.remove(path)
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                break
+            try:
+                self.compress_file(path)
+            except Exception:
+                traceback.print_exc()
+
+    def compress(self, path):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+        self._queue.put(path)
+
+    def close(self):
+        """Wait for the files that have been queued to be compressed"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class LogFile(object):
+
+    # A log file that is opened once and kept open until close() is
+    # called. Other processes may append to the same file, so it is
+    # locked while each batch is written, and flushed before the lock
+    # is given up. When to fsync is up to the config (see Config.FSYNC).
+    #
+    # The log file is rotated once it grows past rotate_size or has
+    # been written to for longer than rotate_age, by renaming it while
+    # we hold the lock. Any other writer notices that the file it has
+    # locked is no longer the log file and reopens it. The time at
+    # which the current log file was started is kept in the mtime of
+    # a ".started" file alongside it.
+    #
+    # If the index option is set, a hacksaw.index sidecar is written
+    # under the same lock, and rotated along with the log file. The
+    # index of a compressed segment refers to the uncompressed data.
 
     LOCK_TIMEOUT = 5
+    LOCK_MIN_SLEEP = 0.001
+    LOCK_MAX_SLEEP = 0.1
 
-    def __init__(self, config):
-        hacksaw.lib.Processor.__init__(self, config)
-        dirname = os.path.dirname(self.config.log_file)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+    def __init__(self, path, config, compressor):
+        self.path = path
+        self.config = config
+        self._compressor = compressor
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:  # another writer beat us
+                    raise
+        self._file = file(path, "a")
+        self._last_sync = time.time()
+        self._unsynced = False
+        self._stamp_file = path + ".started"
+        self._index = None
+        if self.config.index:
+            self._index = hacksaw.index.IndexWriter(path,
+                                                    self.config.index_interval)
 
     def acquire_lock(self):
-        file_obj = file(self.config.log_file, "a")
         try:
-            fcntl.lockf(file_obj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError, e:
             if e.errno in (errno.EACCES, errno.EAGAIN):
-                return None
+                return False
             raise
-        return file_obj
-        
-    def handle_message(self, message):
-        file_obj = self.acquire_lock()
+        return True
+
+    def release_lock(self):
+        fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN)
+
+    def wait_for_lock(self):
+        # Sleep between attempts, backing off while the lock is held,
+        # rather than spinning on the CPU.
         start_time = time.time()
-        while file_obj is None:
-            if time.time() - start_time >= Processor.LOCK_TIMEOUT:
+        delay = LogFile.LOCK_MIN_SLEEP
+        while not self.acquire_lock():
+            remaining = start_time + LogFile.LOCK_TIMEOUT - time.time()
+            if remaining <= 0:
                 raise IOError("Couldn't write to '%s' within %s seconds" %
-                              (self.config.filename, Processor.LOCK_TIMEOUT))
-            file_obj = self.acquire_lock()
-        file_obj.write(message)
-        file_obj.close()
+                              (self.path, LogFile.LOCK_TIMEOUT))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, LogFile.LOCK_MAX_SLEEP)
+
+    def _is_current(self):
+        # Is the file we have open still the log file?
+        try:
+            info = os.stat(self.path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        current = os.fstat(self._file.fileno())
+        return (info.st_dev, info.st_ino) == (current.st_dev, current.st_ino)
+
+    def _lock_log_file(self):
+        self.wait_for_lock()
+        while not self._is_current():
+            self._file.close()
+            if self._index is not None:
+                self._index.close()
+            self._file = file(self.path, "a")
+            self.wait_for_lock()
+
+    def _get_age(self):
+        try:
+            return time.time() - os.stat(self._stamp_file).st_mtime
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        file(self._stamp_file, "w").close()
+        return 0
+
+    def _rotation_due(self, length):
+        size = os.fstat(self._file.fileno()).st_size
+        if size == 0:
+            return False
+        max_size = self.config.rotate_size
+        if max_size and size + length > max_size:
+            return True
+        max_age = self.config.rotate_age
+        return bool(max_age) and self._get_age() >= max_age
+
+    def _get_segment_name(self):
+        prefix = "%s.%s" % (self.path, time.strftime("%Y%m%d-%H%M%S"))
+        name = prefix
+        count = 0
+        while os.path.exists(name) or os.path.exists(name + ".gz"):
+            count += 1
+            name = "%s.%d" % (prefix, count)
+        return name
+
+    def rotate(self):
+        """Move the log file aside and start a new one (hold the lock!)"""
+        segment = self._get_segment_name()
+        os.rename(self.path, segment)
+        if self._index is not None:
+            self._index.rotate(segment)
+        old_file = self._file
+        self._file = file(self.path, "a")
+        try:
+            self.wait_for_lock()
+        finally:
+            old_file.close()
+        file(self._stamp_file, "w").close()
+        if self.config.compress:
+            self._compressor.compress(segment)
+        return segment
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._index is not None:
+            self._index.sync()
+        self._last_sync = time.time()
+        self._unsynced = False
+
+    def _sync_due(self):
+        policy = self.config.fsync
+        if policy == Config.FSYNC_ON_BATCH:
+            return True
+        if policy == Config.FSYNC_ON_INTERVAL:
+            return time.time() - self._last_sync >= self.config.fsync_interval
+        return False
+
+    def write(self, lines):
+        # Always finish on a line boundary, so that another process
+        # appending to the same file can't join its output onto ours.
+        data = "".join(lines)
+        if data and not data.endswith("\n"):
+            data += "\n"
+            lines = lines[:-1] + [lines[-1] + "\n"]
+        self._lock_log_file()
+        try:
+            if self._rotation_due(len(data)):
+                self.rotate()
+            offset = os.fstat(self._file.fileno()).st_size
+            self._file.write(data)
+            self._file.flush()
+            if self._index is not None:
+                self._index.write(offset, lines)
+            self._unsynced = True
+            if self._sync_due():
+                self.sync()
+        finally:
+            self.release_lock()
+
+    def close(self, sync=True):
+        if self._file.closed:
+            return
+        try:
+            if sync and self._unsynced:
+                self.sync()
+        finally:
+            self._file.close()
+            if self._index is not None:
+                self._index.close()
+
+
+class Processor(hacksaw.lib.Processor):
+
+    # Writes to a single log file, or, if the logfile option contains
+    # ${hostname} or ${program}, to a log file for each host and/or
+    # program. Open log files are kept in a least recently used cache
+    # of up to max_open_files, and are closed (and so flushed and
+    # synced) when they fall out of the end of it.
+
+    MAX_PATHS = 10000  # how many host/program pairs to remember paths for
+
+    def __init__(self, config):
+        hacksaw.lib.Processor.__init__(self, config)
+        self._template = None
+        if "$" in self.config.log_file:
+            self._template = string.Template(self.config.log_file)
+        self._paths = {}
+        self._log_files = {}
+        self._last_used = {}  # path -> when its log file was last used
+        self._clock = 0
+        self._compressor = Compressor()
+        if self._template is None:
+            self.get_log_file(self.config.log_file)
+
+    def _get_field(self, value):
+        # Values come from the network, so mustn't be able to take us
+        # outside the directories we've been told to write to.
+        value = value.replace(os.sep, "_").lstrip(".")
+        return value or "unknown"
+
+    def get_path(self, message):
+        if self._template is None:
+            return self.config.log_file
+        # This is called for every line, so rather than build a
+        # LogMessage we use its pattern directly.
+        match = hacksaw.lib.LogMessage.pattern.match(message)
+        if match is None:
+            key = ("", "")
+        else:
+            hostname, process = match.group(2, 3)
+            key = (hostname, process.split("[", 1)[0])
+        try:
+            return self._paths[key]
+        except KeyError:
+            pass
+        if len(self._paths) >= Processor.MAX_PATHS:
+            self._paths.clear()
+        path = self._template.safe_substitute(
+            hostname=self._get_field(key[0]),
+            program=self._get_field(key[1]))
+        self._paths[key] = path
+        return path
+
+    def _evict(self):
+        # Only done when a new file is opened with the cache full, so
+        # the search is cheap next to the open.
+        oldest = min([(used, path)
+                      for path, used in self._last_used.items()])[1]
+        del self._last_used[oldest]
+        # Everything written has already been flushed to the kernel.
+        # With fsync set to close, a file that's only fallen out of the
+        # cache isn't finished with, so it isn't synced.
+        sync = self.config.fsync != Config.FSYNC_ON_CLOSE
+        self._log_files.pop(oldest).close(sync)
+
+    def get_log_file(self, path):
+        try:
+            log_file = self._log_files[path]
+        except KeyError:
+            while len(self._log_files) >= self.config.max_open_files:
+                self._evict()
+            log_file = self._log_files[path] = LogFile(path, self.config,
+                                                       self._compressor)
+        self._clock += 1
+        self._last_used[path] = self._clock
+        return log_file
+
+    def handle_message(self, message):
+        self.handle_messages([message])
+
+    def handle_messages(self, messages):
+        if self._template is None:
+            self.get_log_file(self.config.log_file).write(messages)
+            return
+        paths = []
+        batches = {}
+        for message in messages:
+            path = self.get_path(message)
+            if path not in batches:
+                paths.append(path)
+                batches[path] = []
+            batches[path].append(message)
+        # A file that can't be written mustn't stop the others being
+        # written; the first error is raised afterwards.
+        error = None
+        for path in paths:
+            try:
+                self.get_log_file(path).write(batches[path])
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        try:
+            while self._log_files:
+                path, log_file = self._log_files.popitem()
+                del self._last_used[path]
+                log_file.close()
+        finally:
+            self._compressor.close()
 
 
 class Config(hacksaw.lib.Config):
 
     LOG_FILE = 'logfile'
+    FSYNC = 'fsync'
+    FSYNC_INTERVAL = 'fsync_interval'
+    ROTATE_SIZE = 'rotate_size'
+    ROTATE_AGE = 'rotate_age'
+    COMPRESS = 'compress'
+    MAX_OPEN_FILES = 'max_open_files'
+    INDEX = 'index'
+    INDEX_INTERVAL = 'index_interval'
+
+    FSYNC_ON_BATCH = 'batch'
+    FSYNC_ON_INTERVAL = 'interval'
+    FSYNC_ON_CLOSE = 'close'
+    FSYNC_POLICIES = (FSYNC_ON_BATCH, FSYNC_ON_INTERVAL, FSYNC_ON_CLOSE)
+
+    DEFAULT_FSYNC = FSYNC_ON_CLOSE
+    DEFAULT_FSYNC_INTERVAL = 1
+    DEFAULT_MAX_OPEN_FILES = 256
+    DEFAULT_INDEX_INTERVAL = 300
+
+    FIELDS = ('log_file', 'fsync', 'fsync_interval', 'rotate_size',
+              'rotate_age', 'compress', 'max_open_files', 'index',
+              'index_interval')
+    REQUIRED_FIELDS = ('log_file',)
 
     def _get_log_file(self):
         return self._get_item(Config.LOG_FILE)
 
     log_file = property(_get_log_file)
+
+    def _get_fsync(self):
+        value = self._get_optional_item(Config.FSYNC, Config.DEFAULT_FSYNC)
+        value = value.strip().lower()
+        if value not in Config.FSYNC_POLICIES:
+            raise hacksaw.lib.ConfigError, \
+                  "%s must be one of %s, not '%s'" % \
+                  (Config.FSYNC, ", ".join(Config.FSYNC_POLICIES), value)
+        return value
+
+    fsync = property(_get_fsync)
+
+    def _get_fsync_interval(self):
+        value = self._get_optional_item(Config.FSYNC_INTERVAL,
+                                        Config.DEFAULT_FSYNC_INTERVAL)
+        return float(value)
+
+    fsync_interval = property(_get_fsync_interval)
+
+    def _get_rotate_size(self):
+        # In kilobytes in the config file, like max_messagestore.
+        value = self._get_optional_item(Config.ROTATE_SIZE, 0)
+        return int(value) * 1024
+
+    rotate_size = property(_get_rotate_size)
+
+    def _get_rotate_age(self):
+        value = self._get_optional_item(Config.ROTATE_AGE, 0)
+        return float(value)
+
+    rotate_age = property(_get_rotate_age)
+
+    def _get_compress(self):
+        value = self._get_optional_item(Config.COMPRESS, 'yes')
+        return value.lower() in ('1', 'yes', 'true', 'on')
+
+    compress = property(_get_compress)
+
+    def _get_max_open_files(self):
+        value = self._get_optional_item(Config.MAX_OPEN_FILES,
+                                        Config.DEFAULT_MAX_OPEN_FILES)
+        return max(int(value), 1)
+
+    max_open_files = property(_get_max_open_files)
+
+    def _get_index(self):
+        value = self._get_optional_item(Config.INDEX, 'no')
+        return value.lower() in ('1', 'yes', 'true', 'on')
+
+    index = property(_get_index)
+
+    def _get_index_interval(self):
+        value = int(self._get_optional_item(Config.INDEX_INTERVAL,
+                                            Config.DEFAULT_INDEX_INTERVAL))
+        if value <= 0 or value % 60:
+            raise ValueError("%s must be a whole number of minutes" %
+                             Config.INDEX_INTERVAL)
+        return value
+
+    index_interval = property(_get_index_interval)
@@ -2,6 +2,8 @@
 # (C) Cmed Ltd, 2004
 
 
+import glob
+import gzip
 import os
 import shutil
 import sys
@@ -10,6 +12,8 @@ import unittest
 
 from pmock import *
 
+import hacksaw.index
+import hacksaw.lib
 import hacksaw.lib_test
 import hacksaw.proc.logfile
 
@@ -40,11 +44,38 @@ class ProcessorTest(LogfileTest):
         log_file = file(self.config.log_file, "r")
         self.assert_(log_file.read(), "Test message\n")
 
+    def test_write_batch(self):
+        """Check that we write a batch of log messages in one go"""
+        processor = hacksaw.proc.logfile.Processor(self.config)
+        processor.handle_messages(["Message 1\n", "Message 2\n"])
+        contents = file(self.config.log_file, "r").read()
+        self.assertEqual(contents, "Message 1\nMessage 2\n")
+
+    def test_batch_ends_with_newline(self):
+        """Check a batch always ends on a line boundary"""
+        processor = hacksaw.proc.logfile.Processor(self.config)
+        processor.handle_messages(["Message 1\n", "Message 2"])
+        processor.handle_messages(["Message 3\n"])
+        contents = file(self.config.log_file, "r").read()
+        self.assertEqual(contents, "Message 1\nMessage 2\nMessage 3\n")
+
+    def test_keep_file_open(self):
+        """Check the log file is only opened once"""
+        processor = hacksaw.proc.logfile.Processor(self.config)
+        file_obj = processor.get_log_file(self.config.log_file)._file
+        processor.handle_messages(["Message 1\n"])
+        processor.handle_messages(["Message 2\n"])
+        log_file = processor.get_log_file(self.config.log_file)
+        self.assert_(log_file._file is file_obj)
+        self.failIf(file_obj.closed)
+        processor.close()
+        self.assert_(file_obj.closed)
+
     def test_can_lock(self):
-        """Check we can lock the message store"""
+        """Check we can lock the log file"""
         processor = hacksaw.proc.logfile.Processor(self.config)
-        file_obj = processor.acquire_lock()
-        self.assertNotEqual(file_obj, None)
+        log_file = processor.get_log_file(self.config.log_file)
+        self.assert_(log_file.acquire_lock())
         code = """
 import sys
 
@@ -52,54 +83,337 @@ import hacksaw.proc.logfile
 
 config = hacksaw.proc.logfile.Config("%s")
 processor = hacksaw.proc.logfile.Processor(config)
-if processor.acquire_lock() is None:
-    sys.exit(0)
-else:
+if processor.get_log_file(config.log_file).acquire_lock():
     sys.exit(1)
+else:
+    sys.exit(0)
     
 """ % self.filename
         self.assertEqual(os.system("""python -c '%s'""" % code) >> 8, 0)
+        log_file.release_lock()
 
     def test_use_lock(self):
-        """Check we lock the message store when appending a message"""
-        file_obj = Mock()
-        file_obj.expects(once()).write(eq("Test message"))
-        file_obj.expects(once()).close()
-       
+        """Check we wait for the lock when appending a message"""
         mock = Mock()
-        mock.expects(once()).register().will(return_value(file_obj))
-        mock.expects(once()).register().will(return_value(None))
-              
+        mock.expects(once()).register().will(return_value(True))
+        mock.expects(once()).register().will(return_value(False))
+
         def acquire_func():
-            rval = mock.register()
-            return rval
-       
+            return mock.register()
+
         processor = hacksaw.proc.logfile.Processor(self.config)
-        processor.acquire_lock = acquire_func
-        processor.handle_message("Test message")
+        log_file = processor.get_log_file(self.config.log_file)
+        log_file.acquire_lock = acquire_func
+        log_file.release_lock = lambda: None
+        processor.handle_message("Test message\n")
         mock.verify()
+        processor.close()
+        contents = file(self.config.log_file, "r").read()
+        self.assertEqual(contents, "Test message\n")
 
     def test_lock_timeout(self):
         """Check the lock attempt times out"""
+        processor = hacksaw.proc.logfile.Processor(self.config)
+        log_file = processor.get_log_file(self.config.log_file)
+        log_file.acquire_lock = lambda: False
+
         mock_time = Mock()
         t0 = time.time()
-        timeout = hacksaw.proc.logfile.Processor.LOCK_TIMEOUT
+        timeout = hacksaw.proc.logfile.LogFile.LOCK_TIMEOUT
         mock_time.expects(once()).time().will(return_value(t0 + timeout))
         mock_time.expects(once()).time().will(return_value(t0))
         real_time = hacksaw.proc.logfile.time
         hacksaw.proc.logfile.time = mock_time
-
-        def acquire_func():
-            return None
-
         try:
-            processor = hacksaw.proc.logfile.Processor(self.config)
-            processor.acquire_lock = acquire_func
             self.assertRaises(IOError, processor.handle_message,
                               "Test message")
         finally:
             hacksaw.proc.logfile.time = real_time
-       
+        mock_time.verify()
+
+    def test_sleep_while_locked(self):
+        """Check we sleep, rather than spin, while the lock is held"""
+        processor = hacksaw.proc.logfile.Processor(self.config)
+        attempts = []
+
+        def acquire_func():
+            attempts.append(time.time())
+            return len(attempts) > 3
+
+        log_file = processor.get_log_file(self.config.log_file)
+        log_file.acquire_lock = acquire_func
+        log_file.release_lock = lambda: None
+        processor.handle_message("Test message\n")
+        self.assertEqual(len(attempts), 4)
+        minimum = hacksaw.proc.logfile.LogFile.LOCK_MIN_SLEEP * (1 + 2 + 4)
+        self.assert_(attempts[-1] - attempts[0] >= minimum)
+        processor.close()
+
+
+class SyncTest(LogfileTest):
+
+    def make_processor(self, policy):
+        self.append_to_file("fsync: %s" % policy)
+        self.read_config()
+        processor = hacksaw.proc.logfile.Processor(self.config.compile())
+        self.synced = 0
+        self.log_file = processor.get_log_file(self.config.log_file)
+        real_sync = self.log_file.sync
+
+        def sync():
+            self.synced += 1
+            real_sync()
+
+        self.log_file.sync = sync
+        return processor
+
+    def test_sync_every_batch(self):
+        """Check we fsync after every batch when asked to"""
+        processor = self.make_processor("batch")
+        processor.handle_messages(["Message 1\n"])
+        processor.handle_messages(["Message 2\n"])
+        self.assertEqual(self.synced, 2)
+
+    def test_sync_on_close(self):
+        """Check we only fsync when closing by default"""
+        processor = self.make_processor("close")
+        processor.handle_messages(["Message 1\n"])
+        processor.handle_messages(["Message 2\n"])
+        self.assertEqual(self.synced, 0)
+        processor.close()
+        self.assertEqual(self.synced, 1)
+        contents = file(self.config.log_file, "r").read()
+        self.assertEqual(contents, "Message 1\nMessage 2\n")
+
+    def test_sync_on_interval(self):
+        """Check we fsync once the interval has passed"""
+        self.append_to_file("fsync_interval: 60")
+        processor = self.make_processor("interval")
+        processor.handle_messages(["Message 1\n"])
+        self.assertEqual(self.synced, 0)
+        self.log_file._last_sync -= 60
+        processor.handle_messages(["Message 2\n"])
+        self.assertEqual(self.synced, 1)
+
+
+class RotationTest(LogfileTest):
+
+    def make_processor(self, *options):
+        for option in options:
+            self.append_to_file(option)
+        self.read_config()
+        return hacksaw.proc.logfile.Processor(self.config.compile())
+
+    def get_segments(self):
+        segments = [segment for segment in
+                    glob.glob(LogfileTest.LOG_FILE + ".2*")
+                    if not segment.endswith(".idx")]
+        segments.sort()
+        return segments
+
+    def test_rotate_on_size(self):
+        """Check the log file is rotated when it gets too big"""
+        processor = self.make_processor("rotate_size: 1", "compress: no")
+        line = "x" * 599 + "\n"
+        processor.handle_messages([line])
+        self.assertEqual(self.get_segments(), [])
+        processor.handle_messages([line])
+        processor.close()
+        segments = self.get_segments()
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(file(segments[0]).read(), line)
+        self.assertEqual(file(LogfileTest.LOG_FILE).read(), line)
+
+    def test_rotate_on_age(self):
+        """Check the log file is rotated when it gets too old"""
+        processor = self.make_processor("rotate_age: 60", "compress: no")
+        processor.handle_messages(["Message 1\n"])
+        processor.handle_messages(["Message 2\n"])
+        self.assertEqual(self.get_segments(), [])
+        stamp = LogfileTest.LOG_FILE + ".started"
+        then = time.time() - 61
+        os.utime(stamp, (then, then))
+        processor.handle_messages(["Message 3\n"])
+        processor.close()
+        segments = self.get_segments()
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(file(segments[0]).read(), "Message 1\nMessage 2\n")
+        self.assertEqual(file(LogfileTest.LOG_FILE).read(), "Message 3\n")
+        self.assert_(os.stat(stamp).st_mtime > then + 1)
+
+    def test_compress_segment(self):
+        """Check rotated log files are compressed"""
+        processor = self.make_processor("rotate_size: 1")
+        line = "x" * 1023 + "\n"
+        processor.handle_messages([line])
+        processor.handle_messages([line])
+        processor.close()
+        segments = self.get_segments()
+        self.assertEqual(len(segments), 1)
+        self.assert_(segments[0].endswith(".gz"))
+        self.assertEqual(gzip.open(segments[0]).read(), line)
+
+    def test_unique_segment_names(self):
+        """Check a segment never replaces an older one"""
+        processor = self.make_processor("rotate_size: 1", "compress: no")
+        line = "x" * 1023 + "\n"
+        for i in range(3):
+            processor.handle_messages([line])
+        processor.close()
+        self.assertEqual(len(self.get_segments()), 2)
+
+    def test_other_writer_follows_rotation(self):
+        """Check another writer moves on to the new log file"""
+        processor1 = self.make_processor("rotate_size: 1", "compress: no")
+        processor2 = hacksaw.proc.logfile.Processor(self.config.compile())
+        line = "x" * 599 + "\n"
+        processor1.handle_messages([line])
+        processor2.handle_messages([line])
+        processor1.handle_messages(["Message\n"])
+        processor1.close()
+        processor2.close()
+        segments = self.get_segments()
+        self.assertEqual(len(segments), 1)
+        self.assertEqual(file(segments[0]).read(), line)
+        self.assertEqual(file(LogfileTest.LOG_FILE).read(),
+                         line + "Message\n")
+
+    def test_log_file_removed(self):
+        """Check we recreate the log file if it is removed"""
+        processor = self.make_processor()
+        processor.handle_messages(["Message 1\n"])
+        os.remove(LogfileTest.LOG_FILE)
+        processor.handle_messages(["Message 2\n"])
+        processor.close()
+        self.assertEqual(file(LogfileTest.LOG_FILE).read(), "Message 2\n")
+
+
+class TemplateTest(LogfileTest):
+
+    TEMPLATE = "./path/${hostname}/${program}.log"
+
+    def make_processor(self, *options):
+        self.append_to_file("logfile: %s" % TemplateTest.TEMPLATE)
+        for option in options:
+            self.append_to_file(option)
+        self.read_config()
+        return hacksaw.proc.logfile.Processor(self.config.compile())
+
+    def test_write_per_host_and_program(self):
+        """Check messages are written to a file for each host and program"""
+        processor = self.make_processor()
+        messages = ["Jun  1 00:00:01 host1 sshd[123]: Message 1\n",
+                    "Jun  1 00:00:02 host2 sshd[456]: Message 2\n",
+                    "Jun  1 00:00:03 host1 CRON[789]: Message 3\n",
+                    "Jun  1 00:00:04 host1 sshd[123]: Message 4\n"]
+        processor.handle_messages(messages)
+        processor.close()
+        self.assertEqual(file("./path/host1/sshd.log").read(),
+                         messages[0] + messages[3])
+        self.assertEqual(file("./path/host2/sshd.log").read(), messages[1])
+        self.assertEqual(file("./path/host1/CRON.log").read(), messages[2])
+
+    def test_unwritable_file_in_batch(self):
+        """Check a file that can't be written doesn't stop the others"""
+        processor = self.make_processor()
+        os.makedirs("./path")
+        file("./path/host1", "w").close()  # host1's directory can't be made
+        messages = ["Jun  1 00:00:01 host1 sshd[123]: Message 1\n",
+                    "Jun  1 00:00:02 host2 sshd[456]: Message 2\n"]
+        self.assertRaises(EnvironmentError, processor.handle_messages,
+                          messages)
+        processor.close()
+        self.assertEqual(file("./path/host2/sshd.log").read(), messages[1])
+
+    def test_unsafe_fields(self):
+        """Check hostnames and programs can't escape the log directory"""
+        processor = self.make_processor()
+        processor.handle_messages(
+            ["Jun  1 00:00:01 .. postfix/smtpd[1]: Message\n",
+             "Not a syslog message\n"])
+        processor.close()
+        self.assert_(os.path.exists("./path/unknown/postfix_smtpd.log"))
+        self.assertEqual(file("./path/unknown/unknown.log").read(),
+                         "Not a syslog message\n")
+
+    def test_evict_least_recently_used(self):
+        """Check we only keep max_open_files log files open"""
+        processor = self.make_processor("max_open_files: 2")
+        first = processor.get_log_file("./path/host1/first.log")
+        processor.get_log_file("./path/host1/second.log")
+        processor.get_log_file("./path/host1/first.log")
+        third = processor.get_log_file("./path/host1/third.log")
+        self.failIf(first._file.closed)
+        self.assertEqual(len(processor._log_files), 2)
+        self.failIf("./path/host1/second.log" in processor._log_files)
+        processor.close()
+        self.assert_(first._file.closed)
+        self.assert_(third._file.closed)
+
+    def test_no_sync_on_eviction(self):
+        """Check evicted files aren't synced when fsync is close"""
+        processor = self.make_processor("max_open_files: 1", "fsync: close")
+        synced = []
+        first = processor.get_log_file("./path/host1/sshd.log")
+        first.sync = lambda: synced.append(first.path)
+        message = "Jun  1 00:00:01 host1 sshd[1]: Message 1\n"
+        processor.handle_messages([message])
+        processor.get_log_file("./path/host2/sshd.log")
+        self.assert_(first._file.closed)
+        self.assertEqual(synced, [])
+        self.assertEqual(file("./path/host1/sshd.log").read(), message)
+        processor.close()
+
+    def test_write_after_eviction(self):
+        """Check nothing is lost when a log file is evicted and reopened"""
+        processor = self.make_processor("max_open_files: 1")
+        messages = ["Jun  1 00:00:01 host1 sshd[1]: Message 1\n",
+                    "Jun  1 00:00:02 host2 sshd[1]: Message 2\n",
+                    "Jun  1 00:00:03 host1 sshd[1]: Message 3\n"]
+        for message in messages:
+            processor.handle_messages([message])
+        self.assertEqual(file("./path/host1/sshd.log").read(),
+                         messages[0] + messages[2])
+        processor.close()
+
+
+class IndexTest(LogfileTest):
+
+    def make_processor(self, *options):
+        for option in options:
+            self.append_to_file(option)
+        self.read_config()
+        return hacksaw.proc.logfile.Processor(self.config.compile())
+
+    def test_write_index(self):
+        """Check we write an index alongside the log file"""
+        processor = self.make_processor("index: yes")
+        messages = ["Jun  1 00:00:01 host1 sshd[123]: Message 1\n",
+                    "Jun  1 00:00:02 host2 sshd[456]: Message 2"]
+        processor.handle_messages(messages)
+        processor.close()
+        interval, records = hacksaw.index.read_index(LogfileTest.LOG_FILE)
+        self.assertEqual(interval, 300)
+        size = os.path.getsize(LogfileTest.LOG_FILE)
+        self.assertEqual([record[:2] for record in records],
+                         [(0, len(messages[0])), (len(messages[0]), size)])
+        self.assertEqual([record[3] for record in records],
+                         ["host1", "host2"])
+
+    def test_rotate_index(self):
+        """Check the index is rotated with the log file"""
+        processor = self.make_processor("index: yes", "rotate_size: 1",
+                                        "compress: no")
+        line = "Jun  1 00:00:01 host1 sshd[123]: %s\n" % ("x" * 600)
+        processor.handle_messages([line])
+        processor.handle_messages([line])
+        processor.close()
+        segments = glob.glob(LogfileTest.LOG_FILE + ".2*[0-9]")
+        self.assertEqual(len(segments), 1)
+        segment = segments[0]
+        self.assertEqual(hacksaw.index.read_index(segment)[1],
+                         hacksaw.index.read_index(LogfileTest.LOG_FILE)[1])
+
 
 class ConfigTest(LogfileTest):
 
@@ -110,6 +424,62 @@ class ConfigTest(LogfileTest):
         self.read_config()
         self.assertEqual(self.config.log_file, path)
 
+    def test_get_fsync(self):
+        """Check we can get the fsync policy"""
+        self.assertEqual(self.config.fsync, "close")
+        self.append_to_file("fsync: Batch")
+        self.read_config()
+        self.assertEqual(self.config.fsync, "batch")
+
+    def test_bad_fsync(self):
+        """Check we reject an unknown fsync policy"""
+        self.append_to_file("fsync: sometimes")
+        self.read_config()
+        self.assertRaises(hacksaw.lib.ConfigError, self.config.compile)
+
+    def test_get_fsync_interval(self):
+        """Check we can get the fsync interval"""
+        self.assertEqual(self.config.fsync_interval, 1)
+        self.append_to_file("fsync_interval: 2.5")
+        self.read_config()
+        self.assertEqual(self.config.fsync_interval, 2.5)
+
+    def test_get_rotation(self):
+        """Check we can get the rotation settings"""
+        self.assertEqual(self.config.rotate_size, 0)
+        self.assertEqual(self.config.rotate_age, 0)
+        self.assertEqual(self.config.compress, True)
+        self.append_to_file("rotate_size: 1024")
+        self.append_to_file("rotate_age: 86400")
+        self.append_to_file("compress: no")
+        self.read_config()
+        self.assertEqual(self.config.rotate_size, 1024 * 1024)
+        self.assertEqual(self.config.rotate_age, 86400)
+        self.assertEqual(self.config.compress, False)
+
+    def test_get_max_open_files(self):
+        """Check we can get the number of log files to keep open"""
+        self.assertEqual(self.config.max_open_files, 256)
+        self.append_to_file("max_open_files: 16")
+        self.read_config()
+        self.assertEqual(self.config.max_open_files, 16)
+
+    def test_get_index(self):
+        """Check we can get the index settings"""
+        self.assertEqual(self.config.index, False)
+        self.assertEqual(self.config.index_interval, 300)
+        self.append_to_file("index: yes")
+        self.append_to_file("index_interval: 60")
+        self.read_config()
+        self.assertEqual(self.config.index, True)
+        self.assertEqual(self.config.index_interval, 60)
+
+    def test_bad_index_interval(self):
+        """Check the index interval must be a whole number of minutes"""
+        self.append_to_file("index_interval: 90")
+        self.read_config()
+        self.assertRaises(hacksaw.lib.ConfigError, self.config.compile)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,13 +2,21 @@
 # (C) Cmed Ltd, 2004
 
 
+import base64
+import cStringIO
+import email.MIMEBase
 import email.MIMEText
 import errno
 import fcntl
 import os
 import re
+import smtplib
+import socket
 import sys
+import threading
 import time
+import traceback
+import zlib
 
 import hacksaw.lib
 
@@ -22,18 +30,38 @@ class Processor(hacksaw.lib.Processor):
         dirname = os.path.dirname(self.config.message_store)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
+        # Locks on files belong to the process rather than the thread,
+        # so this keeps our writes apart from the background sender's.
+        self._store_lock = threading.Lock()
+        self.sender = None
+        if self.config.send_size or self.config.send_age:
+            self.sender = BackgroundSender(self.config, self._store_lock)
 
-    def acquire_lock(self):
-        file_obj = file(self.config.message_store, "a")
+    def _is_current(self, file_obj):
+        # The sender moves the store aside while it holds the lock, so
+        # the file we've locked may no longer be the message store.
         try:
-            fcntl.lockf(file_obj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError, e:
-            if e.errno in (errno.EACCES, errno.EAGAIN):
-                return None
-            raise
-        return file_obj
+            stat = os.stat(self.config.message_store)
+        except OSError:
+            return False
+        fstat = os.fstat(file_obj.fileno())
+        return (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino)
+
+    def acquire_lock(self):
+        while True:
+            file_obj = file(self.config.message_store, "a")
+            try:
+                fcntl.lockf(file_obj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                file_obj.close()
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    return None
+                raise
+            if self._is_current(file_obj):
+                return file_obj
+            file_obj.close()
         
-    def handle_message(self, message):
+    def wait_for_lock(self):
         file_obj = self.acquire_lock()
         start_time = time.time()
         while file_obj is None:
@@ -41,8 +69,38 @@ class Processor(hacksaw.lib.Processor):
                 raise IOError("Couldn't write to '%s' within %s seconds" %
                               (self.config.filename, Processor.LOCK_TIMEOUT))
             file_obj = self.acquire_lock()
-        file_obj.write(message)
-        file_obj.close()
+        return file_obj
+
+    def _write(self, data):
+        self._store_lock.acquire()
+        try:
+            file_obj = self.wait_for_lock()
+            try:
+                file_obj.write(data)
+                if self.sender is not None:
+                    file_obj.flush()
+                    stat = os.fstat(file_obj.fileno())
+            finally:
+                file_obj.close()
+        finally:
+            self._store_lock.release()
+        if self.sender is not None:
+            self.sender.note_write(stat)
+
+    def handle_message(self, message):
+        self._write(message)
+
+    def handle_messages(self, messages):
+        # Always finish on a line boundary, so that another process
+        # appending to the same file can't join its output onto ours.
+        data = "".join(messages)
+        if data and not data.endswith("\n"):
+            data += "\n"
+        self._write(data)
+
+    def close(self):
+        if self.sender is not None:
+            self.sender.close()
 
 
 class Config(hacksaw.lib.Config):
@@ -53,6 +111,32 @@ class Config(hacksaw.lib.Config):
     SUBJECT = 'subject'
     MAIL_COMMAND = 'mailcommand'
     MAX_MESSAGE_STORE = 'max_messagestore'
+    DIGEST = 'digest'
+    DIGEST_MAX_TEMPLATES = 'digest_max_templates'
+    SMTP_HOST = 'smtphost'
+    SMTP_PORT = 'smtpport'
+    SMTP_RETRIES = 'smtp_retries'
+    SMTP_RETRY_DELAY = 'smtp_retry_delay'
+    COMPRESS = 'compress'
+    RATE_LIMIT = 'rate_limit'
+    RATE_BURST = 'rate_burst'
+    AGGREGATION_WINDOW = 'aggregation_window'
+    SEND_SIZE = 'send_size'
+    SEND_AGE = 'send_age'
+
+    DEFAULT_DIGEST_MAX_TEMPLATES = 1000
+    DEFAULT_SMTP_PORT = smtplib.SMTP_PORT
+    DEFAULT_SMTP_RETRIES = 3
+    DEFAULT_SMTP_RETRY_DELAY = 1
+
+    FIELDS = ('message_store', 'sender', 'recipients', 'subject',
+              'mail_command', 'max_message_store', 'digest',
+              'digest_max_templates', 'smtp_host', 'smtp_port',
+              'smtp_retries', 'smtp_retry_delay', 'compress', 'rate_limit',
+              'rate_burst', 'aggregation_window', 'send_size', 'send_age')
+    # The rest are only needed once there's something to send (and
+    # mail_command only if smtphost isn't set).
+    REQUIRED_FIELDS = ('message_store',)
 
     def _get_message_store(self):
         return self._get_item(Config.MESSAGE_STORE)
@@ -87,11 +171,649 @@ class Config(hacksaw.lib.Config):
 
     max_message_store = property(_get_max_message_store)
 
+    def _get_digest(self):
+        value = self._get_optional_item(Config.DIGEST, 'no')
+        return value.lower() in ('1', 'yes', 'true', 'on')
+
+    digest = property(_get_digest)
+
+    def _get_digest_max_templates(self):
+        value = self._get_optional_item(Config.DIGEST_MAX_TEMPLATES,
+                                        Config.DEFAULT_DIGEST_MAX_TEMPLATES)
+        return max(int(value), 1)
+
+    digest_max_templates = property(_get_digest_max_templates)
+
+    def _get_smtp_host(self):
+        # Mail is sent with the mail command unless this is set.
+        return self._get_optional_item(Config.SMTP_HOST, None)
+
+    smtp_host = property(_get_smtp_host)
+
+    def _get_smtp_port(self):
+        value = self._get_optional_item(Config.SMTP_PORT,
+                                        Config.DEFAULT_SMTP_PORT)
+        return int(value)
+
+    smtp_port = property(_get_smtp_port)
+
+    def _get_smtp_retries(self):
+        value = self._get_optional_item(Config.SMTP_RETRIES,
+                                        Config.DEFAULT_SMTP_RETRIES)
+        return max(int(value), 0)
+
+    smtp_retries = property(_get_smtp_retries)
+
+    def _get_smtp_retry_delay(self):
+        value = self._get_optional_item(Config.SMTP_RETRY_DELAY,
+                                        Config.DEFAULT_SMTP_RETRY_DELAY)
+        return float(value)
+
+    smtp_retry_delay = property(_get_smtp_retry_delay)
+
+    def _get_compress(self):
+        value = self._get_optional_item(Config.COMPRESS, 'no')
+        return value.lower() in ('1', 'yes', 'true', 'on')
+
+    compress = property(_get_compress)
+
+    def _get_rate_limit(self):
+        # Emails per hour; 0 means there's no limit.
+        value = float(self._get_optional_item(Config.RATE_LIMIT, 0))
+        if value < 0:
+            raise ValueError("%s can't be negative" % Config.RATE_LIMIT)
+        return value
+
+    rate_limit = property(_get_rate_limit)
+
+    def _get_rate_burst(self):
+        value = self._get_optional_item(Config.RATE_BURST, 1)
+        return max(int(value), 1)
+
+    rate_burst = property(_get_rate_burst)
+
+    def _get_aggregation_window(self):
+        value = self._get_optional_item(Config.AGGREGATION_WINDOW, 0)
+        return float(value)
+
+    aggregation_window = property(_get_aggregation_window)
+
+    def _get_send_size(self):
+        # In kilobytes in the config file, like max_messagestore.
+        value = self._get_optional_item(Config.SEND_SIZE, 0)
+        return int(value) * 1024
+
+    send_size = property(_get_send_size)
+
+    def _get_send_age(self):
+        value = self._get_optional_item(Config.SEND_AGE, 0)
+        return float(value)
+
+    send_age = property(_get_send_age)
+
+
+class Digest(object):
+
+    # Summarises log messages by counting how often each one turns up
+    # once the parts that change from line to line (the date, the pid
+    # and any numbers) are taken out. The lines are seen one at a time
+    # and at most max_templates are remembered, so the memory used
+    # doesn't depend on how many lines there are; messages that turn
+    # up once the limit is reached are only counted.
+
+    NUMBER = re.compile(r"\b0x[0-9a-fA-F]+\b|\d+")
+    MAX_EXAMPLE_LENGTH = 500
+
+    def __init__(self, max_templates):
+        self.max_templates = max_templates
+        self.templates = {}
+        self.lines = 0
+        self.others = None
+
+    def get_template(self, line):
+        """Return the (date, template) for a line"""
+        line = line.rstrip("\n")
+        match = hacksaw.lib.LogMessage.pattern.match(line)
+        if match is None:
+            return None, ("", "", Digest.NUMBER.sub("#", line))
+        date, hostname, process, text = match.groups()
+        program = process.split("[", 1)[0]
+        return date, (hostname, program, Digest.NUMBER.sub("#", text))
+
+    def _update(self, entry, date):
+        entry[0] += 1
+        if date is not None:
+            if entry[1] is None:
+                entry[1] = date
+            entry[2] = date
+
+    def add(self, line):
+        self.lines += 1
+        date, template = self.get_template(line)
+        entry = self.templates.get(template)
+        if entry is None:
+            if len(self.templates) >= self.max_templates:
+                if self.others is None:
+                    self.others = [0, None, None]
+                self._update(self.others, date)
+                return
+            example = line.rstrip("\n")[:Digest.MAX_EXAMPLE_LENGTH]
+            entry = self.templates[template] = [0, None, None, example]
+        self._update(entry, date)
+
+    def add_file(self, file_obj):
+        for line in file_obj:
+            self.add(line)
+
+    def _format_entry(self, entry, description):
+        count, first, last = entry[:3]
+        return "%7d  %-15s  %-15s  %s\n" % (count, first or "-", last or "-",
+                                            description)
+
+    def format(self):
+        """Return the digest as text, most common messages first"""
+        entries = [(-entry[0], template, entry)
+                   for template, entry in self.templates.iteritems()]
+        entries.sort()
+        lines = ["%d lines, %d distinct messages\n\n" %
+                 (self.lines, len(self.templates)),
+                 "%7s  %-15s  %-15s  %s\n" %
+                 ("Count", "First seen", "Last seen", "Message")]
+        for count, (hostname, program, text), entry in entries:
+            if hostname:
+                description = "%s %s: %s" % (hostname, program, text)
+            else:
+                description = text
+            lines.append(self._format_entry(entry, description))
+            lines.append("%7s  e.g. %s\n" % ("", entry[3]))
+        if self.others is not None:
+            lines.append(self._format_entry(
+                self.others, "(other messages, over the limit of %d)" %
+                self.max_templates))
+        return "".join(lines)
+
+
+class CommandTransport(object):
+
+    # Sends each message by running the mail command and writing the
+    # message to its standard input.
+
+    def __init__(self, command):
+        self.command = command
+
+    def send(self, sender, recipients, write_message):
+        """Send the message that write_message writes to a file object.
+
+        Returns None if the message was sent, and something else if it
+        wasn't.
+
+        """
+        fd = os.popen(self.command, 'w')
+        try:
+            write_message(fd)
+        finally:
+            rval = fd.close()
+        if rval is not None:
+            sys.stderr.write('Error: sendmail returned %s\n' % rval)
+        return rval
+
+    def close(self):
+        pass
+
+
+class DataWriter(object):
+
+    # Writes a message to an SMTP server after the DATA command, a
+    # piece at a time. smtplib can only quote a whole message at once,
+    # so we convert line endings to CRLF and double the dots at the
+    # start of lines ourselves, remembering where we got to between
+    # pieces.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._line_start = True
+        self._carriage_return = False
+
+    def write(self, data):
+        if self._carriage_return:
+            data = "\r" + data
+            self._carriage_return = False
+        if data.endswith("\r"):
+            data = data[:-1]
+            self._carriage_return = True
+        if not data:
+            return
+        data = data.replace("\r\n", "\n").replace("\r", "\n")
+        if self._line_start and data.startswith("."):
+            data = "." + data
+        self._line_start = data.endswith("\n")
+        self.sock.sendall(data.replace("\n.", "\n..").replace("\n", "\r\n"))
+
+    def close(self):
+        if self._carriage_return:
+            self.write("\n")
+        end = ".\r\n"
+        if not self._line_start:
+            end = "\r\n" + end
+        self.sock.sendall(end)
+
+
+class SMTPTransport(object):
+
+    # Sends messages to an SMTP server over a single connection, which
+    # is opened when the first message is sent and kept open for the
+    # rest. If the server supports pipelining, the envelope commands
+    # are all sent before any of the replies are read. Temporary
+    # failures (4xx replies, dropped connections and servers that stop
+    # answering for TIMEOUT seconds) are retried, with the delay
+    # doubling after each attempt.
+
+    TIMEOUT = 60
+
+    def __init__(self, host, port, retries, retry_delay):
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._smtp = None
+
+    def _get_connection(self):
+        if self._smtp is None:
+            smtp = smtplib.SMTP(timeout=SMTPTransport.TIMEOUT)
+            smtp.connect(self.host, self.port)
+            smtp.ehlo_or_helo_if_needed()
+            self._smtp = smtp
+        return self._smtp
+
+    def _send_envelope(self, smtp, sender, recipients):
+        commands = ["mail FROM:%s" % smtplib.quoteaddr(sender)]
+        for recipient in recipients:
+            commands.append("rcpt TO:%s" % smtplib.quoteaddr(recipient))
+        commands.append("data")
+        expected = [(250,)] + [(250, 251)] * len(recipients) + [(354,)]
+        error = None
+        if smtp.does_esmtp and smtp.has_extn("pipelining"):
+            smtp.send("".join([command + "\r\n" for command in commands]))
+            replies = [smtp.getreply() for command in commands]
+        else:
+            replies = []
+            for command in commands:
+                smtp.send(command + "\r\n")
+                replies.append(smtp.getreply())
+                if replies[-1][0] not in expected[len(replies) - 1]:
+                    break
+        for (code, msg), codes in zip(replies, expected):
+            if code not in codes:
+                error = smtplib.SMTPResponseException(code, msg)
+                break
+        if error is not None:
+            if replies[-1][0] == 354:
+                # The server wants the message even though some of the
+                # envelope failed; send it an empty one and drop it.
+                smtp.send(".\r\n")
+                smtp.getreply()
+            smtp.rset()
+            raise error
+
+    def _send_once(self, sender, recipients, write_message):
+        smtp = self._get_connection()
+        self._send_envelope(smtp, sender, recipients)
+        writer = DataWriter(smtp.sock)
+        write_message(writer)
+        writer.close()
+        code, msg = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPResponseException(code, msg)
+
+    def send(self, sender, recipients, write_message):
+        """Send the message that write_message writes to a file object.
+
+        write_message may be called more than once if the message has
+        to be sent again. Returns None if the message was sent, and
+        the reason if it wasn't.
+
+        """
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                self._send_once(sender, recipients, write_message)
+                return None
+            except smtplib.SMTPResponseException, e:
+                error = "%s %s" % (e.smtp_code, e.smtp_error)
+                if e.smtp_code >= 500:
+                    break
+            except (socket.error, smtplib.SMTPException), e:
+                error = str(e) or e.__class__.__name__
+                self.close()
+            if attempt >= self.retries:
+                break
+            attempt += 1
+            time.sleep(delay)
+            delay *= 2
+        sys.stderr.write('Error: SMTP server %s returned %s\n' %
+                         (self.host, error))
+        return error
+
+    def close(self):
+        if self._smtp is not None:
+            smtp = self._smtp
+            self._smtp = None
+            try:
+                smtp.quit()
+            except (socket.error, smtplib.SMTPException):
+                smtp.close()
+
+
+def get_transport(config, transports=None):
+    """Return a transport for sending the mail for config.
+
+    SMTP transports are shared between configs that use the same
+    server by way of the transports dictionary, if one is given.
+
+    """
+    if config.smtp_host is None:
+        return CommandTransport(config.mail_command)
+    key = (config.smtp_host, config.smtp_port)
+    if transports is not None and key in transports:
+        return transports[key]
+    transport = SMTPTransport(config.smtp_host, config.smtp_port,
+                              config.smtp_retries, config.smtp_retry_delay)
+    if transports is not None:
+        transports[key] = transport
+    return transport
+
+
+class SendState(object):
+
+    # Records how a message store that's being sent was split into
+    # emails, and which of them have gone, so that a run that fails
+    # part way through can carry on without sending anything twice.
+    # The file starts with a line naming the store it belongs to
+    # ("store <inode> <size>"), so that a file left behind from an
+    # earlier store is ignored. That's followed by a line for each
+    # email ("chunk <start> <end>", giving its offsets in the store),
+    # and then by a line for each email that has been sent ("sent
+    # <index>").
+
+    def __init__(self, path, store):
+        self.path = path
+        self.store = store  # the (inode, size) of the store
+        self.chunks = []
+        self.sent = set()
+
+    def load(self):
+        """Read the state file, returning False if there isn't one.
+
+        A state file that was written for a different store doesn't
+        count.
+
+        """
+        try:
+            file_obj = file(self.path, "r")
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        store = None
+        chunks = []
+        sent = set()
+        try:
+            for line in file_obj:
+                words = line.split()
+                if len(words) == 3 and words[0] == "store":
+                    store = (int(words[1]), int(words[2]))
+                elif len(words) == 3 and words[0] == "chunk":
+                    chunks.append((int(words[1]), int(words[2])))
+                elif len(words) == 2 and words[0] == "sent":
+                    sent.add(int(words[1]))
+        finally:
+            file_obj.close()
+        if store != self.store:
+            return False
+        self.chunks = chunks
+        self.sent = sent
+        return True
+
+    def _write(self, lines, mode="a"):
+        file_obj = file(self.path, mode)
+        try:
+            file_obj.write("".join(lines))
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        finally:
+            file_obj.close()
+
+    def create(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = set()
+        self._write(["store %d %d\n" % self.store] +
+                    ["chunk %d %d\n" % chunk for chunk in self.chunks], "w")
+
+    def mark_sent(self, index):
+        self._write(["sent %d\n" % index])
+        self.sent.add(index)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def plan_chunks(file_obj, limit):
+    """Split a file at line boundaries into (start, end) chunks.
+
+    Each chunk holds at most limit bytes, unless it's a single line
+    that is longer than that on its own.
+
+    """
+    chunks = []
+    start = offset = 0
+    file_obj.seek(0)
+    for line in file_obj:
+        if offset > start and offset + len(line) - start > limit:
+            chunks.append((start, offset))
+            start = offset
+        offset += len(line)
+    if offset > start:
+        chunks.append((start, offset))
+    return chunks
+
+
+def _get_compressor():
+    # A window size of 31 makes zlib write a gzip header and trailer.
+    return zlib.compressobj(GzipEncoder.COMPRESS_LEVEL, zlib.DEFLATED, 31)
+
+
+def _get_blocks(file_obj, block_size):
+    # Yield the file's lines, joined into blocks of about block_size.
+    file_obj.seek(0)
+    lines = []
+    length = 0
+    for line in file_obj:
+        lines.append(line)
+        length += len(line)
+        if length >= block_size:
+            yield "".join(lines)
+            lines = []
+            length = 0
+    if lines:
+        yield "".join(lines)
+
+
+def _compress_block(compressor, block):
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def plan_compressed_chunks(file_obj, limit):
+    """Split a file at line boundaries into chunks that gzip to limit.
+
+    Lines are compressed a block at a time, flushing after each block
+    to find out how big the output is so far; the flushes only make it
+    bigger, so the chunks come out a little under the limit when they
+    are compressed in one go. A block that doesn't fit starts a new
+    chunk, so a single block can go over the limit if it doesn't
+    compress at all.
+
+    """
+    chunks = []
+    start = offset = 0
+    size = GzipEncoder.OVERHEAD
+    compressor = _get_compressor()
+    block_size = max(min(GzipEncoder.BLOCK_SIZE, limit), 1)
+    for block in _get_blocks(file_obj, block_size):
+        data = _compress_block(compressor, block)
+        if offset > start and size + len(data) > limit:
+            chunks.append((start, offset))
+            start = offset
+            compressor = _get_compressor()
+            data = _compress_block(compressor, block)
+            size = GzipEncoder.OVERHEAD
+        size += len(data)
+        offset += len(block)
+    if offset > start:
+        chunks.append((start, offset))
+    return chunks
+
+
+class GzipEncoder(object):
+
+    # Gzips what's written to it and writes it on to a stream in
+    # base64, a line at a time, so that a compressed attachment can be
+    # streamed into a message in the same way as a plain one.
+
+    COMPRESS_LEVEL = 6
+    BLOCK_SIZE = 64 * 1024
+    LINE_LENGTH = 57  # bytes of data in each 76 character line
+    OVERHEAD = 20  # gzip header and trailer, and the final block
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._compressor = _get_compressor()
+        self._pending = ""
+        self._separator = ""
+
+    def _encode(self, final=False):
+        end = len(self._pending)
+        if not final:
+            end -= end % GzipEncoder.LINE_LENGTH
+        lines = []
+        for start in range(0, end, GzipEncoder.LINE_LENGTH):
+            data = self._pending[start:start + GzipEncoder.LINE_LENGTH]
+            lines.append(self._separator + base64.b64encode(data))
+            self._separator = "\n"
+        self._pending = self._pending[end:]
+        if lines:
+            self.stream.write("".join(lines))
+
+    def write(self, data):
+        self._pending += self._compressor.compress(data)
+        if len(self._pending) >= GzipEncoder.LINE_LENGTH:
+            self._encode()
+
+    def close(self):
+        self._pending += self._compressor.flush()
+        self._encode(final=True)
+
+
+class Throttle(object):
+
+    # Limits how often mail is sent with a token bucket that holds up
+    # to burst tokens and gains rate of them an hour; each email takes
+    # one. It can also hold back a new message store until window
+    # seconds after we first saw it, so that the messages from a burst
+    # of activity go out together. Each run of the sender is a new
+    # process, so the state is kept in a file, which is locked while
+    # the sender runs so that two senders can't both spend the same
+    # tokens.
+
+    def __init__(self, path, rate, burst, window):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.tokens = float(burst)
+        self.updated = None
+        self.pending_since = None
+        self._file = None
+
+    def _read(self, now):
+        self._file.seek(0)
+        words = self._file.read().split()
+        try:
+            self.tokens = float(words[0])
+            self.updated = float(words[1])
+            if words[2] != "-":
+                self.pending_since = float(words[2])
+        except (IndexError, ValueError):
+            self.tokens = float(self.burst)
+            self.updated = now
+            self.pending_since = None
+
+    def load(self, now):
+        """Lock and read the state file, adding the tokens due since"""
+        self._file = file(self.path, "a+")
+        fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX)
+        self._read(now)
+        if now > self.updated:
+            self.tokens += (now - self.updated) * self.rate / 3600
+        self.tokens = min(self.tokens, self.burst)
+        self.updated = now
+
+    def save(self):
+        """Write the state file back and unlock it"""
+        pending_since = "-"
+        if self.pending_since is not None:
+            pending_since = "%f" % self.pending_since
+        try:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write("%f %f %s\n" % (self.tokens, self.updated,
+                                              pending_since))
+            self._file.flush()
+        finally:
+            self._file.close()
+            self._file = None
+
+    def can_send(self):
+        return self.rate == 0 or self.tokens >= 1
+
+    def take(self):
+        """Take a token for an email, returning False if there isn't one"""
+        if not self.can_send():
+            return False
+        if self.rate:
+            self.tokens -= 1
+        return True
+
+    def window_has_passed(self, now):
+        """Return True if a new message store may be sent now"""
+        if self.pending_since is None:
+            self.pending_since = now
+        return now - self.pending_since >= self.window
+
+    def reset_window(self):
+        self.pending_since = None
+
 
 class MessageSender(object):
 
-    def __init__(self, config):
+    CHUNK_SIZE = 64 * 1024
+    PLACEHOLDER = "@@hacksaw-log-messages@@"
+    THROTTLED = "throttled"
+    BUSY = "busy"
+
+    def __init__(self, config, transport=None, store_lock=None):
         self.config = config
+        self._transport = transport
+        self._store_lock = store_lock
+        self.throttle = None
+
+    def _get_transport(self):
+        if self._transport is None:
+            self._transport = get_transport(self.config)
+        return self._transport
+
+    transport = property(_get_transport)
 
     def addresses_are_valid(self):
         for recipient in self.config.recipients:
@@ -100,50 +822,308 @@ class MessageSender(object):
                 return False
         return True
 
-    def _get_log_attachment(self):
-        log_messages = file(self.config.message_store, "r").read()
-        message = email.MIMEText.MIMEText(log_messages)
-        message.add_header('Content-Disposition', 'attachment',
-                           filename='logs.txt')
-        return message
-         
-    def _get_message(self):
+    def _get_sending_path(self):
+        return self.config.message_store + ".sending"
+
+    sending_path = property(_get_sending_path)
+
+    def _get_message(self, filename, subject):
+        # The log messages are left out, as they're streamed straight
+        # from the message store into the mail command (see
+        # _write_message()).
+        if self.config.compress:
+            attachment = email.MIMEBase.MIMEBase('application', 'gzip')
+            attachment.set_payload(MessageSender.PLACEHOLDER)
+            attachment['Content-Transfer-Encoding'] = 'base64'
+            filename += '.gz'
+        else:
+            attachment = email.MIMEText.MIMEText(MessageSender.PLACEHOLDER)
+        attachment.add_header('Content-Disposition', 'attachment',
+                              filename=filename)
         message = email.MIMEBase.MIMEBase('multipart', 'mixed')
         message.epilogue = "" # guarantees ends in new line
         message["From"] = self.config.sender
         message["To"] = ', '.join(self.config.recipients)
-        message["Subject"] = self.config.subject
-        message.attach(self._get_log_attachment())
+        message["Subject"] = subject
+        message.attach(attachment)
         return message
 
-    def send_message_too_large_error(self):
-        message = email.MIMEBase.MIMEBase('text', 'plain')
-        message.epilogue = "" # guarantees ends in new line
-        message["From"] = self.config.sender
-        message["To"] = ', '.join(self.config.recipients)
-        message["Subject"] = "Hacksaw error: Message store is too large"
-        message_str = message.as_string(unixfrom=0)
-        fd = os.popen(self.config.mail_command, 'w')
-        fd.write(message_str)
-        rval = fd.close()
+    def _write_message(self, stream, store, filename, subject, start, end):
+        # Copies the part of the store between start and end into the
+        # message.
+        message = self._get_message(filename, subject).as_string(unixfrom=0)
+        head, tail = message.split(MessageSender.PLACEHOLDER)
+        store.seek(start)
+        stream.write(head)
+        writer = stream
+        if self.config.compress:
+            writer = GzipEncoder(stream)
+        while start < end:
+            data = store.read(min(MessageSender.CHUNK_SIZE, end - start))
+            if not data:
+                break
+            writer.write(data)
+            start += len(data)
+        if self.config.compress:
+            writer.close()
+        stream.write(tail)
+
+    def _send(self, store, filename, subject, start, end):
+        def write_message(stream):
+            self._write_message(stream, store, filename, subject, start, end)
+        return self.transport.send(self.config.sender, self.config.recipients,
+                                   write_message)
+
+    def _take_store(self):
+        # Move the message store aside while holding its lock, so that
+        # the processors start a new one and nothing they write after
+        # this can be lost when we remove what we've sent.
+        if not os.path.exists(self.config.message_store):
+            return False
+        if self._store_lock is not None:
+            self._store_lock.acquire()
+        try:
+            file_obj = file(self.config.message_store, "a")
+            try:
+                fcntl.lockf(file_obj.fileno(), fcntl.LOCK_EX)
+                os.rename(self.config.message_store, self.sending_path)
+            finally:
+                file_obj.close()
+        finally:
+            if self._store_lock is not None:
+                self._store_lock.release()
+        return True
+
+    def _finish(self, state):
+        # The state goes first: a crash in between must not leave it
+        # behind for the next store.
+        state.remove()
+        os.remove(self.sending_path)
+
+    def send_chunks(self, store, state, filename):
+        # Each email holds as many whole lines as fit within
+        # max_messagestore (once compressed, if we're compressing). The
+        # store is copied to the mail command a chunk at a time, so
+        # however big it gets we only ever hold one chunk of it.
+        if not state.load():
+            limit = self.config.max_message_store * 1024
+            if self.config.compress:
+                state.create(plan_compressed_chunks(store, limit))
+            else:
+                state.create(plan_chunks(store, limit))
+        count = len(state.chunks)
+        for index, (start, end) in enumerate(state.chunks):
+            if index in state.sent:
+                continue
+            if self.throttle is not None and not self.throttle.take():
+                return MessageSender.THROTTLED
+            subject = self.config.subject
+            if count > 1:
+                subject = "%s (%d of %d)" % (subject, index + 1, count)
+            rval = self._send(store, filename, subject, start, end)
+            if rval is not None:
+                return rval
+            state.mark_sent(index)
+        return None
+
+    def send_digest(self, store, state):
+        # The digest of a store always comes out the same, so if it has
+        # to be split it can be resumed in the same way as the store.
+        digest = Digest(self.config.digest_max_templates)
+        digest.add_file(store)
+        return self.send_chunks(cStringIO.StringIO(digest.format()), state,
+                                'digest.txt')
+
+    def _send_store(self):
+        store = file(self.sending_path, "r")
+        try:
+            stat = os.fstat(store.fileno())
+            state = SendState(self.sending_path + ".state",
+                              (stat.st_ino, stat.st_size))
+            if self.config.digest:
+                rval = self.send_digest(store, state)
+            else:
+                rval = self.send_chunks(store, state, 'logs.txt')
+        finally:
+            store.close()
         if rval is None:
-            pass
-        else:
-            sys.stderr.write('Error: sendmail returned %s\n' % rval)
+            self._finish(state)
         return rval
 
+    def _get_throttle(self):
+        if not self.config.rate_limit and not self.config.aggregation_window:
+            return None
+        return Throttle(self.config.message_store + ".throttle",
+                        self.config.rate_limit, self.config.rate_burst,
+                        self.config.aggregation_window)
+
+    def _send_messages(self, now):
+        # A store that we didn't finish sending last time is sent
+        # first, carrying on where we left off. While we're throttled,
+        # new messages collect in the message store until the next
+        # time we're allowed to send.
+        if os.path.exists(self.sending_path):
+            rval = self._send_store()
+            if rval is not None:
+                return rval
+        if not os.path.exists(self.config.message_store):
+            return None
+        if self.throttle is not None:
+            if not self.throttle.can_send() or \
+                   not self.throttle.window_has_passed(now):
+                return MessageSender.THROTTLED
+            self.throttle.reset_window()
+        if not self._take_store():
+            return None
+        return self._send_store()
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    def _lock_sender(self):
+        # Only one sender may work on a message store at once, or they
+        # could both send what was left over from last time.
+        file_obj = file(self.config.message_store + ".lock", "a")
+        try:
+            fcntl.lockf(file_obj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            file_obj.close()
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return None
+            raise
+        return file_obj
+
+    def _send_throttled(self, now):
+        self.throttle = self._get_throttle()
+        if self.throttle is None:
+            return self._send_messages(now)
+        self.throttle.load(now)
+        try:
+            return self._send_messages(now)
+        finally:
+            self.throttle.save()
+            self.throttle = None
+
     def send_message(self):
-        message = self._get_message().as_string(unixfrom=0)
-        if len(message) > self.config.max_message_store * 1024:
-            return self.send_message_too_large_error()
-        fd = os.popen(self.config.mail_command, 'w')
-        fd.write(message)
-        rval = fd.close()
-        if rval is None:
-            os.remove(self.config.message_store)
-        else:
-            sys.stderr.write('Error: sendmail returned %s\n' % rval)
-        return rval
+        """Send the message store, returning None if it all went.
+
+        Returns THROTTLED if some or all of it has been held back by
+        the rate limit or aggregation window, to be sent next time,
+        and BUSY if another sender is already sending it.
+
+        """
+        lock_file = self._lock_sender()
+        if lock_file is None:
+            return MessageSender.BUSY
+        try:
+            return self._send_throttled(time.time())
+        finally:
+            lock_file.close()
+
+
+class BackgroundSender(object):
+
+    # Sends the message store from a background thread once it gets to
+    # send_size bytes or has been waiting for send_age seconds, so that
+    # the processor never waits for mail to be sent. The processor
+    # tells us about each write; the age of a store is counted from the
+    # first write we hear about to it, and is checked every so often
+    # while nothing is being written. Requests made while we're
+    # sending are merged into one. Writes made while we're sending go
+    # to a new store, which is sent next.
+
+    CHECK_INTERVAL = 10
+
+    def __init__(self, config, store_lock):
+        self.config = config
+        self._store_lock = store_lock
+        self._state_lock = threading.Lock()  # guards _store and _size
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._store = None
+        self._started = None
+        self._size = 0
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def note_write(self, stat):
+        """Record a write to the store, given its os.fstat() result"""
+        if self._thread is None:
+            self._start()
+        store = (stat.st_dev, stat.st_ino)
+        self._state_lock.acquire()
+        try:
+            if store != self._store:
+                self._store = store
+                self._started = time.time()
+            self._size = stat.st_size
+        finally:
+            self._state_lock.release()
+        if self._is_due():
+            self._wakeup.set()
+
+    def _is_due(self):
+        if self._started is None or not self._size:
+            return False
+        if self.config.send_size and self._size >= self.config.send_size:
+            return True
+        return bool(self.config.send_age) and \
+               time.time() - self._started >= self.config.send_age
+
+    def _get_timeout(self):
+        if self.config.send_age:
+            return min(BackgroundSender.CHECK_INTERVAL, self.config.send_age)
+        return BackgroundSender.CHECK_INTERVAL
+
+    def send(self):
+        sender = MessageSender(self.config, store_lock=self._store_lock)
+        try:
+            try:
+                return sender.send_message()
+            except Exception:
+                traceback.print_exc()
+                return False
+        finally:
+            sender.close()
+
+    def _send_if_due(self):
+        if not self._is_due():
+            return
+        self._state_lock.acquire()
+        try:
+            store = self._store
+        finally:
+            self._state_lock.release()
+        if self.send() is not None:
+            return  # we'll try again the next time we check
+        # Only forget the store we sent. If a write to a new store was
+        # noted while we were sending, it still counts.
+        self._state_lock.acquire()
+        try:
+            if self._store == store:
+                self._size = 0
+        finally:
+            self._state_lock.release()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._get_timeout())
+            self._wakeup.clear()
+            if self._stopping:
+                break
+            self._send_if_due()
+
+    def close(self):
+        if self._thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
 
 
 class Usage(Exception):
@@ -155,17 +1135,25 @@ class Usage(Exception):
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
+    # Configs that send through the same SMTP server share one
+    # connection to it.
+    transports = {}
     try:
         try:
-            config_file = argv[0]
-        except IndexError:
-            raise Usage
-        config = Config(config_file)
-        sender = MessageSender(config)
-        sender.send_message()
+            if not argv:
+                raise Usage("no config files specified")
+            for config_file in argv:
+                try:
+                    config = Config(config_file).compile()
+                    sender = MessageSender(config,
+                                           get_transport(config, transports))
+                    sender.send_message()
+                except Exception, e:
+                    print >>sys.stderr, e
+        finally:
+            for transport in transports.values():
+                transport.close()
     except Usage, e:
         print >>sys.stderr, e.msg
         return 2
-    except Exception, e:
-        print >>sys.stderr, e
     return 0
@@ -2,11 +2,16 @@
 # (C) Cmed Ltd, 2004
 
 
+import cStringIO
+import email
 import os
 import shutil
+import SocketServer
 import sys
+import threading
 import time
 import unittest
+import zlib
 
 from pmock import *
 
@@ -40,6 +45,13 @@ class ProcessorTest(MailTest):
         message_store = file(self.config.message_store, "r")
         self.assert_(message_store.read(), "Test message\n")
 
+    def test_write_batch(self):
+        """Check that we write a batch of log messages in one go"""
+        processor = hacksaw.proc.mail.Processor(self.config)
+        processor.handle_messages(["Message 1\n", "Message 2\n"])
+        contents = file(self.config.message_store, "r").read()
+        self.assertEqual(contents, "Message 1\nMessage 2\n")
+
     def test_can_lock(self):
         """Check we can lock the message store"""
         processor = hacksaw.proc.mail.Processor(self.config)
@@ -79,6 +91,84 @@ else:
         processor.handle_message("Test message")
         mock.verify()
 
+    def wait_for_mail(self, path):
+        for i in range(100):
+            if os.path.exists(path) and \
+                   not os.path.exists(MailTest.MESSAGE_STORE + ".sending"):
+                return file(path).read()
+            time.sleep(0.05)
+        self.fail("nothing was sent")
+
+    def test_no_background_sender(self):
+        """Check we don't send mail ourselves unless we're asked to"""
+        processor = hacksaw.proc.mail.Processor(self.config)
+        self.assertEqual(processor.sender, None)
+
+    def test_send_when_large(self):
+        """Check we send the store once it gets to send_size"""
+        sent = os.path.join(os.path.dirname(MailTest.MESSAGE_STORE), "sent")
+        self.append_to_file("sender: wilber@cmedltd.com")
+        self.append_to_file("recipients: gteale@cmedltd.com")
+        self.append_to_file("subject: Hacksaw e-mail")
+        self.append_to_file("mailcommand: cat > %s" % sent)
+        self.append_to_file("max_messagestore: 1024")
+        self.append_to_file("send_size: 1")
+        self.read_config()
+        processor = hacksaw.proc.mail.Processor(self.config)
+        try:
+            processor.handle_messages(["Small Message\n"])
+            time.sleep(0.1)
+            self.failIf(os.path.exists(sent))
+            processor.handle_messages(["Message %d\n" % i
+                                       for i in range(100)])
+            mail = self.wait_for_mail(sent)
+        finally:
+            processor.close()
+        self.assert_("Small Message\nMessage 0\n" in mail)
+        self.failIf(os.path.exists(MailTest.MESSAGE_STORE))
+
+    def test_send_when_old(self):
+        """Check we send the store once it's been waiting send_age"""
+        sent = os.path.join(os.path.dirname(MailTest.MESSAGE_STORE), "sent")
+        self.append_to_file("sender: wilber@cmedltd.com")
+        self.append_to_file("recipients: gteale@cmedltd.com")
+        self.append_to_file("subject: Hacksaw e-mail")
+        self.append_to_file("mailcommand: cat > %s" % sent)
+        self.append_to_file("max_messagestore: 1024")
+        self.append_to_file("send_age: 0.2")
+        self.read_config()
+        processor = hacksaw.proc.mail.Processor(self.config)
+        try:
+            processor.handle_messages(["Old Message\n"])
+            mail = self.wait_for_mail(sent)
+            processor.handle_messages(["New Message\n"])
+        finally:
+            processor.close()
+        self.assert_("Old Message\n" in mail)
+        self.failIf("New Message" in mail)
+        self.assertEqual(file(MailTest.MESSAGE_STORE).read(), "New Message\n")
+
+    def test_write_while_sending(self):
+        """Check a write noted while the store is being sent isn't lost"""
+        self.append_to_file("send_size: 1")
+        self.read_config()
+        background = hacksaw.proc.mail.BackgroundSender(self.config, None)
+        background._thread = threading.currentThread()  # don't start one
+        class Stat(object):
+            def __init__(self, inode, size):
+                self.st_dev = 1
+                self.st_ino = inode
+                self.st_size = size
+        def send():
+            background.note_write(Stat(2, 2048))
+        background.send = send
+        background.note_write(Stat(1, 2048))
+        background._send_if_due()
+        self.assert_(background._is_due())
+        background.send = lambda: None
+        background._send_if_due()
+        self.failIf(background._is_due())
+
     def test_lock_timeout(self):
         """Check the lock attempt times out"""
         mock_time = Mock()
@@ -144,6 +234,202 @@ class ConfigTest(MailTest):
         self.read_config()
         self.assertEqual(self.config.max_message_store, max_message_store)
 
+    def test_get_digest(self):
+        """Check we can turn on digest mode"""
+        self.failIf(self.config.digest)
+        self.append_to_file("digest: yes")
+        self.read_config()
+        self.assert_(self.config.digest)
+
+    def test_get_digest_max_templates(self):
+        """Check we can limit the number of messages in a digest"""
+        self.assertEqual(self.config.digest_max_templates,
+                         hacksaw.proc.mail.Config.DEFAULT_DIGEST_MAX_TEMPLATES)
+        self.append_to_file("digest_max_templates: 50")
+        self.read_config()
+        self.assertEqual(self.config.digest_max_templates, 50)
+
+    def test_get_compress(self):
+        """Check we can turn on compressed attachments"""
+        self.failIf(self.config.compress)
+        self.append_to_file("compress: yes")
+        self.read_config()
+        self.assert_(self.config.compress)
+
+    def test_get_rate_limit(self):
+        """Check we can read the rate limit and aggregation window"""
+        self.assertEqual(self.config.rate_limit, 0)
+        self.assertEqual(self.config.rate_burst, 1)
+        self.assertEqual(self.config.aggregation_window, 0)
+        self.append_to_file("rate_limit: 6")
+        self.append_to_file("rate_burst: 3")
+        self.append_to_file("aggregation_window: 300")
+        self.read_config()
+        self.assertEqual(self.config.rate_limit, 6)
+        self.assertEqual(self.config.rate_burst, 3)
+        self.assertEqual(self.config.aggregation_window, 300)
+
+    def test_get_smtp_options(self):
+        """Check we can read the SMTP server's details"""
+        self.assertEqual(self.config.smtp_host, None)
+        self.assertEqual(self.config.smtp_port, 25)
+        self.append_to_file("smtphost: mail.example.com")
+        self.append_to_file("smtpport: 2525")
+        self.append_to_file("smtp_retries: 5")
+        self.append_to_file("smtp_retry_delay: 0.5")
+        self.read_config()
+        self.assertEqual(self.config.smtp_host, "mail.example.com")
+        self.assertEqual(self.config.smtp_port, 2525)
+        self.assertEqual(self.config.smtp_retries, 5)
+        self.assertEqual(self.config.smtp_retry_delay, 0.5)
+
+
+class DigestTest(unittest.TestCase):
+
+    LINES = ["Jun  1 02:00:00 host1 sshd[123]: Failed password from 10.0.0.1\n",
+             "Jun  1 02:00:05 host1 sshd[456]: Failed password from 10.0.0.2\n",
+             "Jun  1 02:01:00 host2 CRON[789]: (root) CMD (backup)\n",
+             "Jun  1 02:09:30 host1 sshd[124]: Failed password from 10.0.0.9\n",
+             "Not a syslog message\n"]
+
+    def test_template(self):
+        """Check the date, pid and numbers are taken out of a message"""
+        digest = hacksaw.proc.mail.Digest(10)
+        self.assertEqual(digest.get_template(DigestTest.LINES[0]),
+                         ("Jun  1 02:00:00",
+                          ("host1", "sshd", "Failed password from #.#.#.#")))
+        self.assertEqual(digest.get_template("Restarted 3 times\n"),
+                         (None, ("", "", "Restarted # times")))
+
+    def test_group(self):
+        """Check we count each template, remembering when it was seen"""
+        digest = hacksaw.proc.mail.Digest(10)
+        for line in DigestTest.LINES:
+            digest.add(line)
+        self.assertEqual(digest.lines, 5)
+        self.assertEqual(len(digest.templates), 3)
+        template = ("host1", "sshd", "Failed password from #.#.#.#")
+        self.assertEqual(digest.templates[template],
+                         [3, "Jun  1 02:00:00", "Jun  1 02:09:30",
+                          DigestTest.LINES[0].rstrip()])
+
+    def test_bounded(self):
+        """Check we stop remembering new templates at the limit"""
+        digest = hacksaw.proc.mail.Digest(2)
+        for line in DigestTest.LINES:
+            digest.add(line)
+        self.assertEqual(len(digest.templates), 2)
+        self.assertEqual(digest.others, [1, None, None])
+        self.assert_("other messages" in digest.format())
+
+    def test_format(self):
+        """Check the most common messages come first, with an example"""
+        digest = hacksaw.proc.mail.Digest(10)
+        for line in DigestTest.LINES:
+            digest.add(line)
+        lines = digest.format().splitlines()
+        self.assertEqual(lines[0], "5 lines, 3 distinct messages")
+        self.assertEqual(lines[3].split()[0], "3")
+        self.assert_(lines[3].endswith("host1 sshd: Failed password from "
+                                       "#.#.#.#"))
+        self.assertEqual(lines[4].strip(),
+                         "e.g. " + DigestTest.LINES[0].rstrip())
+
+
+class ThrottleTest(unittest.TestCase):
+
+    PATH = "./test.throttle"
+
+    def setUp(self):
+        if os.path.exists(ThrottleTest.PATH):
+            os.remove(ThrottleTest.PATH)
+
+    def tearDown(self):
+        if os.path.exists(ThrottleTest.PATH):
+            os.remove(ThrottleTest.PATH)
+
+    def get_throttle(self, now, rate=60, burst=2, window=0):
+        throttle = hacksaw.proc.mail.Throttle(ThrottleTest.PATH, rate, burst,
+                                              window)
+        throttle.load(now)
+        return throttle
+
+    def test_burst(self):
+        """Check we can send a burst of emails and no more"""
+        throttle = self.get_throttle(1000)
+        self.assert_(throttle.take())
+        self.assert_(throttle.take())
+        self.failIf(throttle.take())
+        throttle.save()
+
+    def test_refill(self):
+        """Check the tokens come back over time, across runs"""
+        throttle = self.get_throttle(1000)
+        throttle.take()
+        throttle.take()
+        throttle.save()
+        throttle = self.get_throttle(1030)
+        self.failIf(throttle.can_send())
+        throttle.save()
+        throttle = self.get_throttle(1060)
+        self.assert_(throttle.take())
+        self.failIf(throttle.can_send())
+        throttle.save()
+        throttle = self.get_throttle(100000)
+        self.assertEqual(throttle.tokens, 2)
+        throttle.save()
+
+    def test_no_limit(self):
+        """Check a rate of 0 means there's no limit"""
+        throttle = self.get_throttle(1000, rate=0)
+        for i in range(10):
+            self.assert_(throttle.take())
+        throttle.save()
+
+    def test_window(self):
+        """Check a new store is held back until the window has passed"""
+        throttle = self.get_throttle(1000, window=60)
+        self.failIf(throttle.window_has_passed(1000))
+        throttle.save()
+        throttle = self.get_throttle(1030, window=60)
+        self.failIf(throttle.window_has_passed(1030))
+        throttle.save()
+        throttle = self.get_throttle(1060, window=60)
+        self.assert_(throttle.window_has_passed(1060))
+        throttle.reset_window()
+        throttle.save()
+        throttle = self.get_throttle(1070, window=60)
+        self.failIf(throttle.window_has_passed(1070))
+        throttle.save()
+
+    def test_bad_state_file(self):
+        """Check we start afresh if the state file can't be read"""
+        file(ThrottleTest.PATH, "w").write("rubbish\n")
+        throttle = self.get_throttle(1000)
+        self.assertEqual(throttle.tokens, 2)
+        throttle.save()
+
+
+class Pipe(object):
+
+    # Stands in for the pipe to the mail command, remembering what was
+    # written to it.
+
+    def __init__(self, rval=None):
+        self.rval = rval
+        self.writes = []
+        self.closed = False
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def close(self):
+        self.closed = True
+        return self.rval
+
+    def getvalue(self):
+        return "".join(self.writes)
+
 
 class MessageSenderTest(MailTest):
     
@@ -168,133 +454,474 @@ class MessageSenderTest(MailTest):
         sender = hacksaw.proc.mail.MessageSender(self.config)
         self.failIf(sender.addresses_are_valid())
 
-    def _setup_mock_pipe(self, file_obj):
+    def _setup_mock_pipe(self, *pipes):
         self.append_to_file('sender: wilber@cmedltd.com')
         self.append_to_file('recipients: gteale@cmedltd.com')
         self.append_to_file('subject: Hacksaw e-mail')
         self.append_to_file('mailcommand: /usr/lib/sendmail -t')
         self.read_config()
-        mock_os = Mock()
-        mock_os.expects(once()).popen(
-            eq('/usr/lib/sendmail -t'), eq('w')).will(return_value(file_obj))
-        
-        self.real_os = hacksaw.proc.mail.os
-        hacksaw.proc.mail.os = mock_os
-        return mock_os
+        self.pipes = list(pipes)
+        self.commands = []
+
+        def popen(command, mode):
+            self.commands.append((command, mode))
+            return self.pipes.pop(0)
+
+        self.real_popen = hacksaw.proc.mail.os.popen
+        hacksaw.proc.mail.os.popen = popen
 
     def _remove_mock_pipe(self):
-        hacksaw.proc.mail.os = self.real_os
+        hacksaw.proc.mail.os.popen = self.real_popen
 
-    def test_use_correct_mail_command(self):
-        """Check that the correct mail command is used to send mail"""
-        self.append_to_file("max_messagestore: 1")
-        self.read_config()
-        file_obj = Mock()
-        file_obj.expects(once()).method("close")
-        file_obj.expects(once()).method("write")
-        mock_os = self._setup_mock_pipe(file_obj)
-        mock_os.expects(once()).remove(eq(MailTest.MESSAGE_STORE))
+    def send(self, *pipes):
+        self._setup_mock_pipe(*pipes)
         try:
-            sender = hacksaw.proc.mail.MessageSender(self.config)
-            sender.send_message()
-            file_obj.verify()
-            mock_os.verify()
+            sender = hacksaw.proc.mail.MessageSender(self.config.compile())
+            return sender.send_message()
         finally:
             self._remove_mock_pipe()
+
+    def get_attachment(self, pipe):
+        message = email.message_from_string(pipe.getvalue())
+        return message.get_payload()[0]
+
+    def test_use_correct_mail_command(self):
+        """Check that the correct mail command is used to send mail"""
+        self.append_to_file("max_messagestore: 1")
+        pipe = Pipe()
+        self.send(pipe)
+        self.assertEqual(self.commands, [('/usr/lib/sendmail -t', 'w')])
+        self.assert_(pipe.closed)
         
     def test_log_attachment(self):
         """Check that the log messages are attached to the mail"""
         self.append_to_file("max_messagestore: 1")
-        self.read_config()
-        file_obj = Mock()
-        file_obj.expects(once()).close()
-        file_obj.expects(once()).write(
-            string_contains("Error: Example Message"))
-        mock_os = self._setup_mock_pipe(file_obj)
-        mock_os.expects(once()).remove(eq(MailTest.MESSAGE_STORE))
+        pipe = Pipe()
+        self.send(pipe)
+        self.assert_("Error: Example Message" in pipe.getvalue())
+
+    def test_stream_attachment(self):
+        """Check the message store is copied to the pipe in chunks"""
+        self.append_to_file("max_messagestore: 1")
+        pipe = Pipe()
+        real_chunk_size = hacksaw.proc.mail.MessageSender.CHUNK_SIZE
+        hacksaw.proc.mail.MessageSender.CHUNK_SIZE = 4
         try:
-            sender = hacksaw.proc.mail.MessageSender(self.config)
-            sender.send_message()
-            file_obj.verify()
-            mock_os.verify()
+            self.send(pipe)
         finally:
-            self._remove_mock_pipe()
+            hacksaw.proc.mail.MessageSender.CHUNK_SIZE = real_chunk_size
+        self.assert_(len(pipe.writes) > 3)
+        attachment = self.get_attachment(pipe)
+        self.assertEqual(attachment.get_filename(), "logs.txt")
+        self.assertEqual(attachment.get_payload(), "Error: Example Message\n")
+
+    def test_digest(self):
+        """Check a digest of the messages is sent in digest mode"""
+        self.append_to_file("max_messagestore: 1")
+        self.append_to_file("digest: yes")
+        file(MailTest.MESSAGE_STORE, "a").write(
+            "".join(["Error: Example Message %d\n" % i for i in range(100)]))
+        pipe = Pipe()
+        self.send(pipe)
+        attachment = self.get_attachment(pipe)
+        self.assertEqual(attachment.get_filename(), "digest.txt")
+        self.assert_("100  -" in attachment.get_payload())
+        self.assert_("Error: Example Message #" in attachment.get_payload())
+
+    def assert_all_sent(self):
+        for suffix in ("", ".sending", ".sending.state"):
+            self.failIf(os.path.exists(MailTest.MESSAGE_STORE + suffix))
 
     def test_deletion(self):
         """Check message store deleted if mail sent"""
         self.append_to_file("max_messagestore: 1")
+        self.assertEqual(self.send(Pipe(None)), None)
+        self.assert_all_sent()
+
+    def test_one_sender_at_once(self):
+        """Check we don't send while another sender is sending"""
+        self.append_to_file("max_messagestore: 1")
         self.read_config()
-        file_obj = Mock()
-        file_obj.expects(once()).method("close").will(return_value(None))
-        file_obj.expects(once()).write(
-            string_contains("Error: Example Message"))
-        mock_os = self._setup_mock_pipe(file_obj)
-        mock_os.expects(once()).remove(eq(MailTest.MESSAGE_STORE))
+        sender = hacksaw.proc.mail.MessageSender(self.config.compile())
+        code = """
+import sys
+import time
+
+import hacksaw.proc.mail
+
+config = hacksaw.proc.mail.Config("%s").compile()
+sender = hacksaw.proc.mail.MessageSender(config)
+lock_file = sender._lock_sender()
+sys.stdout.write("locked\\n")
+sys.stdout.flush()
+time.sleep(1)
+""" % self.filename
+        child = os.popen("""python -c '%s'""" % code)
         try:
-            sender = hacksaw.proc.mail.MessageSender(self.config)
-            sender.send_message()
-            file_obj.verify()
-            mock_os.verify()
+            self.assertEqual(child.readline(), "locked\n")
+            self.assertEqual(self.send(),
+                             hacksaw.proc.mail.MessageSender.BUSY)
         finally:
-            self._remove_mock_pipe()
+            child.close()
 
     def test_unsuccessful_send(self):
         """Check message store not deleted if mail not sent"""
         self.append_to_file("max_messagestore: 1")
-        self.read_config()
-        file_obj = Mock()
-        file_obj.expects(once()).method("close").will(return_value(1))
-        file_obj.expects(once()).write(
-            string_contains("Error: Example Message"))
-        mock_os = self._setup_mock_pipe(file_obj)
         sys.stderr = Mock()
         sys.stderr.expects(once()).write(string_contains("Error:"))
         try:
-            sender = hacksaw.proc.mail.MessageSender(self.config)
-            sender.send_message()
-            file_obj.verify()
-            mock_os.verify()
-            self.assert_(os.path.exists(MailTest.MESSAGE_STORE))
+            self.assertEqual(self.send(Pipe(1)), 1)
         finally:
-            self._remove_mock_pipe()
             sys.stderr = sys.__stderr__
+        sending = MailTest.MESSAGE_STORE + ".sending"
+        self.assertEqual(file(sending).read(), "Error: Example Message\n")
 
+    def test_keep_new_messages(self):
+        """Check messages logged after a failed send go out next time"""
+        self.append_to_file("max_messagestore: 1")
+        sys.stderr = Mock()
+        sys.stderr.expects(once()).write(string_contains("Error:"))
+        try:
+            self.send(Pipe(1))
+        finally:
+            sys.stderr = sys.__stderr__
+        processor = hacksaw.proc.mail.Processor(self.config.compile())
+        processor.handle_messages(["New Message\n"])
+        pipes = [Pipe(), Pipe()]
+        self.assertEqual(self.send(*pipes), None)
+        self.assertEqual([self.get_attachment(pipe).get_payload()
+                          for pipe in pipes],
+                         ["Error: Example Message\n", "New Message\n"])
+        self.failIf(os.path.exists(MailTest.MESSAGE_STORE))
+
+    def test_nothing_to_send(self):
+        """Check we don't send anything if there's no message store"""
+        os.remove(MailTest.MESSAGE_STORE)
+        self.append_to_file("max_messagestore: 1")
+        self.assertEqual(self.send(), None)
+        self.assertEqual(self.commands, [])
+
+    def write_store(self):
+        # 32 bytes a line, so each email holds 32 lines.
+        lines = ["Jun  1 02:00:%02d host sshd: %04d\n" % (i % 60, i)
+                 for i in range(100)]
+        file(MailTest.MESSAGE_STORE, "w").write("".join(lines))
+        return lines
+
+    def test_split_store(self):
+        """Check a large store is split into emails that fit the limit"""
+        self.append_to_file("max_messagestore: 1")
+        lines = self.write_store()
+        pipes = [Pipe(), Pipe(), Pipe(), Pipe(), Pipe()]
+        self.assertEqual(self.send(*pipes), None)
+        self.assertEqual(len(self.pipes), 1)
+        attachments = [self.get_attachment(pipe) for pipe in pipes[:-1]]
+        for attachment in attachments:
+            self.assert_(len(attachment.get_payload()) <= 1024)
+        self.assertEqual("".join([attachment.get_payload()
+                                  for attachment in attachments]),
+                         "".join(lines))
+        message = email.message_from_string(pipes[0].getvalue())
+        self.assertEqual(message["Subject"], "Hacksaw e-mail (1 of 4)")
+        self.assert_all_sent()
+
+    def test_resume(self):
+        """Check we don't send a chunk twice after a failure"""
+        self.append_to_file("max_messagestore: 1")
+        lines = self.write_store()
+        first = [Pipe(), Pipe(1)]
+        sys.stderr = Mock()
+        sys.stderr.expects(once()).write(string_contains("Error:"))
+        try:
+            self.assertEqual(self.send(*first), 1)
+        finally:
+            sys.stderr = sys.__stderr__
+        second = [Pipe(), Pipe(), Pipe()]
+        self.assertEqual(self.send(*second), None)
+        subjects = [email.message_from_string(pipe.getvalue())["Subject"]
+                    for pipe in second]
+        self.assertEqual(subjects, ["Hacksaw e-mail (2 of 4)",
+                                    "Hacksaw e-mail (3 of 4)",
+                                    "Hacksaw e-mail (4 of 4)"])
+        self.assertEqual("".join([self.get_attachment(pipe).get_payload()
+                                  for pipe in first[:1] + second]),
+                         "".join(lines))
+
+    def test_stale_state(self):
+        """Check a state file left by an earlier store is ignored"""
+        self.append_to_file("max_messagestore: 1")
+        lines = self.write_store()
+        self.assertEqual(self.send(Pipe(), Pipe(), Pipe(), Pipe()), None)
+        # As if we crashed after sending the last store but before
+        # removing its state.
+        file(MailTest.MESSAGE_STORE + ".sending.state", "w").write(
+            "store 0 0\nchunk 0 1024\nsent 0\n")
+        file(MailTest.MESSAGE_STORE, "w").write(lines[0])
+        pipe = Pipe()
+        self.assertEqual(self.send(pipe), None)
+        self.assertEqual(self.get_attachment(pipe).get_payload(), lines[0])
+        self.assert_all_sent()
+
+    def test_compressed_attachment(self):
+        """Check the messages can be sent gzipped"""
+        self.append_to_file("max_messagestore: 1")
+        self.append_to_file("compress: yes")
+        lines = self.write_store()
+        pipe = Pipe()
+        self.send(pipe)
+        attachment = self.get_attachment(pipe)
+        self.assertEqual(attachment.get_filename(), "logs.txt.gz")
+        self.assertEqual(attachment.get_content_type(), "application/gzip")
+        self.assertEqual(zlib.decompress(attachment.get_payload(decode=True),
+                                         31), "".join(lines))
+
+    def test_split_compressed_store(self):
+        """Check the limit applies to the compressed attachment"""
+        self.append_to_file("max_messagestore: 1")
+        self.append_to_file("compress: yes")
+        lines = ["%s %d\n" % (os.urandom(8).encode("hex"), i)
+                 for i in range(200)]
+        file(MailTest.MESSAGE_STORE, "w").write("".join(lines))
+        pipes = [Pipe() for i in range(10)]
+        self.assertEqual(self.send(*pipes), None)
+        sent = pipes[:len(pipes) - len(self.pipes)]
+        self.assert_(1 < len(sent) < 5)
+        data = []
+        for pipe in sent:
+            compressed = self.get_attachment(pipe).get_payload(decode=True)
+            self.assert_(len(compressed) <= 1024)
+            data.append(zlib.decompress(compressed, 31))
+        self.assertEqual("".join(data), "".join(lines))
+
+    def test_rate_limit(self):
+        """Check messages collect in the store while we're throttled"""
+        self.append_to_file("max_messagestore: 1")
+        self.append_to_file("rate_limit: 1")
+        self.assertEqual(self.send(Pipe()), None)
+        file(MailTest.MESSAGE_STORE, "w").write("Throttled Message\n")
+        self.assertEqual(self.send(), hacksaw.proc.mail.MessageSender.THROTTLED)
+        self.assertEqual(self.commands, [])
+        self.assertEqual(file(MailTest.MESSAGE_STORE).read(),
+                         "Throttled Message\n")
+
+    def test_rate_limit_split_store(self):
+        """Check the rest of a split store waits for the next send"""
+        self.append_to_file("max_messagestore: 1")
+        self.append_to_file("rate_limit: 1")
+        self.append_to_file("rate_burst: 2")
+        self.write_store()
+        pipes = [Pipe(), Pipe(), Pipe()]
+        self.assertEqual(self.send(*pipes),
+                         hacksaw.proc.mail.MessageSender.THROTTLED)
+        self.assertEqual(len(self.pipes), 1)
+        self.assert_(os.path.exists(MailTest.MESSAGE_STORE + ".sending"))
+
+    def test_aggregation_window(self):
+        """Check a new store is held back for the aggregation window"""
+        self.append_to_file("max_messagestore: 1")
+        self.append_to_file("aggregation_window: 3600")
+        self.assertEqual(self.send(), hacksaw.proc.mail.MessageSender.THROTTLED)
+        self.assertEqual(self.commands, [])
+        self.assert_(os.path.exists(MailTest.MESSAGE_STORE))
+
+    def test_plan_chunks(self):
+        """Check a line that's longer than the limit gets its own chunk"""
+        store = cStringIO.StringIO("a\nbbbbbb\nc\nd\n")
+        self.assertEqual(hacksaw.proc.mail.plan_chunks(store, 4),
+                         [(0, 2), (2, 9), (9, 13)])
+
+
+class SMTPHandler(SocketServer.StreamRequestHandler):
+
+    def reply(self, *lines):
+        self.wfile.write("".join([line + "\r\n" for line in lines]))
+        self.wfile.flush()
+
+    def read_message(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line == ".\r\n":
+                break
+            if line.startswith("."):
+                line = line[1:]
+            lines.append(line.replace("\r\n", "\n"))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.reply("451 Try again later")
+        else:
+            self.server.messages.append("".join(lines))
+            self.reply("250 OK")
+
+    def handle(self):
+        self.server.connections += 1
+        if self.server.stalls:
+            # Say nothing until the client gives up on us.
+            self.server.stalls -= 1
+            self.rfile.read()
+            return
+        self.reply("220 localhost")
+        while True:
+            line = self.rfile.readline()
+            command = line[:4].upper()
+            if not line or command == "QUIT":
+                break
+            if command == "EHLO" and self.server.pipelining:
+                self.reply("250-localhost", "250 PIPELINING")
+            elif command == "MAIL" and self.server.pipelining:
+                # Don't reply until we've had the whole envelope, so a
+                # client that waits for each reply gets stuck.
+                replies = ["250 OK"]
+                while not self.rfile.readline().upper().startswith("DATA"):
+                    replies.append("250 OK")
+                self.reply(*(replies + ["354 Go ahead"]))
+                self.read_message()
+            elif command == "DATA":
+                self.reply("354 Go ahead")
+                self.read_message()
+            else:
+                self.reply("250 OK")
+        self.reply("221 Bye")
+
+
+class SMTPServer(SocketServer.ThreadingTCPServer):
+
+    # A stand-in SMTP server that remembers the messages it's sent, and
+    # can be told to turn down the first few or to ignore the first few
+    # connections.
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, pipelining=True):
+        SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                                 SMTPHandler)
+        self.pipelining = pipelining
+        self.connections = 0
+        self.failures = 0
+        self.stalls = 0
+        self.messages = []
+
+
+class DataWriterTest(unittest.TestCase):
+
+    def test_quoting(self):
+        """Check lines end in CRLF and leading dots are doubled"""
+        output = Pipe()
+        output.sendall = output.write
+        writer = hacksaw.proc.mail.DataWriter(output)
+        for data in (".start\n", "line\r", "\n.", "dot\n", "..two\nend"):
+            writer.write(data)
+        writer.close()
+        self.assertEqual(output.getvalue(), "..start\r\nline\r\n..dot\r\n"
+                         "...two\r\nend\r\n.\r\n")
+
+
+class SMTPTest(MailTest):
+
+    pipelining = True
 
-class SendErrorTest(MessageSenderTest):
-    
-    def _setup_mock_pipe(self, file_obj):
-        self.append_to_file('sender: wilber@cmedltd.com')
-        self.append_to_file('recipients: gteale@cmedltd.com')
-        self.append_to_file('subject: Hacksaw error: Message store too large')
-        self.append_to_file('mailcommand: /usr/lib/sendmail -t')
+    def setUp(self):
+        MailTest.setUp(self)
+        self.server = SMTPServer(self.pipelining)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.append_to_file("sender: wilber@cmedltd.com")
+        self.append_to_file("recipients: bob@foo.com, ged@localhost")
+        self.append_to_file("subject: Hacksaw e-mail")
+        self.append_to_file("max_messagestore: 1")
+        self.append_to_file("smtphost: 127.0.0.1")
+        self.append_to_file("smtpport: %d" % self.server.server_address[1])
+        self.append_to_file("smtp_retry_delay: 0")
+        dirname = os.path.dirname(MailTest.MESSAGE_STORE)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.transports = {}
+
+    def tearDown(self):
+        for transport in self.transports.values():
+            transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        MailTest.tearDown(self)
+
+    def send(self, text="Error: Example Message\n"):
+        file(MailTest.MESSAGE_STORE, "w").write(text)
+        config = self.config.compile()
+        transport = hacksaw.proc.mail.get_transport(config, self.transports)
+        sender = hacksaw.proc.mail.MessageSender(config, transport)
+        return sender.send_message()
+
+    def test_send(self):
+        """Check we can send the log messages to an SMTP server"""
         self.read_config()
-        mock_os = Mock()
-        mock_os.expects(once()).popen(
-            eq('/usr/lib/sendmail -t'), eq('w')).will(return_value(file_obj))
-        
-        self.real_os = hacksaw.proc.mail.os
-        hacksaw.proc.mail.os = mock_os
-        return mock_os
+        self.assertEqual(self.send(".dotted\nError: Example Message\n"),
+                         None)
+        self.failIf(os.path.exists(MailTest.MESSAGE_STORE))
+        self.assertEqual(len(self.server.messages), 1)
+        message = email.message_from_string(self.server.messages[0])
+        self.assertEqual(message["To"], "bob@foo.com, ged@localhost")
+        self.assertEqual(message.get_payload()[0].get_payload(),
+                         ".dotted\nError: Example Message\n")
+
+    def test_reuse_connection(self):
+        """Check we send every message over the same connection"""
+        self.read_config()
+        for i in range(3):
+            self.assertEqual(self.send(), None)
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
 
-    def _remove_mock_pipe(self):
-        hacksaw.proc.mail.os = self.real_os
+    def test_retry(self):
+        """Check we try again when the server turns a message down"""
+        self.read_config()
+        self.server.failures = 2
+        self.assertEqual(self.send(), None)
+        self.assertEqual(len(self.server.messages), 1)
+        self.failIf(os.path.exists(MailTest.MESSAGE_STORE))
+
+    def test_give_up(self):
+        """Check we keep the message store if we can't send it"""
+        self.append_to_file("smtp_retries: 1")
+        self.read_config()
+        self.server.failures = 2
+        sys.stderr = cStringIO.StringIO()
+        try:
+            self.assertNotEqual(self.send(), None)
+            self.assert_("451" in sys.stderr.getvalue())
+        finally:
+            sys.stderr = sys.__stderr__
+        self.assertEqual(self.server.messages, [])
+        self.assert_(os.path.exists(MailTest.MESSAGE_STORE + ".sending"))
 
-    def test_message_store_too_large(self):
-        """Check error message is sent if message store too large"""
-        self.append_to_file("max_messagestore: 0")
+    def test_reconnect(self):
+        """Check we reconnect if the server drops the connection"""
         self.read_config()
-        file_obj = Mock()
-        file_obj.expects(once()).close()
-        file_obj.expects(once()).write(
-            string_contains("Subject: Hacksaw error:"))
-        mock_os = self._setup_mock_pipe(file_obj)
+        self.assertEqual(self.send(), None)
+        transport = self.transports.values()[0]
+        transport._smtp.sock.close()
+        self.assertEqual(self.send(), None)
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_timeout(self):
+        """Check we try again when the server stops answering"""
+        self.read_config()
+        self.server.stalls = 1
+        timeout = hacksaw.proc.mail.SMTPTransport.TIMEOUT
+        hacksaw.proc.mail.SMTPTransport.TIMEOUT = 0.2
         try:
-            sender = hacksaw.proc.mail.MessageSender(self.config)
-            sender.send_message()
-            file_obj.verify()
-            mock_os.verify()
+            self.assertEqual(self.send(), None)
         finally:
-            self._remove_mock_pipe()
+            hacksaw.proc.mail.SMTPTransport.TIMEOUT = timeout
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual(self.server.connections, 2)
+
+
+class SMTPWithoutPipeliningTest(SMTPTest):
+
+    pipelining = False
 
 
 if __name__ == '__main__':
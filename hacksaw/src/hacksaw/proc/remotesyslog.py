@@ -3,7 +3,10 @@
 
 
 import ConfigParser
+import errno
+import os
 import re
+import sys
 import syslog
 
 import netsyslog
@@ -11,42 +14,7 @@ import netsyslog
 import hacksaw.lib
 
 
-class LogMessage(object):
-
-    # This class was blatantly stolen from the Band Saw source.
-    # See http://bandsaw.sourceforge.net/.
-
-    regex = r"([^\s]+\s+[^\s]+\s+[^\s]+)\s+([^\s]+)\s+([^\s]+):\s(.*)"
-    pattern = re.compile(regex)
-    
-    def __init__(self, line):
-        self.match = LogMessage.pattern.match(line)
-
-    def _get_message_part(self, index):
-        try:
-            return self.match.groups()[index]
-        except AttributeError:
-            return ""
-
-    def _get_date(self):
-        return self._get_message_part(0)
-
-    date = property(_get_date)
-    
-    def _get_hostname(self):
-        return self._get_message_part(1)
-
-    hostname = property(_get_hostname)
-
-    def _get_process(self):
-        return self._get_message_part(2)
-
-    process = property(_get_process)
-
-    def _get_text(self):
-        return self._get_message_part(3)
-
-    text = property(_get_text)
+LogMessage = hacksaw.lib.LogMessage  # for backwards compatibility
 
 
 class Processor(hacksaw.lib.Processor):
@@ -58,6 +26,8 @@ class Processor(hacksaw.lib.Processor):
             [SingleLineFilter, MultiLineFilter, MessageDispatcher])
 
     def set_action_chain(self, action_classes):
+        if self._action_chain is not None:
+            self._action_chain.close()
         self._action_chain = ActionChain(self, action_classes)
 
     def split_process_info(self, text):
@@ -70,7 +40,7 @@ class Processor(hacksaw.lib.Processor):
         return name, pid
 
     def create_packet(self, message):
-        log = LogMessage(message)
+        log = hacksaw.lib.LogMessage(message)
         pri = netsyslog.PriPart(self.config.facility, self.config.priority)
         header = netsyslog.HeaderPart(log.date, log.hostname)
         process_name, pid = self.split_process_info(log.process)
@@ -80,6 +50,12 @@ class Processor(hacksaw.lib.Processor):
     def handle_message(self, message):
         self._action_chain.handle_message(message)
 
+    def handle_messages(self, messages):
+        self._action_chain.handle_messages(messages)
+
+    def close(self):
+        self._action_chain.close()
+
 
 class ActionChain(object):
 
@@ -102,6 +78,13 @@ class ActionChain(object):
     def handle_message(self, message):
         self.get_action(0).handle_message(message)
 
+    def handle_messages(self, messages):
+        self.get_action(0).handle_messages(messages)
+
+    def close(self):
+        for action in self._actions:
+            action.close()
+
 
 class UnhandledMessageError(RuntimeError):
 
@@ -120,6 +103,17 @@ class Action(object):
                 'The message "%s" was not handled' % message)
         self._successor.handle_message(message)
 
+    def handle_messages(self, messages):
+        if not messages:
+            return
+        if self._successor is None:
+            raise UnhandledMessageError(
+                'The messages "%s" were not handled' % messages)
+        self._successor.handle_messages(messages)
+
+    def close(self):
+        pass
+
 
 class SingleLineFilter(Action):
 
@@ -136,12 +130,24 @@ class SingleLineFilter(Action):
                 regexes.append(re.compile(pattern_tuple[0]))
         return regexes
 
-    def handle_message(self, message):
+    def is_ignored(self, message):
         for regex in self._ignore_regexes:
             if regex.search(message):
-                return
+                return True
+        return False
+
+    def handle_message(self, message):
+        if self.is_ignored(message):
+            self._processor.lines_dropped += 1
+            return
         super(SingleLineFilter, self).handle_message(message)
 
+    def handle_messages(self, messages):
+        kept = [message for message in messages
+                if not self.is_ignored(message)]
+        self._processor.lines_dropped += len(messages) - len(kept)
+        super(SingleLineFilter, self).handle_messages(kept)
+
 
 class MultiLineFilter(Action):
 
@@ -160,32 +166,114 @@ class MultiLineFilter(Action):
                 regexes.append((re.compile(start), re.compile(end)))
         return regexes
 
-    def handle_message(self, message):
-        log = LogMessage(message)
+    def is_ignored(self, message):
+        log = hacksaw.lib.LogMessage(message)
         logger_id = (log.hostname, log.process)
         if logger_id in self._currently_ignored_loggers:
             if self._currently_ignored_loggers[logger_id].search(message):
                 del self._currently_ignored_loggers[logger_id]
-            return
+            return True
         else:
             for start_regex, end_regex in self._ignore_regexes:
                 if start_regex.search(message):
                     self._currently_ignored_loggers[logger_id] = end_regex
-                    return
+                    return True
+        return False
+
+    def handle_message(self, message):
+        if self.is_ignored(message):
+            self._processor.lines_dropped += 1
+            return
         super(MultiLineFilter, self).handle_message(message)
 
+    def handle_messages(self, messages):
+        kept = [message for message in messages
+                if not self.is_ignored(message)]
+        self._processor.lines_dropped += len(messages) - len(kept)
+        super(MultiLineFilter, self).handle_messages(kept)
+
 
 class MessageDispatcher(Action):
 
+    # Sends the messages on through a single logger (and so a single
+    # socket), which is set up from the config the first time it's
+    # needed and kept until the processor is closed. A processor is
+    # made afresh when the config is reloaded, so the logger always
+    # sends to the hosts that are in the config.
+
     def __init__(self, processor, successor):
         super(MessageDispatcher, self).__init__(processor, successor)
+        self._logger = None
+
+    def _get_spill_path(self, hostname, port):
+        spill_dir = self._processor.config.tcp_spill_dir
+        if spill_dir is None:
+            return None
+        return os.path.join(spill_dir, "%s_%d.spill" % (hostname, port))
+
+    def _make_spill_dir(self):
+        spill_dir = self._processor.config.tcp_spill_dir
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            try:
+                os.makedirs(spill_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:  # another processor beat us
+                    raise
+
+    def _create_logger(self):
+        config = self._processor.config
+        self._make_spill_dir()
+        logger = netsyslog.Logger(config.address_ttl)
+        for protocol, hostname, port in config.destinations:
+            if protocol == "tcp":
+                logger.add_tcp_host(hostname, port, config.tcp_queue_size,
+                                    self._get_spill_path(hostname, port))
+            else:
+                logger.add_host(hostname)
+        return logger
+
+    def _get_logger(self):
+        if self._logger is None:
+            self._logger = self._create_logger()
+        return self._logger
 
     def handle_message(self, message):
-        packet = self._processor.create_packet(message)
-        logger = netsyslog.Logger()
-        for host in self._processor.config.hosts:
-            logger.add_host(host)
-        logger.send_packet(packet)
+        self.handle_messages([message])
+
+    def _create_packets(self, messages):
+        # Lines that can't be made into a packet (e.g. with a bad pid)
+        # are skipped and counted as dropped, and the first error is
+        # returned so that it can be reported.
+        create_packet = self._processor.create_packet
+        packets = []
+        error = None
+        for message in messages:
+            try:
+                packets.append(create_packet(message))
+            except Exception:
+                self._processor.lines_dropped += 1
+                if error is None:
+                    error = sys.exc_info()
+        return packets, error
+
+    def handle_messages(self, messages):
+        # The whole batch goes to every host, even if sending to one of
+        # them fails; the error is raised afterwards so it's reported.
+        # Packets that a TCP host has queued to send later don't count.
+        packets, error = self._create_packets(messages)
+        results = self._get_logger().send_packets(packets)
+        for destination in self._processor.config.destinations:
+            result = results.get(destination)
+            if result is not None and result.failed and \
+                   result.error is not None:
+                raise result.error
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        if self._logger is not None:
+            self._logger.close()
+            self._logger = None
 
 
 class BadRuleName(RuntimeError):
@@ -201,6 +289,20 @@ class Config(hacksaw.lib.Config):
     IGNORE_SECTION = "ignore"
     RULE_START = "match"
     RULE_END = "end"
+    ADDRESS_TTL = "address_ttl"
+    TCP_PREFIX = "tcp:"
+    TCP_QUEUE_SIZE = "tcp_queue_size"
+    TCP_SPILL_DIR = "tcp_spill_dir"
+
+    DEFAULT_ADDRESS_TTL = netsyslog.Logger.ADDRESS_TTL
+    DEFAULT_UDP_PORT = netsyslog.Logger.PORT
+    DEFAULT_TCP_PORT = netsyslog.TCPTransport.PORT
+    DEFAULT_TCP_QUEUE_SIZE = netsyslog.TCPTransport.MAX_QUEUE
+
+    FIELDS = ("facility", "priority", "hosts", "ignore_patterns",
+              "address_ttl", "destinations", "tcp_queue_size",
+              "tcp_spill_dir")
+    REQUIRED_FIELDS = ("facility", "priority", "hosts")
 
     def __init__(self, filename):
         super(Config, self).__init__(filename)
@@ -248,6 +350,44 @@ class Config(hacksaw.lib.Config):
 
     hosts = property(_get_hosts)
 
+    def _get_destinations(self):
+        # Returns a (protocol, hostname, port) tuple for each host. Hosts
+        # are sent to over UDP unless they're written as "tcp:hostname"
+        # or "tcp:hostname:port".
+        destinations = []
+        for host in self.hosts:
+            if not host.startswith(Config.TCP_PREFIX):
+                destinations.append(("udp", host, Config.DEFAULT_UDP_PORT))
+                continue
+            hostname = host[len(Config.TCP_PREFIX):]
+            port = Config.DEFAULT_TCP_PORT
+            if ":" in hostname:
+                hostname, port = hostname.rsplit(":", 1)
+                port = int(port)
+            destinations.append(("tcp", hostname, port))
+        return destinations
+
+    destinations = property(_get_destinations)
+
+    def _get_tcp_queue_size(self):
+        value = self._get_optional_item(Config.TCP_QUEUE_SIZE,
+                                        Config.DEFAULT_TCP_QUEUE_SIZE)
+        return int(value)
+
+    tcp_queue_size = property(_get_tcp_queue_size)
+
+    def _get_tcp_spill_dir(self):
+        return self._get_optional_item(Config.TCP_SPILL_DIR, None)
+
+    tcp_spill_dir = property(_get_tcp_spill_dir)
+
+    def _get_address_ttl(self):
+        value = self._get_optional_item(Config.ADDRESS_TTL,
+                                        Config.DEFAULT_ADDRESS_TTL)
+        return float(value)
+
+    address_ttl = property(_get_address_ttl)
+
     def _get_ignore_section(self):
         return ".".join((self._get_section(), self.IGNORE_SECTION))
 
@@ -2,15 +2,24 @@
 # (C) Cmed Ltd, 2005
 
 
+import errno
+import os
+import shutil
+import socket
 import syslog
 import unittest
 
+import netsyslog
 import pmock
 
+import hacksaw.lib
 import hacksaw.lib_test
 import hacksaw.proc.remotesyslog as remotesyslog
 
 
+UDP_PORT = remotesyslog.Config.DEFAULT_UDP_PORT
+
+
 class StandardConfigTest(hacksaw.lib_test.ConfigTest):
 
     config_cls = remotesyslog.Config
@@ -28,6 +37,44 @@ class BasicConfigTest(StandardConfigTest):
         self.read_config()
         self.assertEqual(self.config.hosts, ["localhost", "otherhost"])
 
+    def test_get_destinations(self):
+        """Check we can choose to send to some hosts over TCP"""
+        self.append_to_file("hosts: localhost, tcp:loghost, tcp:other:601")
+        self.read_config()
+        port = remotesyslog.Config.DEFAULT_TCP_PORT
+        self.assertEqual(self.config.destinations,
+                         [("udp", "localhost", UDP_PORT),
+                          ("tcp", "loghost", port), ("tcp", "other", 601)])
+
+    def test_bad_tcp_port(self):
+        """Check a TCP port that isn't a number is a config error"""
+        self.append_to_file("facility: daemon")
+        self.append_to_file("priority: warn")
+        self.append_to_file("hosts: tcp:loghost:syslog")
+        self.read_config()
+        self.assertRaises(hacksaw.lib.ConfigError, self.config.compile)
+
+    def test_get_tcp_options(self):
+        """Check we can set the TCP queue size and spill directory"""
+        self.read_config()
+        self.assertEqual(self.config.tcp_queue_size,
+                         remotesyslog.Config.DEFAULT_TCP_QUEUE_SIZE)
+        self.assertEqual(self.config.tcp_spill_dir, None)
+        self.append_to_file("tcp_queue_size: 50")
+        self.append_to_file("tcp_spill_dir: /var/spool/hacksaw/tcp")
+        self.read_config()
+        self.assertEqual(self.config.tcp_queue_size, 50)
+        self.assertEqual(self.config.tcp_spill_dir, "/var/spool/hacksaw/tcp")
+
+    def test_get_address_ttl(self):
+        """Check we can say how often to look up the hosts' addresses"""
+        self.read_config()
+        self.assertEqual(self.config.address_ttl,
+                         remotesyslog.Config.DEFAULT_ADDRESS_TTL)
+        self.append_to_file("address_ttl: 60")
+        self.read_config()
+        self.assertEqual(self.config.address_ttl, 60)
+
     def test_get_facility(self):
         """Check we can get the syslog message facility"""
         self.append_to_file("facility: local0")
@@ -52,6 +99,23 @@ class BasicConfigTest(StandardConfigTest):
         self.read_config()
         self.assertEqual(self.config.priority, syslog.LOG_WARNING)
 
+    def test_compile(self):
+        """Check we can compile the config"""
+        self.append_to_file("hosts: %s" % "localhost, otherhost")
+        self.append_to_file("facility: local0")
+        self.append_to_file("priority: warn")
+        self.read_config()
+        snapshot = self.config.compile()
+        self.assertEqual(snapshot.hosts, ("localhost", "otherhost"))
+        self.assertEqual(snapshot.facility, syslog.LOG_LOCAL0)
+        self.assertEqual(snapshot.priority, syslog.LOG_WARNING)
+
+    def test_compile_bad_facility(self):
+        """Check a bad facility is reported when the config is compiled"""
+        self.append_to_file("facility: nonsense")
+        self.read_config()
+        self.assertRaises(hacksaw.lib.ConfigError, self.config.compile)
+
 
 class RuleNameTest(unittest.TestCase):
 
@@ -92,40 +156,6 @@ class IgnoreConfigTest(StandardConfigTest):
                          [(r"\bcat", "dog"), ("start", "stop")])
 
 
-class LogMessageTest(unittest.TestCase):
-
-    # TODO: move to hacksaw.lib (it's also used by other processors)
-
-    def setUp(self):
-        self.line = 'Jun 23 14:02:37 hoopoo ldap[29913]: Hello  world\n'
-
-    def test_date(self):
-        """Check we can extract the date from a log message"""
-        message = remotesyslog.LogMessage(self.line)
-        self.assertEqual(message.date, 'Jun 23 14:02:37')
-
-    def test_date_single_figure_day(self):
-        """Check we can extract the date when the day is a single digit"""
-        line = 'Jun  1 14:02:37 hoopoo ldap[29913]: Hello  world\n'
-        message = remotesyslog.LogMessage(line)
-        self.assertEqual(message.date, 'Jun  1 14:02:37')
-
-    def test_hostname(self):
-        """Check we can extract the hostname from a log message"""
-        message = remotesyslog.LogMessage(self.line)
-        self.assertEqual(message.hostname, 'hoopoo')
-
-    def test_process(self):
-        """Check we can extract the process details from a log message"""
-        message = remotesyslog.LogMessage(self.line)
-        self.assertEqual(message.process, 'ldap[29913]')
-        
-    def test_message(self):
-        """Check we can extract the text from a log message"""
-        message = remotesyslog.LogMessage(self.line)
-        self.assertEqual(message.text, 'Hello  world')
-        
-
 class ActionTestCase(unittest.TestCase):
 
     def test_handle_message(self):
@@ -247,6 +277,150 @@ class ProcessorTest(StandardConfigTest):
             remotesyslog.netsyslog = origmod
 
 
+class FakeLogger(object):
+
+    instances = []
+
+    def __init__(self, address_ttl):
+        self.address_ttl = address_ttl
+        self.hosts = []
+        self.destinations = []
+        self.tcp_hosts = []
+        self.unreachable = []
+        self.packets = []
+        self.closed = False
+        FakeLogger.instances.append(self)
+
+    def add_host(self, hostname):
+        self.hosts.append(hostname)
+        self.destinations.append(("udp", hostname, UDP_PORT))
+
+    def add_tcp_host(self, hostname, port, max_queue, spill_path):
+        self.hosts.append(hostname)
+        self.destinations.append(("tcp", hostname, port))
+        self.tcp_hosts.append((hostname, port, max_queue, spill_path))
+
+    def send_packets(self, packets):
+        results = {}
+        for destination in self.destinations:
+            results[destination] = netsyslog.SendResult()
+        for packet in packets:
+            self.packets.append(str(packet))
+            for destination in self.destinations:
+                result = results[destination]
+                if destination in self.unreachable:
+                    result.failed += 1
+                    result.error = socket.error(errno.EHOSTUNREACH,
+                                                "No route to host")
+                else:
+                    result.sent += 1
+        return results
+
+    def close(self):
+        self.closed = True
+
+
+class MessageDispatcherTest(StandardConfigTest):
+
+    def setUp(self):
+        StandardConfigTest.setUp(self)
+        self.append_to_file("facility: daemon")
+        self.append_to_file("priority: warn")
+        self.append_to_file("hosts: localhost, otherhost")
+        self.read_config()
+        FakeLogger.instances = []
+        self.real_logger = remotesyslog.netsyslog.Logger
+        remotesyslog.netsyslog.Logger = FakeLogger
+
+    def tearDown(self):
+        remotesyslog.netsyslog.Logger = self.real_logger
+        StandardConfigTest.tearDown(self)
+
+    def test_reuse_logger(self):
+        """Check we send every message through the same logger"""
+        processor = remotesyslog.Processor(self.config.compile())
+        message = "Nov 22 08:59:54 myhost myproc[123]: Hello world!"
+        processor.handle_messages([message, message])
+        processor.handle_message(message)
+        self.assertEqual(len(FakeLogger.instances), 1)
+        logger = FakeLogger.instances[0]
+        self.assertEqual(logger.hosts, ["localhost", "otherhost"])
+        self.assertEqual(len(logger.packets), 3)
+        self.failIf(logger.closed)
+        processor.close()
+        self.assert_(logger.closed)
+
+    def test_send_error(self):
+        """Check a send error is raised once the whole batch is sent"""
+        processor = remotesyslog.Processor(self.config.compile())
+        processor.handle_message(
+            "Nov 22 08:59:54 myhost myproc[123]: Hello world!")
+        logger = FakeLogger.instances[0]
+        logger.unreachable = [("udp", "localhost", UDP_PORT)]
+        message = "Nov 22 08:59:55 myhost myproc[123]: Hello again!"
+        self.assertRaises(socket.error, processor.handle_messages,
+                          [message, message])
+        self.assertEqual(len(logger.packets), 3)
+
+    def test_bad_line_in_batch(self):
+        """Check a line that can't be sent doesn't stop the rest"""
+        processor = remotesyslog.Processor(self.config.compile())
+        messages = ["Nov 22 08:59:54 myhost myproc[123]: Hello world!",
+                    "Nov 22 08:59:55 myhost b[x]: Bad pid",
+                    "Nov 22 08:59:56 myhost myproc[123]: Hello again!"]
+        self.assertRaises(ValueError, processor.handle_messages, messages)
+        logger = FakeLogger.instances[0]
+        self.assertEqual(len(logger.packets), 2)
+        self.assertEqual(processor.lines_dropped, 1)
+
+    def test_send_error_with_tcp_to_same_host(self):
+        """Check a UDP error isn't hidden by TCP to the same host"""
+        self.append_to_file("hosts: localhost, tcp:localhost")
+        self.read_config()
+        processor = remotesyslog.Processor(self.config.compile())
+        processor.handle_message(
+            "Nov 22 08:59:54 myhost myproc[123]: Hello world!")
+        logger = FakeLogger.instances[0]
+        logger.unreachable = [("udp", "localhost", UDP_PORT)]
+        self.assertRaises(socket.error, processor.handle_message,
+                          "Nov 22 08:59:55 myhost myproc[123]: Hello again!")
+
+    def test_tcp_hosts(self):
+        """Check TCP hosts are given their own spill files"""
+        spill_dir = "./test-tcp-spill/remotesyslog"
+        self.append_to_file("hosts: localhost, tcp:loghost:601")
+        self.append_to_file("tcp_queue_size: 50")
+        self.append_to_file("tcp_spill_dir: %s" % spill_dir)
+        self.read_config()
+        processor = remotesyslog.Processor(self.config.compile())
+        try:
+            processor.handle_message(
+                "Nov 22 08:59:54 myhost myproc[123]: Hello world!")
+            self.assert_(os.path.isdir(spill_dir))
+        finally:
+            processor.close()
+            shutil.rmtree(os.path.dirname(spill_dir))
+        logger = FakeLogger.instances[0]
+        self.assertEqual(logger.hosts, ["localhost", "loghost"])
+        self.assertEqual(logger.tcp_hosts,
+                         [("loghost", 601, 50,
+                           os.path.join(spill_dir, "loghost_601.spill"))])
+
+    def test_close_unused(self):
+        """Check we can close a processor that hasn't sent anything"""
+        processor = remotesyslog.Processor(self.config.compile())
+        processor.close()
+        self.assertEqual(FakeLogger.instances, [])
+
+    def test_replace_action_chain(self):
+        """Check the old logger is closed when the chain is replaced"""
+        processor = remotesyslog.Processor(self.config.compile())
+        processor.handle_message(
+            "Nov 22 08:59:54 myhost myproc[123]: Hello world!")
+        processor.set_action_chain([remotesyslog.MessageDispatcher])
+        self.assert_(FakeLogger.instances[0].closed)
+
+
 class SingleLineFilterTest(StandardConfigTest):
 
     def test_ignore_single_message(self):
@@ -269,36 +443,62 @@ class MultiLineFilterTest(StandardConfigTest):
         super(MultiLineFilterTest, self).setUp()
         self._dispatched_messages = []
 
-    def test_ingore_multiple_lines(self):
-        """Check we can ignore groups of log messages"""
+    lines = [
+        "Nov 22 08:59:54 yourhost myproc[123]: Hello!",
+        "Nov 22 08:59:55 yourhost myproc[123]: start!",
+        "Nov 22 08:59:56 yourhost myproc[123]: middle!",
+        "Nov 22 08:59:56 myhost myproc[123]: middle!",
+        "Nov 22 08:59:56 yourhost myproc[321]: not last line_",
+        "Nov 22 08:59:57 yourhost myproc[123]: last line this time",
+        "Nov 22 08:59:58 yourhost myproc[123]: Bye!",
+    ]
+
+    def make_processor(self):
 
         class MockDispatcher(remotesyslog.Action):
 
             def handle_message(self_, message):
                 self._dispatched_messages.append(message)
+
+            def handle_messages(self_, messages):
+                self._dispatched_messages.extend(messages)
         
         self.append_to_file("[hacksaw.proc.remotesyslog.ignore]")
         self.append_to_file(r"match-stuff: start")
         self.append_to_file(r"end-stuff: last line\b")
         self.read_config()
-        lines = [
-            "Nov 22 08:59:54 yourhost myproc[123]: Hello!",
-            "Nov 22 08:59:55 yourhost myproc[123]: start!",
-            "Nov 22 08:59:56 yourhost myproc[123]: middle!",
-            "Nov 22 08:59:56 myhost myproc[123]: middle!",
-            "Nov 22 08:59:56 yourhost myproc[321]: not last line_",
-            "Nov 22 08:59:57 yourhost myproc[123]: last line this time",
-            "Nov 22 08:59:58 yourhost myproc[123]: Bye!",
-        ]
         processor = remotesyslog.Processor(self.config)
         processor.set_action_chain([remotesyslog.SingleLineFilter,
                                     remotesyslog.MultiLineFilter,
                                     MockDispatcher])
-        for line in lines:
+        return processor
+
+    def test_ingore_multiple_lines(self):
+        """Check we can ignore groups of log messages"""
+        processor = self.make_processor()
+        for line in self.lines:
             processor.handle_message(line)
+        lines = self.lines
         expected_dispatched = [lines[0], lines[3], lines[4], lines[6]]
         self.assertEquals(self._dispatched_messages, expected_dispatched)
 
+    def test_ignore_multiple_lines_in_batch(self):
+        """Check we can ignore groups of log messages within a batch"""
+        processor = self.make_processor()
+        processor.handle_messages(self.lines[:3])
+        processor.handle_messages(self.lines[3:])
+        lines = self.lines
+        expected_dispatched = [lines[0], lines[3], lines[4], lines[6]]
+        self.assertEquals(self._dispatched_messages, expected_dispatched)
+
+    def test_count_dropped_lines(self):
+        """Check we count the messages that are ignored"""
+        processor = self.make_processor()
+        processor.handle_messages(self.lines[:3])
+        processor.handle_message(self.lines[3])
+        processor.handle_messages(self.lines[4:])
+        self.assertEquals(processor.lines_dropped, 3)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,98 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import cStringIO
+import mmap
+import os
+
+
+class SpoolReader(object):
+
+    # Reads a spool file through a memory map. Rather than pulling
+    # lines out one at a time we take a window of the map that ends on
+    # a line boundary and split the whole window in a single call,
+    # copying each line straight out of the map.
+    # Windows are sized to hold a little less than a batch, so that a
+    # batch's end offset is normally just the end of its window.
+
+    INITIAL_LINE_LENGTH = 128
+    BATCH_FILL = 0.95
+
+    def __init__(self, path):
+        self.path = path
+        self._file = file(path, "rb")
+        self._map = None
+        self._size = 0
+        self._remap()
+
+    def _get_current_size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._size = self._get_current_size()
+        if self._size > 0:
+            self._map = mmap.mmap(self._file.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def _read_lines(self, start, end):
+        # cStringIO reads straight out of the buffer without copying
+        # it, and unlike str.splitlines() only splits on newlines.
+        window = buffer(self._map, start, end - start)
+        return cStringIO.StringIO(window).readlines()
+
+    def _find_window_end(self, start, window_size, end_of_data):
+        end = start + window_size
+        if end >= end_of_data:
+            return end_of_data
+        newline = self._map.rfind("\n", start, end)
+        if newline == -1:
+            # The line is longer than the window.
+            newline = self._map.find("\n", end, end_of_data)
+            if newline == -1:
+                return end_of_data
+        return newline + 1
+
+    def _split_batches(self, lines, batch_size, offset):
+        batches = []
+        for start in range(0, len(lines), batch_size):
+            batch = lines[start:start + batch_size]
+            offset += sum(map(len, batch))
+            batches.append((batch, offset))
+        return batches
+
+    def read_batches(self, batch_size, offset=0):
+        """Yield lists of up to batch_size lines, with the offset after each"""
+        window_size = int(batch_size * self.INITIAL_LINE_LENGTH)
+        while True:
+            end_of_data = self._size
+            while offset < end_of_data:
+                # Touching a page beyond the end of a file that has
+                # been truncated would kill us with SIGBUS, so check
+                # the size before each window and stop at the new end.
+                end_of_data = min(end_of_data, self._get_current_size())
+                if offset >= end_of_data:
+                    break
+                end = self._find_window_end(offset, window_size, end_of_data)
+                lines = self._read_lines(offset, end)
+                if len(lines) > batch_size:
+                    for batch in self._split_batches(lines, batch_size,
+                                                     offset):
+                        yield batch
+                else:
+                    yield lines, end
+                window_size = max(int(window_size * self.BATCH_FILL *
+                                      batch_size / len(lines)), 1)
+                offset = end
+            if self._get_current_size() <= self._size:
+                break
+            self._remap()  # the file has grown since we mapped it
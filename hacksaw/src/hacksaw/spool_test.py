@@ -0,0 +1,115 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import os
+import unittest
+
+import hacksaw.spool
+
+
+class SpoolReaderTest(unittest.TestCase):
+
+    filename = './test.log'
+
+    def make_reader(self, contents):
+        file(self.filename, 'w').write(contents)
+        self.reader = hacksaw.spool.SpoolReader(self.filename)
+        return self.reader
+
+    def read_lines(self, reader, offset=0, batch_size=1000):
+        lines = []
+        for batch, end in reader.read_batches(batch_size, offset):
+            lines.extend(batch)
+        return lines
+
+    def setUp(self):
+        self.reader = None
+
+    def tearDown(self):
+        if self.reader is not None:
+            self.reader.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_read_lines(self):
+        """Check we can read the lines in a spool file"""
+        reader = self.make_reader('Message 1\nMessage 2\n')
+        self.assertEqual(self.read_lines(reader),
+                         ['Message 1\n', 'Message 2\n'])
+
+    def test_empty_file(self):
+        """Check we can read an empty spool file"""
+        reader = self.make_reader('')
+        self.assertEqual(self.read_lines(reader), [])
+
+    def test_no_trailing_newline(self):
+        """Check we read the last line if it isn't terminated"""
+        reader = self.make_reader('Message 1\nMessage 2')
+        self.assertEqual(self.read_lines(reader),
+                         ['Message 1\n', 'Message 2'])
+
+    def test_carriage_return(self):
+        """Check carriage returns don't split a message"""
+        reader = self.make_reader('Message\r1\nMessage 2')
+        self.assertEqual(self.read_lines(reader),
+                         ['Message\r1\n', 'Message 2'])
+
+    def test_lines_span_windows(self):
+        """Check lines aren't split across windows"""
+        lines = ['Message %d\n' % i for i in range(1000)]
+        reader = self.make_reader(''.join(lines))
+        self.assertEqual(self.read_lines(reader, batch_size=3), lines)
+
+    def test_line_longer_than_window(self):
+        """Check we can read a line that's longer than a window"""
+        lines = ['Message 1\n', 'x' * 1000 + '\n', 'Message 3\n']
+        reader = self.make_reader(''.join(lines))
+        self.assertEqual(self.read_lines(reader, batch_size=1), lines)
+
+    def test_batches(self):
+        """Check batches are the right size and report their end offset"""
+        reader = self.make_reader('one\ntwo\nthree\n')
+        batches = list(reader.read_batches(2))
+        self.assertEqual(batches, [(['one\n', 'two\n'], 8),
+                                   (['three\n'], 14)])
+
+    def test_batch_size_limit(self):
+        """Check no batch is larger than we asked for"""
+        lines = ['Message %d\n' % i for i in range(1000)]
+        reader = self.make_reader(''.join(lines))
+        for batch, end in reader.read_batches(100):
+            self.assert_(0 < len(batch) <= 100)
+            self.assertEqual(end, len(''.join(lines[:lines.index(batch[-1])
+                                                         + 1])))
+
+    def test_start_at_offset(self):
+        """Check we can start reading part way through a file"""
+        reader = self.make_reader('one\ntwo\nthree\n')
+        self.assertEqual(self.read_lines(reader, 4), ['two\n', 'three\n'])
+
+    def test_truncated_file(self):
+        """Check we stop at the new end of a file that's been truncated"""
+        contents = ''.join(['Message %d\n' % i for i in range(1000)])
+        reader = self.make_reader(contents)
+        batches = reader.read_batches(5)
+        read, end = batches.next()
+        file(self.filename, 'r+').truncate(2000)
+        for batch, end in batches:
+            read.extend(batch)
+        self.assertEqual(''.join(read), contents[:2000])
+        self.assertEqual(end, 2000)
+
+    def test_file_grows(self):
+        """Check we pick up lines appended while we were reading"""
+        reader = self.make_reader('one\n')
+        batches = reader.read_batches(1)
+        read, end = batches.next()
+        file(self.filename, 'a').write('two\n')
+        for batch, end in batches:
+            read.extend(batch)
+        self.assertEqual(read, ['one\n', 'two\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
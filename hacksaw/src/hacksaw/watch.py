@@ -0,0 +1,115 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+
+class WatchError(OSError):
+
+    pass
+
+
+class PollingWatcher(object):
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+
+    def list_files(self):
+        return sorted(os.listdir(self.directory))
+
+    def wait(self, timeout=None):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+        return self.list_files()
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(PollingWatcher):
+
+    # Constants from <sys/inotify.h>.
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+
+    EVENT_FORMAT = "iIII"
+    EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+    BUFFER_SIZE = 64 * 1024
+
+    _libc = None
+
+    def __init__(self, directory, interval):
+        super(InotifyWatcher, self).__init__(directory, interval)
+        libc = self._load_libc()
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise WatchError(ctypes.get_errno(), "inotify_init failed")
+        # Only files renamed into the spool count. One that's written in
+        # place may not be finished when it's closed (pull-logs.sh used
+        # to edit files after copying them in).
+        mask = self.IN_MOVED_TO
+        if libc.inotify_add_watch(self._fd, directory, mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise WatchError(err, "can't watch '%s'" % directory)
+
+    @classmethod
+    def _load_libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            if not hasattr(libc, "inotify_init"):
+                raise WatchError(errno.ENOSYS, "inotify not supported")
+            cls._libc = libc
+        return cls._libc
+
+    def _parse_events(self, data):
+        names = []
+        overflowed = False
+        pos = 0
+        while pos + self.EVENT_SIZE <= len(data):
+            wd, mask, cookie, length = struct.unpack(
+                self.EVENT_FORMAT, data[pos:pos + self.EVENT_SIZE])
+            pos += self.EVENT_SIZE
+            name = data[pos:pos + length].rstrip("\0")
+            pos += length
+            if mask & self.IN_Q_OVERFLOW:
+                overflowed = True
+            elif name and name not in names:
+                names.append(name)
+        return names, overflowed
+
+    def wait(self, timeout=None):
+        try:
+            readable, writable, errors = select.select([self._fd], [], [],
+                                                       timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not readable:
+            return []
+        names, overflowed = self._parse_events(
+            os.read(self._fd, self.BUFFER_SIZE))
+        if overflowed:
+            # We've missed some events; fall back to listing everything.
+            return self.list_files()
+        return names
+
+    def close(self):
+        os.close(self._fd)
+
+
+def get_watcher(directory, interval):
+    try:
+        return InotifyWatcher(directory, interval)
+    except (OSError, AttributeError):
+        return PollingWatcher(directory, interval)
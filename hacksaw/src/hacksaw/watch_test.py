@@ -0,0 +1,100 @@
+# $Id$
+# (C) Cmed Ltd, 2004
+
+
+import os
+import shutil
+import struct
+import unittest
+
+import hacksaw.watch
+
+
+class WatcherTest(unittest.TestCase):
+
+    SPOOL_DIR = './test-spool'
+
+    def make_file(self, name):
+        file(os.path.join(self.SPOOL_DIR, name), 'w').write('Message\n')
+
+    def setUp(self):
+        if os.path.exists(self.SPOOL_DIR):
+            shutil.rmtree(self.SPOOL_DIR)
+        os.mkdir(self.SPOOL_DIR)
+
+    def tearDown(self):
+        shutil.rmtree(self.SPOOL_DIR)
+
+
+class PollingWatcherTest(WatcherTest):
+
+    def test_list_files(self):
+        """Check the polling watcher returns every file in the spool"""
+        self.make_file('b')
+        self.make_file('a')
+        watcher = hacksaw.watch.PollingWatcher(self.SPOOL_DIR, 0)
+        self.assertEqual(watcher.wait(), ['a', 'b'])
+
+
+class InotifyWatcherTest(WatcherTest):
+
+    def make_watcher(self):
+        try:
+            return hacksaw.watch.InotifyWatcher(self.SPOOL_DIR, 0)
+        except OSError:
+            return None
+
+    def test_renamed_file(self):
+        """Check we're told about files renamed into the spool directory"""
+        watcher = self.make_watcher()
+        if watcher is None:
+            return
+        try:
+            file('./test-file', 'w').write('Message\n')
+            os.rename('./test-file', os.path.join(self.SPOOL_DIR, 'log'))
+            self.assertEqual(watcher.wait(1), ['log'])
+        finally:
+            watcher.close()
+
+    def test_written_in_place(self):
+        """Check files written straight into the spool are ignored"""
+        watcher = self.make_watcher()
+        if watcher is None:
+            return
+        try:
+            self.make_file('log')
+            self.assertEqual(watcher.wait(0.1), [])
+        finally:
+            watcher.close()
+
+    def test_timeout(self):
+        """Check we don't wait for ever if nothing arrives"""
+        watcher = self.make_watcher()
+        if watcher is None:
+            return
+        try:
+            self.assertEqual(watcher.wait(0), [])
+        finally:
+            watcher.close()
+
+    def test_parse_events(self):
+        """Check we can extract file names from inotify events"""
+        watcher = self.make_watcher()
+        if watcher is None:
+            return
+        try:
+            cls = hacksaw.watch.InotifyWatcher
+            data = struct.pack(cls.EVENT_FORMAT, 1, cls.IN_MOVED_TO, 0, 8)
+            data += 'one\0\0\0\0\0'
+            data += struct.pack(cls.EVENT_FORMAT, 1, cls.IN_MOVED_TO, 0, 4)
+            data += 'two\0'
+            self.assertEqual(watcher._parse_events(data),
+                             (['one', 'two'], False))
+            data = struct.pack(cls.EVENT_FORMAT, -1, cls.IN_Q_OVERFLOW, 0, 0)
+            self.assertEqual(watcher._parse_events(data), ([], True))
+        finally:
+            watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,15 @@
 import ConfigParser
 import getopt
 import os
+import signal
 import sys
 import traceback
 
+import hacksaw.journal
 import hacksaw.lib
+import hacksaw.metrics
+import hacksaw.spool
+import hacksaw.watch
 
 
 def get_processors(config):
@@ -22,23 +27,205 @@ def get_processors(config):
             sys.stderr.write("Error: %s" % e)
         else:
             module = sys.modules[proc]
-            proc_config = module.Config(config.filename)
-            instances.append(module.Processor(proc_config))
+            proc_config = module.Config(config.filename).compile()
+            processor = module.Processor(proc_config)
+            if config.metrics:
+                processor = hacksaw.metrics.InstrumentedProcessor(proc,
+                                                                  processor)
+            instances.append(processor)
     return instances
 
 
-def process_log_files(config):
+def process_log_file(path, processors, batch_size, journal=None):
+    offset = 0
+    if journal is not None:
+        offset = journal.get_offset(path)
+    reader = hacksaw.spool.SpoolReader(path)
+    try:
+        for batch, offset in reader.read_batches(batch_size, offset):
+            # Processors handle every line in the batch that they can
+            # before raising, so an error here only needs reporting.
+            for processor in processors:
+                try:
+                    processor.handle_messages(batch)
+                except:
+                    traceback.print_exc()
+            if journal is not None:
+                journal.commit(path, offset)
+    finally:
+        reader.close()
+    os.remove(path)
+    if journal is not None:
+        journal.remove(path)
+
+
+def is_log_file(path):
+    # Names starting with a dot are ours (e.g. the progress journal).
+    return not os.path.basename(path).startswith(".") and \
+           os.path.isfile(path)
+
+
+def list_log_files(spool_directory):
+    paths = [os.path.join(spool_directory, name)
+             for name in os.listdir(spool_directory)]
+    return [path for path in paths if is_log_file(path)]
+
+
+def assign_log_files(paths, jobs):
+    # Hand out the largest files first, each to the worker with the
+    # least work so far, so that workers finish at roughly the same time.
+    workloads = [[0, []] for i in range(jobs)]
+    sized_paths = [(os.path.getsize(path), path) for path in paths]
+    sized_paths.sort()
+    sized_paths.reverse()
+    for size, path in sized_paths:
+        workload = min(workloads)
+        workload[0] += size
+        workload[1].append(path)
+    return [paths for size, paths in workloads if paths]
+
+
+def close_processors(processors):
+    hacksaw.metrics.write_summary(processors)
+    for processor in processors:
+        try:
+            processor.close()
+        except:
+            traceback.print_exc()
+
+
+def process_assigned_files(config, paths):
+    journal = hacksaw.journal.Journal(config.journal_directory)
+    processors = get_processors(config)
+    try:
+        for path in paths:
+            process_log_file(path, processors, config.batch_size, journal)
+    finally:
+        close_processors(processors)
+
+
+def start_worker(config, paths):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            try:
+                process_assigned_files(config, paths)
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+
+def wait_for_workers(pids):
+    failures = 0
+    for pid in pids:
+        pid, status = os.waitpid(pid, 0)
+        if status != 0:
+            failures += 1
+    if failures:
+        raise RuntimeError, "%d of %d workers failed" % (failures, len(pids))
+
+
+def process_log_files(config, jobs=1):
     if not os.path.exists(config.spool_directory):
         raise IOError, "file not found: '%s'" % config.spool_directory
-    processors = get_processors(config)
-    for log_file in os.listdir(config.spool_directory):
-        for line in file(os.path.join(config.spool_directory, log_file)):
-            for processor in processors:
+    paths = list_log_files(config.spool_directory)
+    journal = hacksaw.journal.Journal(config.journal_directory)
+    journal.prune([os.path.basename(path) for path in paths])
+    if jobs <= 1:
+        process_assigned_files(config, paths)
+    else:
+        pids = [start_worker(config, assigned) for assigned in
+                assign_log_files(paths, jobs)]
+        wait_for_workers(pids)
+
+
+class Daemon(object):
+
+    def __init__(self, config):
+        self.config = config
+        self.processors = []
+        self.journal = None
+        self._stopping = False
+        self._reloading = False
+        self._reporting = False
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reloading = True
+        elif signum == signal.SIGUSR1:
+            self._reporting = True
+        else:
+            self._stopping = True
+
+    def install_signal_handlers(self):
+        # Restart system calls that a signal interrupts, or a SIGUSR1
+        # in the middle of sending would look like a dropped connection
+        # (and TCP packets would be sent twice).
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGINT,
+                       signal.SIGTERM):
+            signal.signal(signum, self.handle_signal)
+            signal.siginterrupt(signum, False)
+
+    def reload(self):
+        # A config that can't be read leaves us running with the old
+        # one, rather than with no processors at all.
+        self._reloading = False
+        filename = self.config.filename
+        try:
+            config = hacksaw.lib.GeneralConfig(filename).compile()
+            processors = get_processors(config)
+        except:
+            traceback.print_exc()
+            sys.stderr.write("Error: keeping the old config\n")
+            return
+        close_processors(self.processors)
+        self.config = config
+        self.processors = processors
+
+    def process_files(self, names):
+        # A file that can't be processed is left where it is, rather
+        # than stopping the daemon. Files we don't get to before we're
+        # told to stop are picked up when we next start.
+        for name in names:
+            if self._stopping:
+                break
+            path = os.path.join(self.config.spool_directory, name)
+            if is_log_file(path):
                 try:
-                    processor.handle_message(line)
+                    process_log_file(path, self.processors,
+                                     self.config.batch_size, self.journal)
                 except:
                     traceback.print_exc()
-        os.remove(os.path.join(config.spool_directory, log_file))
+
+    def run(self):
+        spool_directory = self.config.spool_directory
+        if not os.path.exists(spool_directory):
+            raise IOError, "file not found: '%s'" % spool_directory
+        self.journal = hacksaw.journal.Journal(self.config.journal_directory)
+        self.journal.prune([os.path.basename(path) for path in
+                            list_log_files(spool_directory)])
+        self.processors = get_processors(self.config)
+        watcher = hacksaw.watch.get_watcher(spool_directory,
+                                            self.config.poll_interval)
+        try:
+            # Anything that arrived while we weren't running.
+            self.process_files(watcher.list_files())
+            while not self._stopping:
+                self.process_files(watcher.wait(self.config.poll_interval))
+                if self._reporting:
+                    self._reporting = False
+                    hacksaw.metrics.write_summary(self.processors)
+                if self._reloading:
+                    self.reload()
+        finally:
+            watcher.close()
+            close_processors(self.processors)
 
 
 class Usage(Exception):
@@ -49,22 +236,36 @@ class Usage(Exception):
 
 def main(argv=None):
     config_file = os.path.join("/etc", "hacksaw.conf")
+    jobs = 1
+    run_as_daemon = False
     if argv is None:
         argv = sys.argv[1:]
     try:
         try:
-            opts, args = getopt.getopt(argv, "c:")
+            opts, args = getopt.getopt(argv, "c:dj:")
         except getopt.error, msg:
             raise Usage(msg)
         for opt, arg in opts:
             if opt == "-c":
                 config_file = arg
-        config = hacksaw.lib.GeneralConfig(config_file)
-        process_log_files(config)
+            elif opt == "-d":
+                run_as_daemon = True
+            elif opt == "-j":
+                try:
+                    jobs = int(arg)
+                except ValueError:
+                    raise Usage("number of jobs must be an integer: %s" % arg)
+        config = hacksaw.lib.GeneralConfig(config_file).compile()
+        if run_as_daemon:
+            daemon = Daemon(config)
+            daemon.install_signal_handlers()
+            daemon.run()
+        else:
+            process_log_files(config, jobs)
     except Usage, e:
         print >>sys.stderr, e.msg
         progname = os.path.basename(sys.argv[0])
-        print >>sys.stderr, "%s -c <config-file>" % progname
+        print >>sys.stderr, "%s -c <config-file> [-d | -j <jobs>]" % progname
         return 2
     except Exception, e:
         traceback.print_exc()
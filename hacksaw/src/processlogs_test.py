@@ -2,14 +2,22 @@
 # (C) Cmed Ltd, 2004
 
 
+import cStringIO
+import errno
 import os
 import shutil
+import signal
+import socket
 import sys
+import threading
+import time
 import unittest
 
 from pmock import *
 
+import hacksaw.journal
 import hacksaw.lib
+import hacksaw.metrics
 import processlogs
 
 
@@ -52,9 +60,11 @@ class SingleProcessorTest(ProcessorTest):
         try:
             module = Mock()
             config = Mock()
+            snapshot = Mock()
             module.expects(
                 once()).Config(eq(self.filename)).will(return_value(config))
-            module.expects(once()).Processor(eq(config))
+            config.expects(once()).compile().will(return_value(snapshot))
+            module.expects(once()).Processor(eq(snapshot))
             sys.modules['hacksaw.proc.test'] = module
             processors = processlogs.get_processors(self.config)
             self.assertEquals(len(processors), 1)
@@ -62,6 +72,24 @@ class SingleProcessorTest(ProcessorTest):
         finally:
             del sys.modules['hacksaw.proc.test']
 
+    def test_instrument_processors(self):
+        """Check processors are instrumented when metrics are turned on"""
+        self.append_to_file("metrics: yes\n")
+        try:
+            module = Mock()
+            processor = hacksaw.lib.Processor(None)
+            config = Mock()
+            config.stubs().method("compile")
+            module.stubs().method("Config").will(return_value(config))
+            module.stubs().method("Processor").will(return_value(processor))
+            sys.modules['hacksaw.proc.test'] = module
+            processors = processlogs.get_processors(self.config)
+            self.assert_(isinstance(processors[0],
+                                    hacksaw.metrics.InstrumentedProcessor))
+            self.assertEqual(processors[0].name, 'hacksaw.proc.test')
+        finally:
+            del sys.modules['hacksaw.proc.test']
+
 
 class MultipleProcessorTest(ProcessorTest):
 
@@ -75,12 +103,15 @@ class MultipleProcessorTest(ProcessorTest):
         try:
             module = Mock()
             config = Mock()
+            snapshot = Mock()
             module.expects(
                 once()).Config(eq(self.filename)).will(return_value(config))
-            module.expects(once()).Processor(eq(config))
+            config.expects(once()).compile().will(return_value(snapshot))
+            module.expects(once()).Processor(eq(snapshot))
             module.expects(
                 once()).Config(eq(self.filename)).will(return_value(config))
-            module.expects(once()).Processor(eq(config))
+            config.expects(once()).compile().will(return_value(snapshot))
+            module.expects(once()).Processor(eq(snapshot))
             sys.modules['hacksaw.proc.test1'] = module
             sys.modules['hacksaw.proc.test2'] = module
             processors = processlogs.get_processors(self.config)
@@ -111,9 +142,12 @@ class MissingProcessorTest(ProcessorTest):
 
 class UseProcessorsTest(ProcessorTest):
 
+    log_contents = 'Message 1'
+
     def mock_get_processors(self, config):
         self.processor = Mock()
-        self.processor.expects(once()).handle_message(eq('Message 1'))
+        self.processor.expects(once()).handle_messages(eq(['Message 1']))
+        self.processor.expects(once()).close()
         return [self.processor]
 
     def make_log_file(self):
@@ -121,7 +155,7 @@ class UseProcessorsTest(ProcessorTest):
             shutil.rmtree(UseProcessorsTest.SPOOL_DIR)
         os.mkdir(UseProcessorsTest.SPOOL_DIR)
         log = file(os.path.join(UseProcessorsTest.SPOOL_DIR, 'test.log'), 'w')
-        log.write('Message 1')
+        log.write(self.log_contents)
         log.close()
         
     def setUp(self):
@@ -140,6 +174,237 @@ class UseProcessorsTest(ProcessorTest):
         processlogs.process_log_files(self.config)
         self.processor.verify()
 
+    def test_spool_file_removed(self):
+        """Check spool files are removed once they have been processed"""
+        processlogs.process_log_files(self.config)
+        self.assertEqual(
+            processlogs.list_log_files(UseProcessorsTest.SPOOL_DIR), [])
+
+
+class BatchSizeTest(UseProcessorsTest):
+
+    log_contents = 'Message 1\nMessage 2\nMessage 3\n'
+
+    def mock_get_processors(self, config):
+        self.processor = Mock()
+        self.processor.expects(once()).handle_messages(
+            eq(['Message 1\n', 'Message 2\n']))
+        self.processor.expects(once()).handle_messages(
+            eq(['Message 3\n']))
+        self.processor.expects(once()).close()
+        return [self.processor]
+
+    def setUp(self):
+        UseProcessorsTest.setUp(self)
+        self.append_to_file('batchsize: 2\n')
+
+
+class ResumeTest(BatchSizeTest):
+
+    def mock_get_processors(self, config):
+        self.processor = Mock()
+        self.processor.expects(once()).handle_messages(
+            eq(['Message 2\n', 'Message 3\n']))
+        self.processor.expects(once()).close()
+        return [self.processor]
+
+    def setUp(self):
+        BatchSizeTest.setUp(self)
+        log_path = os.path.join(self.SPOOL_DIR, 'test.log')
+        journal = hacksaw.journal.Journal(self.config.journal_directory)
+        journal.commit(log_path, len('Message 1\n'))
+
+    def test_journal_entry_removed(self):
+        """Check the journal forgets about files once they're processed"""
+        processlogs.process_log_files(self.config)
+        self.assertEqual(os.listdir(self.config.journal_directory), [])
+
+
+class AssignLogFilesTest(ProcessorTest):
+
+    def make_log_file(self, name, size):
+        path = os.path.join(self.SPOOL_DIR, name)
+        file(path, 'w').write('x' * size)
+        return path
+
+    def setUp(self):
+        ProcessorTest.setUp(self)
+        if os.path.exists(self.SPOOL_DIR):
+            shutil.rmtree(self.SPOOL_DIR)
+        os.mkdir(self.SPOOL_DIR)
+
+    def tearDown(self):
+        ProcessorTest.tearDown(self)
+        shutil.rmtree(self.SPOOL_DIR)
+
+    def test_balance_work(self):
+        """Check spool files are shared out evenly by size"""
+        big = self.make_log_file('big', 100)
+        medium = self.make_log_file('medium', 60)
+        small = self.make_log_file('small', 50)
+        assigned = processlogs.assign_log_files([small, medium, big], 2)
+        assigned.sort()
+        self.assertEqual(assigned, [[big], [medium, small]])
+
+    def test_more_jobs_than_files(self):
+        """Check we don't start workers that have nothing to do"""
+        path = self.make_log_file('only', 10)
+        self.assertEqual(processlogs.assign_log_files([path], 4), [[path]])
+
+
+class ParallelProcessingTest(ProcessorTest):
+
+    LOG_FILE = './test-output/logfile'
+
+    def setUp(self):
+        ProcessorTest.setUp(self)
+        self.append_to_file('processors: hacksaw.proc.logfile\n')
+        self.append_to_file('[hacksaw.proc.logfile]\n')
+        self.append_to_file('logfile: %s\n' % self.LOG_FILE)
+        if os.path.exists(self.SPOOL_DIR):
+            shutil.rmtree(self.SPOOL_DIR)
+        os.mkdir(self.SPOOL_DIR)
+        self.expected = {}
+        for host in range(4):
+            lines = ['host%d message %d\n' % (host, i) for i in range(100)]
+            spool_file = os.path.join(self.SPOOL_DIR, 'host%d' % host)
+            file(spool_file, 'w').write(''.join(lines))
+            self.expected['host%d' % host] = lines
+
+    def tearDown(self):
+        ProcessorTest.tearDown(self)
+        shutil.rmtree(self.SPOOL_DIR)
+        shutil.rmtree(os.path.dirname(self.LOG_FILE))
+
+    def test_order_kept_within_file(self):
+        """Check each spool file's lines are written out whole and in order"""
+        processlogs.process_log_files(self.config, jobs=3)
+        written = {}
+        for line in file(self.LOG_FILE):
+            written.setdefault(line.split()[0], []).append(line)
+        self.assertEqual(written, self.expected)
+        self.assertEqual(processlogs.list_log_files(self.SPOOL_DIR), [])
+
+
+class DaemonTest(ProcessorTest):
+
+    def mock_get_processors(self, config):
+
+        class FakeProcessor(hacksaw.lib.Processor):
+
+            def handle_messages(self_, messages):
+                self.messages.extend(messages)
+                self.daemon.handle_signal(signal.SIGTERM, None)
+
+            def close(self_):
+                self.closed = True
+
+        return [FakeProcessor(config)]
+
+    def setUp(self):
+        ProcessorTest.setUp(self)
+        self.real_func = processlogs.get_processors
+        processlogs.get_processors = self.mock_get_processors
+        self.append_to_file('processors: hacksaw.proc.logfile\n')
+        self.append_to_file('poll_interval: 0.1\n')
+        if os.path.exists(self.SPOOL_DIR):
+            shutil.rmtree(self.SPOOL_DIR)
+        os.mkdir(self.SPOOL_DIR)
+        self.messages = []
+        self.closed = False
+        self.daemon = processlogs.Daemon(self.config)
+
+    def tearDown(self):
+        processlogs.get_processors = self.real_func
+        ProcessorTest.tearDown(self)
+        shutil.rmtree(self.SPOOL_DIR)
+
+    def test_process_waiting_files(self):
+        """Check the daemon handles files spooled before it started"""
+        file(os.path.join(self.SPOOL_DIR, 'test.log'), 'w').write('Message\n')
+        self.daemon.run()
+        self.assertEqual(self.messages, ['Message\n'])
+        self.assertEqual(processlogs.list_log_files(self.SPOOL_DIR), [])
+        self.assert_(self.closed)
+
+    def test_stop_between_files(self):
+        """Check the daemon stops after the file it's processing"""
+        for name in ('a.log', 'b.log'):
+            file(os.path.join(self.SPOOL_DIR, name), 'w').write('Message\n')
+        self.daemon.run()
+        self.assertEqual(self.messages, ['Message\n'])
+        self.assertEqual(len(processlogs.list_log_files(self.SPOOL_DIR)), 1)
+
+    def test_reload(self):
+        """Check the processors are replaced when the config is reloaded"""
+        old = self.daemon.processors = self.mock_get_processors(self.config)
+        self.daemon.reload()
+        self.assert_(self.closed)
+        self.assertEqual(len(self.daemon.processors), 1)
+        self.failIf(self.daemon.processors[0] is old[0])
+
+    def test_reload_bad_config(self):
+        """Check we keep the old config if the new one can't be read"""
+        processors = self.mock_get_processors(self.config)
+        self.daemon.processors = processors
+        file(self.filename, 'w').write('rubbish\n')
+        real_stderr = sys.stderr
+        sys.stderr = cStringIO.StringIO()
+        try:
+            self.daemon.reload()
+        finally:
+            sys.stderr = real_stderr
+        self.failIf(self.closed)
+        self.assert_(self.daemon.processors is processors)
+        self.assert_(self.daemon.config is self.config)
+
+    def test_restart_interrupted_calls(self):
+        """Check a signal doesn't interrupt a blocking system call"""
+        reader, writer = socket.socketpair()
+        def send():
+            time.sleep(0.1)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.1)
+            writer.send('x')
+        thread = threading.Thread(target=send)
+        handlers = {}
+        for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGINT,
+                       signal.SIGTERM):
+            handlers[signum] = signal.getsignal(signum)
+        self.daemon.install_signal_handlers()
+        try:
+            thread.start()
+            self.assertEqual(reader.recv(1), 'x')
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            thread.join()
+            reader.close()
+            writer.close()
+        self.assert_(self.daemon._reporting)
+
+    def test_skip_bad_file(self):
+        """Check a file that can't be processed doesn't stop the daemon"""
+        real_process_log_file = processlogs.process_log_file
+        def process_log_file(path, *args):
+            if path.endswith('bad.log'):
+                raise IOError(errno.EACCES, 'Permission denied', path)
+            real_process_log_file(path, *args)
+        for name in ('bad.log', 'good.log'):
+            file(os.path.join(self.SPOOL_DIR, name), 'w').write('Message\n')
+        processlogs.process_log_file = process_log_file
+        self.daemon.processors = self.mock_get_processors(self.config)
+        real_stderr = sys.stderr
+        sys.stderr = cStringIO.StringIO()
+        try:
+            self.daemon.process_files(['bad.log', 'good.log'])
+        finally:
+            sys.stderr = real_stderr
+            processlogs.process_log_file = real_process_log_file
+        self.assertEqual(self.messages, ['Message\n'])
+        self.assertEqual(processlogs.list_log_files(self.SPOOL_DIR),
+                         [os.path.join(self.SPOOL_DIR, 'bad.log')])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -29,7 +29,10 @@ metadata (e.g. time, host name, program name, etc.) yourself, giving
 you full control over the contents of the UDP packets that it creates.
 
 See L{Logger.log} and L{Logger.send_packet} for a synopsis of these
-two techniques.
+two techniques. L{Logger.send_packets} sends many packets at once,
+and L{Logger.add_tcp_host} adds a host that is sent packets over TCP.
+L{AsyncLogger} does the same from within an asyncore event loop,
+without ever blocking it.
 
 The format of the UDP packets sent by netsyslog adheres closely to
 that defined in U{RFC 3164<http://www.ietf.org/rfc/rfc3164.txt>}. Much
@@ -46,10 +49,22 @@ page<http://hacksaw.sourceforge.net/netsyslog/>}.
 __version__ = "0.1.0"
 
 
+import asyncore
+import collections
+import errno
 import os
+import select
 import socket
+import struct
 import sys
+import threading
 import time
+import weakref
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
 
 
 class PriPart(object):
@@ -252,8 +267,9 @@ class Packet(object):
     """Combines the PRI, HEADER and MSG into a packet.
 
     If the packet is longer than L{MAX_LEN} bytes in length it is
-    automatically truncated prior to sending; any extraneous bytes are
-    lost.
+    automatically truncated prior to sending over UDP; any extraneous
+    bytes are lost. Packets sent over TCP (see L{TCPTransport}) are
+    sent whole.
 
     """
 
@@ -270,9 +286,532 @@ class Packet(object):
         self.header = header
         self.msg = msg
 
-    def __str__(self):
+    def format(self, truncate=True):
+        """Return the text of the packet.
+
+        The text is cut short at L{MAX_LEN} bytes unless truncate is
+        False.
+
+        """
         message = "%s%s %s" % (self.pri, self.header, self.msg)
-        return message[:self.MAX_LEN]
+        if truncate:
+            return message[:self.MAX_LEN]
+        return message
+
+    def __str__(self):
+        return self.format()
+
+
+class SendResult(object):
+
+    """The outcome of sending a batch of packets to one host.
+
+    See L{Logger.send_packets}. The sent and failed attributes count
+    the packets that were and weren't sent, and queued counts those
+    that were kept to be sent later (see L{TCPTransport}). error is
+    the last socket.error that was raised while sending them, or None.
+
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.queued = 0
+        self.error = None
+
+
+# sendmmsg() hands a whole batch of datagrams to the kernel in one
+# system call. It's only on Linux, so we call it through ctypes when we
+# can and fall back to a sendto() per packet when we can't.
+
+MAX_BATCH = 1024  # UIO_MAXIOV, the most the kernel takes in one call
+
+if ctypes is not None:
+
+    class _IOVec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_char_p),
+                    ("iov_len", ctypes.c_size_t)]
+
+    class _SockAddrIn(ctypes.Structure):
+        _fields_ = [("sin_family", ctypes.c_ushort),
+                    ("sin_port", ctypes.c_ushort),
+                    ("sin_addr", ctypes.c_uint32),
+                    ("sin_zero", ctypes.c_char * 8)]
+
+    class _MsgHdr(ctypes.Structure):
+        _fields_ = [("msg_name", ctypes.c_void_p),
+                    ("msg_namelen", ctypes.c_uint32),
+                    ("msg_iov", ctypes.c_void_p),
+                    ("msg_iovlen", ctypes.c_size_t),
+                    ("msg_control", ctypes.c_void_p),
+                    ("msg_controllen", ctypes.c_size_t),
+                    ("msg_flags", ctypes.c_int)]
+
+    class _MMsgHdr(ctypes.Structure):
+        _fields_ = [("msg_hdr", _MsgHdr),
+                    ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    if ctypes is None or not sys.platform.startswith("linux"):
+        return None
+    try:
+        sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                         ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def _get_sockaddr(address, port):
+    # Returns None for hosts that we only know by name.
+    try:
+        packed = socket.inet_aton(address)
+    except socket.error:
+        return None
+    sockaddr = _SockAddrIn()
+    sockaddr.sin_family = socket.AF_INET
+    sockaddr.sin_port = socket.htons(port)
+    sockaddr.sin_addr = struct.unpack("=I", packed)[0]
+    return sockaddr
+
+
+def _send_batches(fileno, data, sockaddr, result):
+    # Send every string in data to sockaddr, MAX_BATCH at a time. If the
+    # kernel stops part way through a batch we carry on from the packet
+    # that it stopped at; a packet that fails outright is skipped.
+    count = len(data)
+    iovecs = (_IOVec * count)()
+    messages = (_MMsgHdr * count)()
+    iovec_size = ctypes.sizeof(_IOVec)
+    message_size = ctypes.sizeof(_MMsgHdr)
+    iovecs_address = ctypes.addressof(iovecs)
+    sockaddr_address = ctypes.addressof(sockaddr)
+    sockaddr_size = ctypes.sizeof(sockaddr)
+    for i in xrange(count):
+        iovec = iovecs[i]
+        iovec.iov_base = data[i]
+        iovec.iov_len = len(data[i])
+        header = messages[i].msg_hdr
+        header.msg_name = sockaddr_address
+        header.msg_namelen = sockaddr_size
+        header.msg_iov = iovecs_address + i * iovec_size
+        header.msg_iovlen = 1
+    messages_address = ctypes.addressof(messages)
+    position = 0
+    while position < count:
+        sent = _sendmmsg(fileno, messages_address + position * message_size,
+                         min(count - position, MAX_BATCH), 0)
+        if sent < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            result.failed += 1
+            result.error = socket.error(error, os.strerror(error))
+            position += 1
+        else:
+            result.sent += sent
+            position += sent
+
+
+def _make_packet(facility, level, text, pid):
+    pri = PriPart(facility, level)
+    header = HeaderPart()
+    if pid:
+        msg = MsgPart(content=text, pid=os.getpid())
+    else:
+        msg = MsgPart(content=text)
+    return Packet(pri, header, msg)
+
+
+def frame(data):
+    """Frame data for a TCP stream by octet counting (RFC 6587)."""
+    return "%d %s" % (len(data), data)
+
+
+def _read_frames(file_obj, chunk_size=64 * 1024):
+    # Yield the frames in a spill file. A frame that was only partly
+    # written (if we were killed while spilling) ends the file.
+    buffer = ""
+    position = 0
+    while True:
+        space = buffer.find(" ", position)
+        if space != -1:
+            length = buffer[position:space]
+            if not length.isdigit():
+                return
+            end = space + 1 + int(length)
+            if end <= len(buffer):
+                yield buffer[position:end]
+                position = end
+                continue
+        data = file_obj.read(chunk_size)
+        if not data:
+            return
+        buffer = buffer[position:] + data
+        position = 0
+
+
+class TCPTransport(object):
+
+    """Sends packets to a syslog server over TCP.
+
+    Packets are framed by octet counting (RFC 6587), so they aren't
+    truncated to L{Packet.MAX_LEN}. The connection is kept open between
+    sends, and made again when it's lost. Connecting never blocks:
+    packets are queued while the connection is being made, and sent by
+    a later call once it's up (L{close} waits for it). After a failed attempt we wait
+    L{RECONNECT_DELAY} seconds before trying again, doubling the wait
+    after each failure up to L{MAX_RECONNECT_DELAY}.
+
+    While the server can't be reached packets are kept on a queue of up
+    to max_queue packets, and sent before any others once it's back.
+    If spill_path is given, packets that don't fit on the queue are
+    appended to that file (which can grow to max_spill bytes) and sent
+    after the queue. Anything that is still in the file when the
+    transport is next created, say after a restart, is sent too.
+    Packets that don't fit anywhere are dropped; the dropped attribute
+    counts them.
+
+    Packets that were being sent when the connection broke are sent
+    again, so the server may see some of them twice.
+
+    """
+
+    PORT = 514
+    MAX_QUEUE = 10000
+    MAX_SPILL = 100 * 1024 * 1024
+    TIMEOUT = 10
+    RECONNECT_DELAY = 5
+    MAX_RECONNECT_DELAY = 300
+    BATCH_SIZE = 64 * 1024
+
+    def __init__(self, hostname, port=PORT, max_queue=MAX_QUEUE,
+                 spill_path=None, max_spill=MAX_SPILL):
+        self.hostname = hostname
+        self.port = port
+        self.max_queue = max_queue
+        self.spill_path = spill_path
+        self.max_spill = max_spill
+        self.dropped = 0
+        self.last_error = None
+        self._sock = None
+        self._connecting = None
+        self._connect_started = 0
+        self._next_attempt = 0
+        self._delay = None
+        self._queue = collections.deque()
+        self._spilled = 0
+        if spill_path is not None and os.path.exists(spill_path):
+            self._spilled = os.path.getsize(spill_path)
+
+    def _get_pending(self):
+        return len(self._queue)
+
+    pending = property(_get_pending)
+
+    def _is_closed(self):
+        # A server that has closed the connection makes the socket
+        # readable, and we'd otherwise only find out after losing the
+        # next packets that we sent.
+        try:
+            if not select.select([self._sock], [], [], 0)[0]:
+                return False
+            return self._sock.recv(4096) == ""
+        except (select.error, socket.error):
+            return True
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._connecting is not None:
+            self._connecting.close()
+            self._connecting = None
+
+    def _connect_failed(self, error, now):
+        if self._connecting is not None:
+            self._connecting.close()
+            self._connecting = None
+        self.last_error = error
+        if self._delay is None:
+            self._delay = self.RECONNECT_DELAY
+        else:
+            self._delay = min(self._delay * 2, self.MAX_RECONNECT_DELAY)
+        self._next_attempt = now + self._delay
+
+    def _start_connect(self, now):
+        # The name lookup still blocks, but Logger looks its addresses
+        # up the same way.
+        try:
+            address = socket.gethostbyname(self.hostname)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        except (socket.error, UnicodeError), e:
+            self._connect_failed(e, now)
+            return
+        sock.setblocking(0)
+        self._connecting = sock
+        self._connect_started = now
+        error = sock.connect_ex((address, self.port))
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._connect_failed(socket.error(error, os.strerror(error)), now)
+
+    def _finish_connect(self, now):
+        sock = self._connecting
+        try:
+            ready = select.select([], [sock], [], 0)[1]
+        except select.error, e:
+            self._connect_failed(socket.error(*e.args), now)
+            return False
+        if not ready:
+            if now - self._connect_started > self.TIMEOUT:
+                self._connect_failed(socket.timeout("timed out"), now)
+            return False
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._connect_failed(socket.error(error, os.strerror(error)), now)
+            return False
+        sock.settimeout(self.TIMEOUT)
+        self._sock = sock
+        self._connecting = None
+        self._delay = None
+        return True
+
+    def _connect(self):
+        if self._sock is not None:
+            if not self._is_closed():
+                return True
+            self._disconnect()
+        now = time.time()
+        if self._connecting is None:
+            if now < self._next_attempt:
+                return False
+            self._start_connect(now)
+            if self._connecting is None:
+                return False
+        return self._finish_connect(now)
+
+    def _wait_for_connect(self):
+        # Give a connection that's still being made the rest of its
+        # TIMEOUT to come up.
+        if self._connecting is None:
+            return
+        remaining = self._connect_started + self.TIMEOUT - time.time()
+        try:
+            select.select([], [self._connecting], [], max(remaining, 0))
+        except select.error:
+            pass
+        self._connect()
+
+    def _write(self, frames):
+        try:
+            self._sock.sendall("".join(frames))
+        except socket.error, e:
+            self.last_error = e
+            self._disconnect()
+            return False
+        return True
+
+    def _get_batch(self, frames):
+        # Return the frames at the front of frames that make up about
+        # BATCH_SIZE bytes (and always at least one frame).
+        batch = []
+        size = 0
+        for frame in frames:
+            if batch and size + len(frame) > self.BATCH_SIZE:
+                break
+            batch.append(frame)
+            size += len(frame)
+        return batch
+
+    def _send_queue(self):
+        while self._queue:
+            batch = self._get_batch(self._queue)
+            if not self._write(batch):
+                return False
+            for frame in batch:
+                self._queue.popleft()
+        return True
+
+    def _rewrite_spill(self, data, file_obj=None):
+        # Replace the spill file with data followed by the rest of
+        # file_obj, by way of a temporary file so that a crash leaves
+        # one or the other whole.
+        temp_path = self.spill_path + ".tmp"
+        temp_file = file(temp_path, "wb")
+        try:
+            temp_file.write(data)
+            while file_obj is not None:
+                data = file_obj.read(self.BATCH_SIZE)
+                if not data:
+                    break
+                temp_file.write(data)
+        finally:
+            temp_file.close()
+        os.rename(temp_path, self.spill_path)
+        self._spilled = os.path.getsize(self.spill_path)
+
+    def _keep_spill(self, file_obj, offset):
+        # Keep the part of the spill file that we didn't manage to send.
+        # If we can't, it's all sent again next time.
+        file_obj.seek(offset)
+        try:
+            self._rewrite_spill("", file_obj)
+        except (IOError, OSError), e:
+            self.last_error = e
+
+    def _send_spill(self):
+        if not self._spilled:
+            return True
+        try:
+            file_obj = file(self.spill_path, "rb")
+        except IOError, e:
+            self.last_error = e
+            self._spilled = 0
+            return True
+        try:
+            offset = 0
+            batch = []
+            size = 0
+            for frame in _read_frames(file_obj):
+                batch.append(frame)
+                size += len(frame)
+                if size >= self.BATCH_SIZE:
+                    if not self._write(batch):
+                        self._keep_spill(file_obj, offset)
+                        return False
+                    offset += size
+                    batch = []
+                    size = 0
+            if batch and not self._write(batch):
+                self._keep_spill(file_obj, offset)
+                return False
+        finally:
+            file_obj.close()
+        try:
+            os.remove(self.spill_path)
+        except OSError, e:
+            self.last_error = e
+        self._spilled = 0
+        return True
+
+    def flush(self):
+        """Send the packets that are waiting.
+
+        Returns True if there are none left.
+
+        """
+        if not self._queue and not self._spilled:
+            return True
+        return self._connect() and self._send_queue() and self._send_spill()
+
+    def _spill(self, frames, result):
+        kept = []
+        if self.spill_path is not None:
+            size = self._spilled
+            for frame in frames:
+                if size + len(frame) > self.max_spill:
+                    break
+                kept.append(frame)
+                size += len(frame)
+        try:
+            if kept:
+                file_obj = file(self.spill_path, "ab")
+                try:
+                    file_obj.write("".join(kept))
+                finally:
+                    file_obj.close()
+                self._spilled = size
+        except (IOError, OSError), e:
+            self.last_error = e
+            kept = []
+        result.queued += len(kept)
+        result.failed += len(frames) - len(kept)
+        self.dropped += len(frames) - len(kept)
+
+    def _keep(self, frames, result):
+        # Queued packets are always older than spilled ones, so once
+        # we've started spilling everything goes in the file until
+        # it's been sent.
+        room = 0
+        if not self._spilled:
+            room = max(self.max_queue - len(self._queue), 0)
+        self._queue.extend(frames[:room])
+        result.queued += len(frames[:room])
+        if frames[room:]:
+            self._spill(frames[room:], result)
+
+    def send(self, frames):
+        """Send a list of framed packets (see L{frame}).
+
+        Returns a L{SendResult}. Packets are queued rather than sent
+        while there are older ones waiting, or if the server can't be
+        reached.
+
+        """
+        result = SendResult()
+        if self.flush() and self._connect() and self._write(frames):
+            result.sent = len(frames)
+        else:
+            result.error = self.last_error
+            self._keep(frames, result)
+        return result
+
+    def close(self):
+        """Close the connection.
+
+        Waiting packets are sent first, once a connection that's still
+        being made comes up (or TIMEOUT passes). Any that are still
+        queued after that are written to the spill file, if there is
+        one, ahead of those that are already in it. Otherwise, or if
+        the file can't be written, they're lost and counted as dropped
+        (and last_error says why).
+
+        """
+        if self._queue or self._spilled:
+            self._wait_for_connect()
+            self.flush()
+        self._disconnect()
+        if not self._queue:
+            return
+        if self.spill_path is None:
+            self.dropped += len(self._queue)
+        else:
+            spill_file = None
+            try:
+                try:
+                    if self._spilled:
+                        spill_file = file(self.spill_path, "rb")
+                    self._rewrite_spill("".join(self._queue), spill_file)
+                except (IOError, OSError), e:
+                    self.last_error = e
+                    self.dropped += len(self._queue)
+            finally:
+                if spill_file is not None:
+                    spill_file.close()
+        self._queue.clear()
+
+
+def _refresh_addresses(logger_ref, closing, interval):
+    # Runs in a Logger's background thread. It only holds a weak
+    # reference to the logger, so that a logger that is dropped without
+    # being closed can still be garbage collected, and the thread then
+    # stops too. Event.wait() only says whether it was set from Python
+    # 2.7 on, so we ask the event.
+    while True:
+        closing.wait(interval)
+        if closing.isSet():
+            break
+        logger = logger_ref()
+        if logger is None:
+            break
+        logger._refresh_addresses()
+        del logger
 
 
 class Logger(object):
@@ -289,28 +828,107 @@ class Logger(object):
     """
 
     PORT = 514
+    ADDRESS_TTL = 300
 
-    def __init__(self):
+    def __init__(self, address_ttl=ADDRESS_TTL):
+        """Create a logger.
+
+        Each host's address is looked up when it is added, and again
+        every address_ttl seconds by a background thread, so sending a
+        packet never has to wait for a lookup. If a lookup fails the
+        last address that was found is kept. Set address_ttl to 0 to
+        only look addresses up once.
+
+        """
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._hostnames = {}
+        self._tcp_hosts = {}
+        self.address_ttl = address_ttl
+        self._closing = threading.Event()
+        self._refresher = None
+
+    def _resolve(self, hostname):
+        # Hosts whose address we've never been able to find are sent
+        # to by name, leaving it to sendto() to try again.
+        try:
+            address = socket.gethostbyname(hostname)
+        except (socket.error, UnicodeError):
+            address = self._hostnames.get(hostname) or hostname
+        return address
+
+    def _refresh_addresses(self):
+        for hostname in self._hostnames.keys():
+            address = self._resolve(hostname)
+            if hostname in self._hostnames:
+                self._hostnames[hostname] = address
 
     def add_host(self, hostname):
         """Add hostname to the list of hosts that will receive packets.
 
-        Can be a hostname or an IP address. Note that if the hostname
-        cannot be resolved calls to L{log} or L{send_packet} will take
-        a long time to return.
+        Can be a hostname or an IP address. The address is looked up
+        straight away, so this can take a while if the name server is
+        slow to answer.
         
         """
-        self._hostnames[hostname] = 1
+        self._hostnames[hostname] = self._resolve(hostname)
+        if self.address_ttl and self._refresher is None:
+            self._refresher = threading.Thread(
+                target=_refresh_addresses,
+                args=(weakref.ref(self), self._closing, self.address_ttl))
+            self._refresher.setDaemon(True)
+            self._refresher.start()
+
+    def add_tcp_host(self, hostname, port=TCPTransport.PORT,
+                     max_queue=TCPTransport.MAX_QUEUE, spill_path=None):
+        """Add a host that will receive packets over TCP.
+
+        See L{TCPTransport} for the meaning of the arguments. A host
+        can be sent packets over both UDP and TCP. If it's already
+        being sent packets over TCP on the same port, the old
+        transport is replaced.
+
+        """
+        self.remove_tcp_host(hostname, port)
+        self._tcp_hosts[(hostname, port)] = TCPTransport(
+            hostname, port, max_queue, spill_path)
 
     def remove_host(self, hostname):
         """Remove hostname from the list of hosts that will receive packets."""
         del self._hostnames[hostname]
 
+    def remove_tcp_host(self, hostname, port=TCPTransport.PORT):
+        """Stop sending packets to hostname over TCP (see L{add_tcp_host})."""
+        transport = self._tcp_hosts.pop((hostname, port), None)
+        if transport is not None:
+            transport.close()
+
     def _send_packet_to_hosts(self, packet):
-        for hostname in self._hostnames:
-            self._sock.sendto(str(packet), (hostname, self.PORT))
+        data = str(packet)
+        for address in self._hostnames.values():
+            self._sock.sendto(data, (address, self.PORT))
+        if self._tcp_hosts:
+            frames = [frame(packet.format(truncate=False))]
+            for transport in self._tcp_hosts.values():
+                transport.send(frames)
+
+    def _get_fileno(self):
+        try:
+            return self._sock.fileno()
+        except AttributeError:
+            return None
+
+    def _send_each(self, data, address, result):
+        sendto = self._sock.sendto
+        destination = (address, self.PORT)
+        failed = 0
+        for datum in data:
+            try:
+                sendto(datum, destination)
+            except socket.error, e:
+                failed += 1
+                result.error = e
+        result.sent += len(data) - failed
+        result.failed += failed
 
     def log(self, facility, level, text, pid=False):
         """Send the message text to all registered hosts.
@@ -333,14 +951,7 @@ class Logger(object):
         colon.
 
         """
-        pri = PriPart(facility, level)
-        header = HeaderPart()
-        if pid:
-            msg = MsgPart(content=text, pid=os.getpid())
-        else:
-            msg = MsgPart(content=text)
-        packet = Packet(pri, header, msg)
-        self._send_packet_to_hosts(packet)
+        self._send_packet_to_hosts(_make_packet(facility, level, text, pid))
 
     def send_packet(self, packet):
         """Send a L{Packet} object to all registered hosts.
@@ -360,3 +971,196 @@ class Logger(object):
 
         """
         self._send_packet_to_hosts(packet)
+
+    def send_packets(self, packets):
+        """Send each of an iterable of L{Packet} objects to all hosts.
+
+        This is much quicker than calling L{send_packet} for each
+        packet. On Linux the packets are handed to the kernel in
+        batches, so a thousand packets need one system call per host
+        rather than a thousand; elsewhere they're sent one at a time.
+
+        An error sending one packet doesn't stop the rest from being
+        sent. Returns a dictionary that maps a (protocol, hostname,
+        port) tuple for each host, where protocol is "udp" or "tcp", to
+        a L{SendResult} recording how many packets were sent to that
+        host and how many weren't.
+
+        """
+        packets = list(packets)
+        data = [str(packet) for packet in packets]
+        fileno = None
+        if _sendmmsg is not None:
+            fileno = self._get_fileno()
+        results = {}
+        for hostname, address in self._hostnames.items():
+            result = results[("udp", hostname, self.PORT)] = SendResult()
+            sockaddr = None
+            if fileno is not None:
+                sockaddr = _get_sockaddr(address, self.PORT)
+            if sockaddr is not None:
+                _send_batches(fileno, data, sockaddr, result)
+            else:
+                self._send_each(data, address, result)
+        if self._tcp_hosts:
+            frames = [frame(packet.format(truncate=False))
+                      for packet in packets]
+            for (hostname, port), transport in self._tcp_hosts.items():
+                results[("tcp", hostname, port)] = transport.send(frames)
+        return results
+
+    def close(self):
+        """Close the socket used to send packets.
+
+        The logger can't be used again once it has been closed.
+
+        """
+        self._closing.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+        # Every transport gets the chance to spill its queue, even if
+        # closing another one fails; the first error is raised after.
+        error = None
+        try:
+            for transport in self._tcp_hosts.values():
+                try:
+                    transport.close()
+                except Exception:
+                    if error is None:
+                        error = sys.exc_info()
+            if error is not None:
+                raise error[0], error[1], error[2]
+        finally:
+            self._sock.close()
+
+
+class AsyncLogger(asyncore.dispatcher):
+
+    """Send log messages from within an asyncore event loop.
+
+    AsyncLogger has the same methods as L{Logger}, but they never
+    block. Each packet is put on a queue for each host and sent by the
+    event loop when the socket is ready, so the loop must be running
+    for anything to be sent::
+
+        logger = netsyslog.AsyncLogger()
+        logger.add_host("localhost")
+        logger.log(syslog.LOG_USER, syslog.LOG_INFO, "Hello World")
+        asyncore.loop()
+
+    The queue holds at most max_queue datagrams. Packets that arrive
+    when it's full are dropped, so that a burst of messages can't use
+    up all our memory; the dropped attribute counts them. The sent
+    and errors attributes count the datagrams that were sent and that
+    couldn't be, and pending is the number still on the queue.
+
+    Addresses are only looked up when hosts are added. Closing the
+    logger throws away anything that is still on the queue.
+
+    """
+
+    PORT = 514
+    MAX_QUEUE = 10000
+    WRITES_PER_EVENT = 100
+
+    def __init__(self, max_queue=MAX_QUEUE, map=None):
+        """Create a logger, adding it to map (or asyncore's own map)."""
+        asyncore.dispatcher.__init__(self, map=map)
+        self.create_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.max_queue = max_queue
+        self._destinations = {}
+        self._queue = collections.deque()
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+
+    def add_host(self, hostname):
+        """Add hostname to the list of hosts that will receive packets."""
+        try:
+            address = socket.gethostbyname(hostname)
+        except (socket.error, UnicodeError):
+            address = hostname
+        self._destinations[hostname] = (address, self.PORT)
+
+    def remove_host(self, hostname):
+        """Remove hostname from the list of hosts that will receive packets."""
+        del self._destinations[hostname]
+
+    def _get_pending(self):
+        return len(self._queue)
+
+    pending = property(_get_pending)
+
+    def _queue_data(self, data):
+        queued = True
+        for destination in self._destinations.values():
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                queued = False
+            else:
+                self._queue.append((data, destination))
+        return queued
+
+    def log(self, facility, level, text, pid=False):
+        """Queue the message text to be sent to all registered hosts.
+
+        See L{Logger.log}. Returns False if the message was dropped
+        for any of the hosts because the queue was full.
+
+        """
+        return self._queue_data(str(_make_packet(facility, level, text,
+                                                 pid)))
+
+    def send_packet(self, packet):
+        """Queue a L{Packet} object to be sent to all registered hosts.
+
+        Returns False if the packet was dropped for any of the hosts
+        because the queue was full.
+
+        """
+        return self._queue_data(str(packet))
+
+    def send_packets(self, packets):
+        """Queue each of an iterable of L{Packet} objects.
+
+        Returns the number of packets that were queued for every host.
+
+        """
+        queued = 0
+        for packet in packets:
+            if self._queue_data(str(packet)):
+                queued += 1
+        return queued
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return bool(self._queue)
+
+    def handle_connect(self):
+        # asyncore treats the first write event on a socket that isn't
+        # connected as a connection; there's nothing to do for UDP.
+        pass
+
+    def handle_write(self):
+        # Only send a few datagrams each time round the loop, so that
+        # the other channels don't have to wait for a long queue.
+        queue = self._queue
+        sendto = self.socket.sendto
+        for i in xrange(self.WRITES_PER_EVENT):
+            if not queue:
+                break
+            data, destination = queue[0]
+            try:
+                sendto(data, destination)
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.ENOBUFS):
+                    break  # try again when the socket's writable
+                self.errors += 1
+                self.last_error = e
+            else:
+                self.sent += 1
+            queue.popleft()
@@ -18,8 +18,12 @@
 # $Id$
 
 
+import asyncore
 import copy
+import cStringIO
+import errno
 import os
+import shutil
 import socket
 import sys
 import syslog
@@ -183,14 +187,21 @@ class LoggerTest(MockHeaderTest, MockMsgTest):
     def mock_socket(self, family, proto):
         return self.mock_sock
         
+    def fail_to_resolve(self, hostname):
+        raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        
     def setUp(self):
         MockHeaderTest.setUp(self)
         MockMsgTest.setUp(self)
         self.mock_sock = Mock()
         self.real_socket = socket.socket
         socket.socket = self.mock_socket
+        # Unresolvable hosts are sent to by name.
+        self.real_gethostbyname = socket.gethostbyname
+        socket.gethostbyname = self.fail_to_resolve
 
     def tearDown(self):
+        socket.gethostbyname = self.real_gethostbyname
         socket.socket = self.real_socket
         MockMsgTest.tearDown(self)
         MockHeaderTest.tearDown(self)
@@ -261,7 +272,472 @@ class LoggerTest(MockHeaderTest, MockMsgTest):
         logger.add_host(hostname)
         logger.send_packet(packet)
         self.mock_sock.verify()
-    
+
+    def test_close(self):
+        """Check closing the logger closes its socket"""
+        self.mock_sock.expects(once()).close()
+        logger = netsyslog.Logger()
+        logger.close()
+        self.mock_sock.verify()
+
+
+
+class FakeSocket(object):
+
+    unreachable = []
+
+    def __init__(self, family, proto):
+        self.sent = []
+
+    def sendto(self, data, address):
+        if address[0] in FakeSocket.unreachable:
+            raise socket.error(errno.EHOSTUNREACH, "No route to host")
+        self.sent.append((data, address))
+
+    def close(self):
+        pass
+
+
+class AddressCacheTest(unittest.TestCase):
+
+    def resolve(self, hostname):
+        self.lookups += 1
+        try:
+            return self.addresses[hostname]
+        except KeyError:
+            raise socket.gaierror(socket.EAI_NONAME,
+                                  "Name or service not known")
+
+    def setUp(self):
+        self.addresses = {"loghost": "10.0.0.1"}
+        self.lookups = 0
+        self.real_socket = socket.socket
+        self.real_gethostbyname = socket.gethostbyname
+        socket.socket = FakeSocket
+        socket.gethostbyname = self.resolve
+        pri = netsyslog.PriPart(syslog.LOG_LOCAL4, syslog.LOG_NOTICE)
+        header = netsyslog.HeaderPart("Jan  1 10:00:00", "myhost")
+        msg = netsyslog.MsgPart("myprog", "hello")
+        self.packet = netsyslog.Packet(pri, header, msg)
+
+    def tearDown(self):
+        socket.gethostbyname = self.real_gethostbyname
+        socket.socket = self.real_socket
+
+    def get_addresses(self, logger):
+        return [address for data, address in logger._sock.sent]
+
+    def test_resolve_once(self):
+        """Check we only look a host up when it's added"""
+        logger = netsyslog.Logger(address_ttl=0)
+        logger.add_host("loghost")
+        for i in range(3):
+            logger.send_packet(self.packet)
+        self.assertEqual(self.lookups, 1)
+        self.assertEqual(self.get_addresses(logger),
+                         [("10.0.0.1", netsyslog.Logger.PORT)] * 3)
+        logger.close()
+
+    def test_unresolvable_host(self):
+        """Check we send to hosts we can't look up by name"""
+        logger = netsyslog.Logger(address_ttl=0)
+        logger.add_host("nohost")
+        logger.send_packet(self.packet)
+        self.assertEqual(self.get_addresses(logger),
+                         [("nohost", netsyslog.Logger.PORT)])
+        logger.close()
+
+    def test_keep_last_good_address(self):
+        """Check we keep the last address we found if a lookup fails"""
+        logger = netsyslog.Logger(address_ttl=0)
+        logger.add_host("loghost")
+        del self.addresses["loghost"]
+        logger._refresh_addresses()
+        logger.send_packet(self.packet)
+        self.assertEqual(self.get_addresses(logger),
+                         [("10.0.0.1", netsyslog.Logger.PORT)])
+        logger.close()
+
+    def test_refresh(self):
+        """Check addresses are looked up again in the background"""
+        logger = netsyslog.Logger(address_ttl=0.01)
+        logger.add_host("loghost")
+        self.addresses["loghost"] = "10.0.0.2"
+        for i in range(200):
+            if self.lookups > 1:
+                break
+            time.sleep(0.01)
+        logger.close()
+        logger.send_packet(self.packet)
+        self.assertEqual(self.get_addresses(logger),
+                         [("10.0.0.2", netsyslog.Logger.PORT)])
+
+    def test_send_packets_one_at_a_time(self):
+        """Check send_packets() falls back to sending each packet"""
+        self.addresses["otherhost"] = "10.0.0.3"
+        FakeSocket.unreachable = ["10.0.0.3"]
+        try:
+            logger = netsyslog.Logger(address_ttl=0)
+            logger.add_host("loghost")
+            logger.add_host("otherhost")
+            results = logger.send_packets([self.packet] * 3)
+        finally:
+            FakeSocket.unreachable = []
+        self.assertEqual(logger._sock.sent,
+                         [(str(self.packet),
+                           ("10.0.0.1", netsyslog.Logger.PORT))] * 3)
+        loghost = results[("udp", "loghost", netsyslog.Logger.PORT)]
+        otherhost = results[("udp", "otherhost", netsyslog.Logger.PORT)]
+        self.assertEqual((loghost.sent, loghost.failed), (3, 0))
+        self.assertEqual(loghost.error, None)
+        self.assertEqual((otherhost.sent, otherhost.failed), (0, 3))
+        self.assertEqual(otherhost.error.args[0],
+                         errno.EHOSTUNREACH)
+        logger.close()
+
+
+class SendPacketsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(5)
+        self.logger = netsyslog.Logger(address_ttl=0)
+        self.logger.PORT = self.server.getsockname()[1]
+        self.logger.add_host("127.0.0.1")
+        self.key = ("udp", "127.0.0.1", self.logger.PORT)
+
+    def tearDown(self):
+        self.logger.close()
+        self.server.close()
+
+    def make_packet(self, i):
+        pri = netsyslog.PriPart(syslog.LOG_LOCAL4, syslog.LOG_NOTICE)
+        header = netsyslog.HeaderPart("Jan  1 10:00:00", "myhost")
+        msg = netsyslog.MsgPart("myprog", "message %d" % i)
+        return netsyslog.Packet(pri, header, msg)
+
+    def test_send_packets(self):
+        """Check send_packets() sends every packet in order"""
+        packets = [self.make_packet(i) for i in range(10)]
+        results = self.logger.send_packets(iter(packets))
+        self.assertEqual(results[self.key].sent, 10)
+        self.assertEqual(results[self.key].failed, 0)
+        for packet in packets:
+            self.assertEqual(self.server.recv(2048), str(packet))
+
+    def test_more_than_one_batch(self):
+        """Check we can send more packets than fit in one batch"""
+        count = netsyslog.MAX_BATCH + 10
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               1024 * 1024)
+        packets = [self.make_packet(i) for i in range(count)]
+        results = self.logger.send_packets(packets)
+        self.assertEqual(results[self.key].sent, count)
+        self.assertEqual(self.server.recv(2048), str(packets[0]))
+
+    def test_no_packets(self):
+        """Check sending no packets does nothing"""
+        results = self.logger.send_packets([])
+        self.assertEqual(results[self.key].sent, 0)
+
+
+class AsyncLoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(5)
+        self.map = {}
+        self.logger = netsyslog.AsyncLogger(max_queue=5, map=self.map)
+        self.logger.PORT = self.server.getsockname()[1]
+        self.logger.add_host("127.0.0.1")
+
+    def tearDown(self):
+        self.logger.close()
+        self.server.close()
+
+    def make_packet(self, i):
+        pri = netsyslog.PriPart(syslog.LOG_LOCAL4, syslog.LOG_NOTICE)
+        header = netsyslog.HeaderPart("Jan  1 10:00:00", "myhost")
+        msg = netsyslog.MsgPart("myprog", "message %d" % i)
+        return netsyslog.Packet(pri, header, msg)
+
+    def run_loop(self):
+        for i in range(100):
+            if not self.logger.pending:
+                break
+            asyncore.loop(timeout=0.1, map=self.map, count=1)
+
+    def test_send_from_loop(self):
+        """Check packets are only sent by the event loop"""
+        packets = [self.make_packet(i) for i in range(3)]
+        self.assert_(self.logger.send_packet(packets[0]))
+        self.assertEqual(self.logger.send_packets(packets[1:]), 2)
+        self.assertEqual(self.logger.pending, 3)
+        self.assertEqual(self.logger.sent, 0)
+        self.run_loop()
+        self.assertEqual(self.logger.pending, 0)
+        self.assertEqual(self.logger.sent, 3)
+        for packet in packets:
+            self.assertEqual(self.server.recv(2048), str(packet))
+
+    def test_log(self):
+        """Check log() queues a packet"""
+        self.assert_(self.logger.log(syslog.LOG_USER, syslog.LOG_INFO,
+                                     "Hello World"))
+        self.run_loop()
+        self.assert_(self.server.recv(2048).endswith("Hello World"))
+
+    def test_drop_when_full(self):
+        """Check packets are dropped when the queue is full"""
+        packets = [self.make_packet(i) for i in range(8)]
+        self.assertEqual(self.logger.send_packets(packets), 5)
+        self.failIf(self.logger.send_packet(packets[0]))
+        self.assertEqual(self.logger.dropped, 4)
+        self.run_loop()
+        self.assertEqual(self.logger.sent, 5)
+        self.assertEqual(self.server.recv(2048), str(packets[0]))
+
+    def test_send_error(self):
+        """Check a packet that can't be sent is counted and skipped"""
+        self.logger.add_host("nohost.invalid")
+        self.logger.send_packet(self.make_packet(0))
+        self.run_loop()
+        self.assertEqual(self.logger.sent, 1)
+        self.assertEqual(self.logger.errors, 1)
+        self.assert_(isinstance(self.logger.last_error, socket.error))
+
+
+class TCPTransportTest(unittest.TestCase):
+
+    SPILL_DIR = "./test-spill"
+
+    def setUp(self):
+        if os.path.exists(self.SPILL_DIR):
+            shutil.rmtree(self.SPILL_DIR)
+        os.mkdir(self.SPILL_DIR)
+        self.spill_path = os.path.join(self.SPILL_DIR, "loghost.spill")
+        # Nothing is listening on the port until start_server() is
+        # called, so connecting to it is refused.
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(5)
+        self.port = self.server.getsockname()[1]
+        self.transports = []
+
+    def tearDown(self):
+        for transport in self.transports:
+            transport.close()
+        self.server.close()
+        shutil.rmtree(self.SPILL_DIR)
+
+    def start_server(self):
+        self.server.listen(5)
+
+    def make_transport(self, **options):
+        transport = netsyslog.TCPTransport("127.0.0.1", self.port, **options)
+        transport.RECONNECT_DELAY = 0
+        self.transports.append(transport)
+        return transport
+
+    def wait_for_connection(self, transport):
+        # Connections are made without blocking, so the first send may
+        # only start one.
+        for i in range(500):
+            if transport._connect():
+                return
+            time.sleep(0.01)
+        self.fail("no connection made")
+
+    def receive(self, size):
+        connection = self.server.accept()[0]
+        connection.settimeout(5)
+        data = ""
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        connection.close()
+        return data
+
+    def test_frame(self):
+        """Check packets are framed by octet counting"""
+        self.assertEqual(netsyslog.frame("<13>hello"), "9 <13>hello")
+
+    def test_send(self):
+        """Check we can send packets over a connection"""
+        self.start_server()
+        transport = self.make_transport()
+        self.wait_for_connection(transport)
+        frames = [netsyslog.frame("one"), netsyslog.frame("two")]
+        result = transport.send(frames)
+        self.assertEqual((result.sent, result.queued, result.failed),
+                         (2, 0, 0))
+        self.assertEqual(self.receive(10), "3 one3 two")
+
+    def test_no_truncation(self):
+        """Check long packets aren't truncated when sent over TCP"""
+        self.start_server()
+        logger = netsyslog.Logger(address_ttl=0)
+        logger.add_tcp_host("127.0.0.1", self.port)
+        pri = netsyslog.PriPart(syslog.LOG_LOCAL4, syslog.LOG_NOTICE)
+        header = netsyslog.HeaderPart("Jan  1 10:00:00", "myhost")
+        msg = netsyslog.MsgPart("myprog", "x" * 2000)
+        packet = netsyslog.Packet(pri, header, msg)
+        logger.send_packets([])
+        self.wait_for_connection(logger._tcp_hosts.values()[0])
+        results = logger.send_packets([packet])
+        self.assertEqual(results[("tcp", "127.0.0.1", self.port)].sent, 1)
+        text = packet.format(truncate=False)
+        self.assert_(len(text) > netsyslog.Packet.MAX_LEN)
+        self.assertEqual(self.receive(len(netsyslog.frame(text))),
+                         netsyslog.frame(text))
+        logger.close()
+
+    def test_queue_while_down(self):
+        """Check packets are queued until the server can be reached"""
+        transport = self.make_transport()
+        result = transport.send([netsyslog.frame("one")])
+        self.assertEqual((result.sent, result.queued), (0, 1))
+        self.start_server()
+        self.wait_for_connection(transport)
+        result = transport.send([netsyslog.frame("two")])
+        self.assertEqual(result.sent, 1)
+        self.assertEqual(transport.pending, 0)
+        self.assertEqual(self.receive(10), "3 one3 two")
+
+    def test_drop_when_full(self):
+        """Check packets are dropped when the queue is full"""
+        transport = self.make_transport(max_queue=2)
+        frames = [netsyslog.frame(str(i)) for i in range(3)]
+        result = transport.send(frames)
+        self.assertEqual((result.queued, result.failed), (2, 1))
+        self.assertEqual(transport.dropped, 1)
+
+    def test_spill(self):
+        """Check packets spill to disk and are sent after a restart"""
+        transport = self.make_transport(max_queue=1,
+                                        spill_path=self.spill_path)
+        frames = [netsyslog.frame(str(i)) for i in range(4)]
+        result = transport.send(frames[:2])
+        self.assertEqual((result.queued, result.failed), (2, 0))
+        transport.send(frames[2:])
+        self.assertEqual(transport.pending, 1)
+        transport.close()
+        self.assertEqual(file(self.spill_path).read(), "".join(frames))
+        self.start_server()
+        transport = self.make_transport(spill_path=self.spill_path)
+        self.wait_for_connection(transport)
+        self.assert_(transport.flush())
+        self.failIf(os.path.exists(self.spill_path))
+        self.assertEqual(self.receive(12), "".join(frames))
+
+    def test_reconnect(self):
+        """Check we connect again when the server closes the connection"""
+        self.start_server()
+        transport = self.make_transport()
+        self.wait_for_connection(transport)
+        transport.send([netsyslog.frame("one")])
+        self.assertEqual(self.receive(5), "3 one")
+        time.sleep(0.1)
+        transport.send([])
+        self.wait_for_connection(transport)
+        result = transport.send([netsyslog.frame("two")])
+        self.assertEqual(result.sent, 1)
+        self.assertEqual(self.receive(5), "3 two")
+
+    def test_back_off(self):
+        """Check we don't try to connect while we're waiting to retry"""
+        transport = self.make_transport()
+        transport.RECONNECT_DELAY = 5
+        for i in range(500):
+            transport.send([])
+            if transport.last_error is not None:
+                break
+            time.sleep(0.01)
+        self.assert_(isinstance(transport.last_error, socket.error))
+        self.start_server()
+        start = time.time()
+        result = transport.send([netsyslog.frame("one")])
+        self.assert_(time.time() - start < 1)
+        self.assertEqual(result.queued, 1)
+        self.assertEqual(transport._connecting, None)
+
+    def test_reconnect_delay_doubles(self):
+        """Check we wait longer after each failed connection"""
+        transport = self.make_transport()
+        transport.RECONNECT_DELAY = 5
+        transport.MAX_RECONNECT_DELAY = 15
+        delays = []
+        for i in range(4):
+            transport._connect_failed(socket.error(), 100)
+            delays.append(transport._next_attempt - 100)
+        self.assertEqual(delays, [5, 10, 15, 15])
+
+    def test_missing_spill_dir(self):
+        """Check packets are dropped if the spill file can't be written"""
+        spill_path = os.path.join(self.SPILL_DIR, "missing", "loghost.spill")
+        transport = self.make_transport(max_queue=1, spill_path=spill_path)
+        frames = [netsyslog.frame(str(i)) for i in range(2)]
+        result = transport.send(frames)
+        self.assertEqual((result.queued, result.failed), (1, 1))
+        transport.close()
+        self.assertEqual(transport.dropped, 2)
+        self.assert_(isinstance(transport.last_error, IOError))
+
+    def test_same_host_over_udp_and_tcp(self):
+        """Check a host sent to over UDP and TCP gets two results"""
+        logger = netsyslog.Logger(address_ttl=0)
+        logger.PORT = self.port
+        logger.add_host("127.0.0.1")
+        logger.add_tcp_host("127.0.0.1", self.port)
+        pri = netsyslog.PriPart(syslog.LOG_LOCAL4, syslog.LOG_NOTICE)
+        header = netsyslog.HeaderPart("Jan  1 10:00:00", "myhost")
+        packet = netsyslog.Packet(pri, header, netsyslog.MsgPart("myprog"))
+        results = logger.send_packets([packet])
+        keys = results.keys()
+        keys.sort()
+        self.assertEqual(keys, [("tcp", "127.0.0.1", self.port),
+                                ("udp", "127.0.0.1", self.port)])
+        self.assertEqual(results[("tcp", "127.0.0.1", self.port)].queued, 1)
+        logger.close()
+
+    def test_close_every_transport(self):
+        """Check the logger closes everything if a transport won't close"""
+        logger = netsyslog.Logger(address_ttl=0)
+        logger.add_tcp_host("127.0.0.1", self.port)
+        logger.add_tcp_host("127.0.0.1", self.port + 1)
+        closed = []
+        def fail_to_close():
+            closed.append(None)
+            raise IOError(errno.ENOSPC, "No space left on device")
+        for transport in logger._tcp_hosts.values():
+            transport.close = fail_to_close
+        self.assertRaises(IOError, logger.close)
+        self.assertEqual(len(closed), 2)
+        self.assertRaises(socket.error, logger._sock.sendto, "x",
+                          ("127.0.0.1", self.port))
+
+    def test_close_while_connecting(self):
+        """Check close() sends the queue once the connection comes up"""
+        self.start_server()
+        transport = self.make_transport()
+        transport._start_connect(time.time())
+        transport._queue.append(netsyslog.frame("one"))
+        transport.close()
+        self.assertEqual(transport.dropped, 0)
+        self.assertEqual(transport.pending, 0)
+        self.assertEqual(self.receive(5), "3 one")
+
+    def test_partly_written_spill(self):
+        """Check a frame cut short at the end of a spill file is ignored"""
+        frames = list(netsyslog._read_frames(
+            cStringIO.StringIO("3 one3 two5 thr"), chunk_size=4))
+        self.assertEqual(frames, ["3 one", "3 two"])
+
 
 if __name__ == "__main__":
     unittest.main()